@@ -0,0 +1,303 @@
+"""
+Batched offline analysis of capture files
+
+    python analyze.py [--wrapped] [--batch N] CAPTURE...
+
+Packets are pulled out of the streams recorded from and to the PIM, then
+checked and summarised in NumPy batches: checksum failures, per device
+message and retry rates, ACK/NAK ratios per destination and an MDID
+histogram, printed as JSON. Transmits are taken from the TO_PIM records,
+captures without them have no transmit or ACK/NAK figures. Requires numpy.
+"""
+
+import argparse
+import json
+import sys
+from binascii import unhexlify
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from capture import CaptureReader, CaptureDirection
+from const import UpbMessage, UpbTransmission, PimCommand, GATEWAY_REQUEST_HEADER_BYTES, \
+GATEWAY_REQUEST_LENGTH_OFFSET, GATEWAY_RESPONSE_HEADER_BYTES, GATEWAY_RESPONSE_LENGTH_OFFSET, \
+GATEWAY_TRAILER_BYTES, MdidSet
+from framer import Framer
+from pulse import PulseDecoder, PulseEvent
+
+ANALYZE_BATCH = 1000000
+ANALYZE_PACKET_BYTES = 32
+DEVICE_KEYS = 1 << 16
+
+PIM_REPORT = UpbMessage.UPB_MESSAGE_PIMREPORT
+ACK = UpbTransmission.UPB_TRANSMISSION_ACK
+NAK = UpbTransmission.UPB_TRANSMISSION_NAK
+BUSY = UpbTransmission.UPB_PIM_BUSY
+MESSAGE = UpbTransmission.UPB_MESSAGE
+TRANSMIT = PimCommand.UPB_NETWORK_TRANSMIT
+
+
+class CaptureExtractor:
+    """
+    Splits a capture into received packets, packets written to the PIM and
+    PIM outcome reports, 0 for ACK, 1 for NAK and -1 for busy, which
+    answers a transmit the proxy sends again. Client records are not used,
+    cache hits and coalesced commands from them never reach the PIM.
+    """
+
+    def __init__(self, wrapped=False):
+        self.wrapped = wrapped
+        self.pim_framer = Framer()
+        self.sent_framer = Framer()
+        self.decoder = PulseDecoder()
+        self.received = []
+        self.received_times = []
+        self.transmitted = []
+        self.transmitted_times = []
+        self.outcomes = []
+
+    def __len__(self):
+        return len(self.received) + len(self.transmitted)
+
+    def take(self):
+        """
+        Returns and clears what has been extracted so far.
+        """
+        taken = (self.received, self.received_times, self.transmitted, self.transmitted_times, self.outcomes)
+        self.received = []
+        self.received_times = []
+        self.transmitted = []
+        self.transmitted_times = []
+        self.outcomes = []
+        return taken
+
+    def pim_line(self, timestamp, line):
+        if len(line) > 1 and line[0] == PIM_REPORT:
+            transmission = line[1]
+            if transmission == MESSAGE:
+                try:
+                    self.received.append(unhexlify(line[2:]))
+                    self.received_times.append(timestamp)
+                except ValueError:
+                    pass
+            elif transmission == ACK:
+                self.outcomes.append(0)
+            elif transmission == NAK:
+                self.outcomes.append(1)
+            elif transmission == BUSY:
+                self.outcomes.append(-1)
+            return True
+        return False
+
+    def pim_lines(self, timestamp, lines):
+        pulse = [line for line in lines if not self.pim_line(timestamp, line)]
+        if pulse:
+            for event in self.decoder.decode(pulse):
+                if event[0] == PulseEvent.PACKET and not event[2]:
+                    self.received.append(bytes(event[1]))
+                    self.received_times.append(timestamp)
+
+    def sent_line(self, timestamp, line):
+        if len(line) > 2 and line[0] == TRANSMIT:
+            try:
+                self.transmitted.append(unhexlify(line[1:]))
+                self.transmitted_times.append(timestamp)
+            except ValueError:
+                pass
+
+    def feed(self, timestamp, direction, data):
+        if direction == CaptureDirection.FROM_PIM:
+            framer = self.pim_framer
+            framer.feed(data)
+            if not self.wrapped:
+                for line in framer.lines(b'\x00'):
+                    if bytes(line[:14]) == b'AUTH SUCCEEDED':
+                        self.wrapped = True
+                        self.sent_framer.clear()
+                        break
+                else:
+                    self.pim_lines(timestamp, [bytes(line) for line in framer.lines(b'\r') if len(line) > 1])
+                    return
+            self.pim_lines(timestamp, [bytes(payload[:-1]) for cmd, frame, payload in framer.gateway_frames(
+                GATEWAY_RESPONSE_HEADER_BYTES, GATEWAY_RESPONSE_LENGTH_OFFSET, GATEWAY_TRAILER_BYTES,
+                cmd_offset=1)])
+        elif direction == CaptureDirection.TO_PIM:
+            framer = self.sent_framer
+            framer.feed(data)
+            if self.wrapped:
+                for cmd, frame, payload in framer.gateway_frames(GATEWAY_REQUEST_HEADER_BYTES,
+                        GATEWAY_REQUEST_LENGTH_OFFSET, GATEWAY_TRAILER_BYTES):
+                    self.sent_line(timestamp, payload[:-1])
+                return
+            for line in framer.lines(b'\x00'):
+                pass
+            for line in framer.lines(b'\r'):
+                self.sent_line(timestamp, line)
+
+
+def packet_matrix(packets):
+    """
+    Packs packets into a zero padded (count, ANALYZE_PACKET_BYTES) uint8
+    array, returned with the array of their lengths.
+    """
+    packets = [packet[:ANALYZE_PACKET_BYTES] for packet in packets]
+    count = len(packets)
+    lengths = np.fromiter(map(len, packets), dtype=np.int64, count=count)
+    flat = np.frombuffer(b''.join(packets), dtype=np.uint8)
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    matrix = np.zeros((count, ANALYZE_PACKET_BYTES), dtype=np.uint8)
+    matrix[np.repeat(np.arange(count), lengths), np.arange(len(flat)) - starts] = flat
+    return matrix, lengths
+
+
+def packet_columns(matrix, lengths):
+    """
+    Decodes the header fields of every row of a packet matrix at once.
+    """
+    byte0 = matrix[:, 0]
+    byte1 = matrix[:, 1]
+    valid = (lengths >= 7) & ((byte0 & 0x1f) == lengths) & \
+        ((matrix.sum(axis=1, dtype=np.uint32) & 0xff) == 0)
+    return {
+        'valid': valid,
+        'link': (byte0 >> 7).astype(bool),
+        'repeater': (byte0 >> 5) & 0x03,
+        'ack': (byte1 >> 4) & 0x07,
+        'transmit_cnt': (byte1 >> 2) & 0x03,
+        'transmit_seq': byte1 & 0x03,
+        'network': matrix[:, 2],
+        'destination': matrix[:, 3],
+        'source': matrix[:, 4],
+        'mdid': matrix[:, 5],
+    }
+
+
+class Analysis:
+    """
+    Running totals over batches, kept as fixed size arrays indexed by
+    network << 8 | device and by MDID.
+    """
+
+    def __init__(self):
+        self.first = None
+        self.last = None
+        self.received = 0
+        self.transmitted = 0
+        self.checksum_failures = 0
+        self.device_messages = np.zeros(DEVICE_KEYS, dtype=np.int64)
+        self.device_retries = np.zeros(DEVICE_KEYS, dtype=np.int64)
+        self.destination_outcomes = np.zeros(DEVICE_KEYS, dtype=np.int64)
+        self.destination_naks = np.zeros(DEVICE_KEYS, dtype=np.int64)
+        self.received_mdids = np.zeros(256, dtype=np.int64)
+        self.transmitted_mdids = np.zeros(256, dtype=np.int64)
+        self.pending_transmits = np.zeros(0, dtype=np.int64)
+        self.pending_outcomes = np.zeros(0, dtype=np.int8)
+
+    def times(self, timestamps):
+        if timestamps:
+            first, last = min(timestamps), max(timestamps)
+            self.first = first if self.first is None else min(self.first, first)
+            self.last = last if self.last is None else max(self.last, last)
+
+    def add(self, received, received_times, transmitted, transmitted_times, outcomes):
+        self.times(received_times)
+        self.times(transmitted_times)
+        if received:
+            columns = packet_columns(*packet_matrix(received))
+            valid = columns['valid']
+            self.received += len(received)
+            self.checksum_failures += int((~valid).sum())
+            keys = (columns['network'][valid].astype(np.int64) << 8) | columns['source'][valid]
+            self.device_messages += np.bincount(keys, minlength=DEVICE_KEYS)
+            self.device_retries += np.bincount(keys, weights=columns['transmit_seq'][valid] > 0,
+                minlength=DEVICE_KEYS).astype(np.int64)
+            self.received_mdids += np.bincount(columns['mdid'][valid], minlength=256)
+        if transmitted:
+            columns = packet_columns(*packet_matrix(transmitted))
+            valid = columns['valid']
+            self.transmitted += len(transmitted)
+            self.transmitted_mdids += np.bincount(columns['mdid'][valid], minlength=256)
+            keys = (columns['network'].astype(np.int64) << 8) | columns['destination']
+            self.pending_transmits = np.concatenate((self.pending_transmits, keys))
+        if outcomes:
+            self.pending_outcomes = np.concatenate((self.pending_outcomes, np.array(outcomes, dtype=np.int8)))
+        # outcomes answer the transmits written to the PIM in order, pair up what both sides have
+        paired = min(len(self.pending_transmits), len(self.pending_outcomes))
+        if paired:
+            outcomes = self.pending_outcomes[:paired]
+            answered = outcomes >= 0
+            keys = self.pending_transmits[:paired][answered]
+            self.destination_outcomes += np.bincount(keys, minlength=DEVICE_KEYS)
+            self.destination_naks += np.bincount(keys, weights=outcomes[answered],
+                minlength=DEVICE_KEYS).astype(np.int64)
+            self.pending_transmits = self.pending_transmits[paired:]
+            self.pending_outcomes = self.pending_outcomes[paired:]
+
+    def as_dict(self):
+        duration = (self.last - self.first) / 1e9 if self.first is not None and self.last > self.first else None
+        devices = {}
+        for key in np.flatnonzero(self.device_messages):
+            messages = int(self.device_messages[key])
+            devices[f'{key >> 8}/{key & 0xff}'] = {
+                'messages': messages,
+                'rate': messages / duration if duration else None,
+                'retry_ratio': int(self.device_retries[key]) / messages,
+            }
+        destinations = {}
+        for key in np.flatnonzero(self.destination_outcomes):
+            outcomes = int(self.destination_outcomes[key])
+            destinations[f'{key >> 8}/{key & 0xff}'] = {
+                'transmits': outcomes,
+                'nak_ratio': int(self.destination_naks[key]) / outcomes,
+            }
+        return {
+            'duration': duration,
+            'received': self.received,
+            'transmitted': self.transmitted,
+            'checksum_failures': self.checksum_failures,
+            'nak_ratio': int(self.destination_naks.sum()) / max(int(self.destination_outcomes.sum()), 1),
+            'devices': devices,
+            'destinations': destinations,
+            'received_mdids': mdid_histogram(self.received_mdids),
+            'transmitted_mdids': mdid_histogram(self.transmitted_mdids),
+        }
+
+
+def mdid_histogram(counts):
+    histogram = {}
+    for value in np.flatnonzero(counts):
+        mdid_set = MdidSet(int(value) & 0xe0)
+        histogram[f'{value:#04x}'] = {'set': mdid_set.name, 'count': int(counts[value])}
+    return histogram
+
+
+def analyze(paths, wrapped=False, batch=ANALYZE_BATCH):
+    extractor = CaptureExtractor(wrapped)
+    analysis = Analysis()
+    for path in paths:
+        with CaptureReader(path) as reader:
+            for timestamp, direction, data in reader:
+                extractor.feed(timestamp, direction, data)
+                data.release()
+                if len(extractor) >= batch:
+                    analysis.add(*extractor.take())
+    analysis.add(*extractor.take())
+    return analysis
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze upbshark captures')
+    parser.add_argument('--wrapped', action='store_true', help='captures start after the auth handshake')
+    parser.add_argument('--batch', type=int, default=ANALYZE_BATCH)
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+    if np is None:
+        print('analyze.py requires numpy', file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(analyze(args.paths, args.wrapped, args.batch).as_dict(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
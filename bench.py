@@ -0,0 +1,414 @@
+"""
+Benchmarks of the proxy pipeline
+
+    python bench.py [--quick] [--output FILE] [--compare BASELINE [--threshold 0.2]]
+
+Runs each benchmark over synthetic traffic mixes and prints the results
+as JSON. With --compare the run is checked against a previous result
+file and exits non-zero when any benchmark is slower by more than
+threshold.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import statistics
+import sys
+import time
+from binascii import hexlify, unhexlify
+
+import proxy
+from const import GatewayCmd, UpbMessage, UpbTransmission, PimCommand, MdidCoreReport, GATEWAY_RESPONSE_HEADER_BYTES, \
+GATEWAY_RESPONSE_LENGTH_OFFSET, GATEWAY_TRAILER_BYTES
+from encoder import CommandEncoder
+from framer import Framer, encode_gateway_request, encode_gateway_response
+from packet import encode_packet
+from pulse import PulseDecoder
+from simulator import SimulatedNetwork, SimulatedPIM, pulse_lines, report_mdid, GETSIGNALSTRENGTH
+from util import cksum, hexdump
+
+BENCH_SEED = 0x5eed
+BENCH_REPEAT = 5
+BENCH_PACKETS = 2000
+BENCH_CHUNK = 1024
+BENCH_RELAY_COUNT = 200
+BENCH_ROUNDTRIP_COUNT = 20
+BENCH_USERNAME = 'bench'
+BENCH_PASSWORD = 'bench'
+
+REGISTERVALUES = report_mdid(MdidCoreReport.MDID_DEVICE_CORE_REPORT_REGISTERVALUES)
+DEVICESTATE = report_mdid(MdidCoreReport.MDID_DEVICE_CORE_REPORT_DEVICESTATE)
+
+
+class NullTransport:
+
+    def write(self, data):
+        pass
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def abort(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def line_frame(line):
+    return encode_gateway_response(GatewayCmd.SEND_TO_SERIAL, line + b'\r')
+
+
+def report_line(transmission, data=b''):
+    return bytes((UpbMessage.UPB_MESSAGE_PIMREPORT, transmission)) + data
+
+
+def state_packets(rand, count):
+    return [encode_packet(1, 0xff, rand.randrange(1, 250), DEVICESTATE, bytes((rand.randrange(101),)))
+        for _ in range(count)]
+
+
+def register_packets(rand, count):
+    packets = []
+    for _ in range(count):
+        start = rand.randrange(0, 240, 16)
+        values = bytes(rand.randrange(256) for _ in range(16))
+        packets.append(encode_packet(1, 0xff, rand.randrange(1, 250), REGISTERVALUES, bytes((start,)) + values))
+    return packets
+
+
+def traffic_mixes(count):
+    """
+    Returns {name: (packets, lines)} for each mix, lines being what the PIM
+    sends for them.
+    """
+    rand = random.Random(BENCH_SEED)
+    mixes = {}
+    # idle: keep alives and the occasional accept/ack/state report
+    packets = state_packets(rand, count // 20)
+    lines = []
+    for packet in packets:
+        lines += [report_line(UpbTransmission.UPB_PIM_ACCEPT), report_line(UpbTransmission.UPB_TRANSMISSION_ACK),
+            report_line(UpbTransmission.UPB_MESSAGE, hexlify(packet).upper())]
+    mixes['idle'] = (packets, lines)
+    # pulse: every received packet as pulse mode crumbs
+    packets = state_packets(rand, count // 4) + register_packets(rand, count // 4)
+    rand.shuffle(packets)
+    lines = []
+    for packet in packets:
+        lines += pulse_lines(packet)
+    mixes['pulse'] = (packets, lines)
+    # register storm: back to back register reports
+    packets = register_packets(rand, count)
+    lines = [report_line(UpbTransmission.UPB_MESSAGE, hexlify(packet).upper()) for packet in packets]
+    mixes['registers'] = (packets, lines)
+    return mixes
+
+
+def stream(lines, keep_alives=0):
+    frames = [line_frame(line) for line in lines]
+    if keep_alives:
+        keep_alive = encode_gateway_response(GatewayCmd.KEEP_ALIVE, b'')
+        frames = [keep_alive] * keep_alives + frames
+    return b''.join(frames)
+
+
+def chunks(data, size=BENCH_CHUNK):
+    return [data[offset:offset + size] for offset in range(0, len(data), size)]
+
+
+def measure(name, func, ops, repeat):
+    """
+    Runs func repeat times, returns the result of the fastest run.
+    """
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        func()
+        times.append(time.perf_counter_ns() - started)
+    best = min(times)
+    return {
+        'name': name,
+        'ops': ops,
+        'repeat': repeat,
+        'ns_per_op': best / ops,
+        'ops_per_sec': ops / (best / 1e9) if best else None,
+        'median_ns_per_op': statistics.median(times) / ops,
+    }
+
+
+def latency_result(name, samples):
+    samples = sorted(samples)
+    return {
+        'name': name,
+        'ops': len(samples),
+        'ns_per_op': statistics.median(samples) * 1e9,
+        'p90_ns': samples[int(len(samples) * 0.9)] * 1e9,
+        'p99_ns': samples[min(int(len(samples) * 0.99), len(samples) - 1)] * 1e9,
+        'max_ns': samples[-1] * 1e9,
+    }
+
+
+def bench_framing(mixes, repeat):
+    results = []
+    for mix, (packets, lines) in mixes.items():
+        data = chunks(stream(lines, keep_alives=len(lines) if mix == 'idle' else 0))
+        framer = Framer()
+
+        def run():
+            for chunk in data:
+                framer.feed(chunk)
+                for frame in framer.gateway_frames(GATEWAY_RESPONSE_HEADER_BYTES,
+                        GATEWAY_RESPONSE_LENGTH_OFFSET, GATEWAY_TRAILER_BYTES, cmd_offset=1):
+                    pass
+        ops = len(lines) * (2 if mix == 'idle' else 1)
+        results.append(measure(f'framing.{mix}', run, ops, repeat))
+    return results
+
+
+def bench_pulse(mixes, repeat):
+    packets, lines = mixes['pulse']
+    decoder = PulseDecoder()
+    batches = [lines[offset:offset + 64] for offset in range(0, len(lines), 64)]
+
+    def run():
+        decoder.reset()
+        for batch in batches:
+            decoder.decode(batch)
+    return [measure('pulse_decode.pulse', run, len(packets), repeat)]
+
+
+def bench_packets(mixes, repeat):
+    results = []
+    pim = proxy.PIM(register_path=None)
+    for mix, (packets, lines) in mixes.items():
+        def run():
+            proxy.decode_packet.cache_clear()
+            for packet in packets:
+                pim.process_packet(packet)
+        results.append(measure(f'process_packet.{mix}', run, len(packets), repeat))
+
+    rand = random.Random(BENCH_SEED)
+    commands = [bytes((PimCommand.UPB_NETWORK_TRANSMIT,)) + hexlify(encode_packet(1, rand.randrange(1, 250), 0xff,
+        GETSIGNALSTRENGTH)).upper() for _ in range(BENCH_PACKETS)]
+    session = proxy.Upstart(NullTransport(), pim)
+
+    def run():
+        proxy.decode_packet.cache_clear()
+        for line in commands:
+            session.line_received(line)
+    results.append(measure('upstart_line_received', run, len(commands), repeat))
+    return results
+
+
+def bench_util(mixes, repeat):
+    packets = mixes['registers'][0]
+    bodies = [packet[:-1] for packet in packets]
+
+    def run_cksum():
+        for body in bodies:
+            cksum(body)
+
+    def run_hexdump():
+        for packet in packets:
+            hexdump(packet)
+
+    encoder = CommandEncoder()
+    targets = [(packet[4], packet[6]) for packet in packets]
+
+    def run_encode():
+        for device_id, start in targets:
+            encoder.get_registers(1, device_id, start, 16)
+    return [
+        measure('cksum', run_cksum, len(bodies), repeat),
+        measure('hexdump', run_hexdump, len(packets), repeat),
+        measure('encode_transmit', run_encode, len(targets), repeat),
+    ]
+
+
+async def bench_pipeline(mixes, repeat):
+    """
+    PIM.data_received over each mix with one session attached.
+    """
+    results = []
+    for mix, (packets, lines) in mixes.items():
+        data = chunks(stream(lines))
+        pim = proxy.PIM(register_path=None)
+        pim.connection_made(NullTransport())
+        pim.initial = False
+        pim.wrapped = True
+        session = proxy.Upstart(NullTransport(), pim)
+        session.connection_made(NullTransport())
+
+        def run():
+            for chunk in data:
+                pim.data_received(chunk)
+        results.append(measure(f'pim_data_received.{mix}', run, len(packets), repeat))
+        pim.connection_lost(None)
+    return results
+
+
+class RelayClient(asyncio.Protocol):
+    """
+    Client side of the loopback relay, queues the null terminated lines of
+    the handshake and then timestamps each complete frame.
+    """
+
+    def __init__(self):
+        self.framer = Framer()
+        self.lines = asyncio.Queue()
+        self.wrapped = False
+        self.waiter = None
+        self.expect = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    async def handshake(self, username, password):
+        self.transport.write(b'UPStart/5.0.1/BENCH\x00')
+        banner = await asyncio.wait_for(self.lines.get(), 1.0)
+        challenge = unhexlify(banner.split(b'/')[4])
+        self.transport.write(username.encode('utf-8') + b'/' + proxy.auth_digest(password, challenge) + b'\x00')
+        result = await asyncio.wait_for(self.lines.get(), 1.0)
+        if not result.startswith(b'AUTH SUCCEEDED/'):
+            raise RuntimeError(f'relay handshake failed: {result}')
+        self.wrapped = True
+
+    def data_received(self, data):
+        self.framer.feed(data)
+        if not self.wrapped:
+            for line in self.framer.lines(b'\x00'):
+                self.lines.put_nowait(bytes(line))
+            return
+        for cmd, frame, payload in self.framer.gateway_frames(GATEWAY_RESPONSE_HEADER_BYTES,
+                GATEWAY_RESPONSE_LENGTH_OFFSET, GATEWAY_TRAILER_BYTES, cmd_offset=1):
+            if self.waiter is not None and not self.waiter.done() and bytes(payload).startswith(self.expect):
+                self.waiter.set_result(time.perf_counter())
+
+    def wait_for(self, expect):
+        self.expect = expect
+        self.waiter = asyncio.get_event_loop().create_future()
+        return self.waiter
+
+
+async def bench_relay(count, roundtrips):
+    """
+    Loopback latency through a proxy between the simulator and a client:
+    PIM to client relay of unsolicited reports, and the round trip of a
+    command to its device report including the scheduler's pacing. The
+    client does the real hello and auth exchange first, session setup is
+    not part of the timings.
+    """
+    loop = asyncio.get_event_loop()
+    pims = []
+    network = SimulatedNetwork(1, range(1, 11))
+
+    def simulated():
+        pims.append(SimulatedPIM(network, BENCH_USERNAME, BENCH_PASSWORD))
+        return pims[-1]
+    sim = await loop.create_server(simulated, '127.0.0.1', 0)
+    pim_t, pim_p = await loop.create_connection(lambda: proxy.PIM(register_path=None, username=BENCH_USERNAME,
+        password=BENCH_PASSWORD), *sim.sockets[0].getsockname()[:2])
+    server = await loop.create_server(lambda: proxy.Upstart(pim_t, pim_p, BENCH_USERNAME, BENCH_PASSWORD),
+        '127.0.0.1', 0)
+    client_t, client = await loop.create_connection(RelayClient, *server.sockets[0].getsockname()[:2])
+    try:
+        await client.handshake(BENCH_USERNAME, BENCH_PASSWORD)
+        relay = []
+        packets = state_packets(random.Random(BENCH_SEED), count)
+        for packet in packets:
+            line = report_line(UpbTransmission.UPB_MESSAGE, hexlify(packet).upper())
+            waiter = client.wait_for(line)
+            started = time.perf_counter()
+            pims[0].send_line(line)
+            relay.append(await asyncio.wait_for(waiter, 1.0) - started)
+
+        roundtrip = []
+        expect = report_line(UpbTransmission.UPB_MESSAGE)
+        for index in range(roundtrips):
+            packet = encode_packet(1, index % 10 + 1, 0xff, GETSIGNALSTRENGTH)
+            waiter = client.wait_for(expect)
+            started = time.perf_counter()
+            client_t.write(encode_gateway_request(GatewayCmd.SEND_TO_SERIAL,
+                bytes((PimCommand.UPB_NETWORK_TRANSMIT,)) + hexlify(packet).upper() + b'\r'))
+            roundtrip.append(await asyncio.wait_for(waiter, 5.0) - started)
+        return [latency_result('relay.pim_to_client', relay), latency_result('relay.roundtrip', roundtrip)]
+    finally:
+        client_t.close()
+        server.close()
+        pim_t.close()
+        sim.close()
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {result['name']: result for result in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['name'])
+        if previous is None or not previous['ns_per_op']:
+            continue
+        change = result['ns_per_op'] / previous['ns_per_op'] - 1
+        result['change'] = change
+        if change > threshold:
+            regressions.append(result['name'])
+    return regressions
+
+
+async def run(args):
+    count = BENCH_PACKETS // 10 if args.quick else BENCH_PACKETS
+    repeat = 1 if args.quick else BENCH_REPEAT
+    mixes = traffic_mixes(count)
+    results = []
+    results += bench_framing(mixes, repeat)
+    results += bench_pulse(mixes, repeat)
+    results += bench_packets(mixes, repeat)
+    results += bench_util(mixes, repeat)
+    results += await bench_pipeline(mixes, repeat)
+    if not args.no_relay:
+        results += await bench_relay(BENCH_RELAY_COUNT // 10 if args.quick else BENCH_RELAY_COUNT,
+            BENCH_ROUNDTRIP_COUNT // 4 if args.quick else BENCH_ROUNDTRIP_COUNT)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='upbshark benchmarks')
+    parser.add_argument('--quick', action='store_true')
+    parser.add_argument('--no-relay', action='store_true')
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.getLogger('upbshark').setLevel(logging.ERROR)
+    results = asyncio.run(run(args))
+    regressions = compare(results, args.compare, args.threshold) if args.compare else []
+    report = {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'quick': args.quick,
+        },
+        'results': results,
+        'regressions': regressions,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Binary capture of proxy traffic
+
+A capture file starts with CAPTURE_MAGIC and a header holding the
+monotonic and wall clock time it was opened, followed by records of a
+monotonic nanosecond timestamp, a direction byte, a length and the raw
+bytes. FROM_PIM and FROM_CLIENT records hold what the proxy received,
+TO_PIM records what it wrote to the PIM, its own commands included.
+"""
+
+import mmap
+import os
+import sys
+import threading
+import time
+from enum import IntEnum
+from struct import Struct
+
+from log import getLogger
+from util import hexdump
+
+log = getLogger('capture')
+
+CAPTURE_MAGIC = b'UPBCAP1\n'
+CAPTURE_HEADER = Struct('<Qd')
+CAPTURE_RECORD = Struct('<QBI')
+CAPTURE_MAX_BYTES = 64 * 1024 * 1024
+CAPTURE_BACKUP_COUNT = 10
+CAPTURE_FLUSH_INTERVAL = 0.5
+CAPTURE_BATCH_BYTES = 256 * 1024
+CAPTURE_MAX_PENDING = 16 * 1024 * 1024
+
+
+class CaptureDirection(IntEnum):
+    FROM_PIM = 0
+    FROM_CLIENT = 1
+    TO_PIM = 2
+
+
+class CaptureWriter:
+    """
+    Collects records in memory and writes them in batches from a background
+    thread, rotating to path.1 .. path.N when a file exceeds max_bytes.
+    Records are dropped rather than buffered past max_pending bytes.
+    """
+
+    def __init__(self, path, max_bytes=CAPTURE_MAX_BYTES, backup_count=CAPTURE_BACKUP_COUNT,
+                 flush_interval=CAPTURE_FLUSH_INTERVAL, max_pending=CAPTURE_MAX_PENDING):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = []
+        self.pending_bytes = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.file = None
+        self.open()
+        self.thread = threading.Thread(target=self.run, name='capture-writer', daemon=True)
+        self.thread.start()
+
+    def open(self):
+        self.file = open(self.path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC + CAPTURE_HEADER.pack(time.monotonic_ns(), time.time()))
+
+    def rotate(self):
+        self.file.close()
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                source = f'{self.path}.{index}'
+                if os.path.exists(source):
+                    os.replace(source, f'{self.path}.{index + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def write(self, direction, data):
+        size = CAPTURE_RECORD.size + len(data)
+        with self.lock:
+            if self.pending_bytes + size > self.max_pending:
+                self.dropped += 1
+                return
+            self.pending.append(CAPTURE_RECORD.pack(time.monotonic_ns(), direction, len(data)))
+            self.pending.append(bytes(data))
+            self.pending_bytes += size
+        if self.pending_bytes >= CAPTURE_BATCH_BYTES:
+            self.wakeup.set()
+
+    def flush(self):
+        with self.lock:
+            batch = self.pending
+            self.pending = []
+            self.pending_bytes = 0
+        if batch:
+            self.file.write(b''.join(batch))
+            self.file.flush()
+            if self.file.tell() >= self.max_bytes:
+                self.rotate()
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                log.error("capture write failed: %s", e)
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+        if self.dropped:
+            log.warning("capture dropped %d records", self.dropped)
+
+
+class CaptureReader:
+    """
+    Iterates the records of a capture file through mmap, yielding
+    (timestamp_ns, direction, data) with data a memoryview into the map.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[0:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            self.map.close()
+            raise ValueError(f'{path} is not a capture file')
+        self.opened_ns, self.opened_time = CAPTURE_HEADER.unpack_from(self.map, len(CAPTURE_MAGIC))
+        self.view = memoryview(self.map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+
+    def __iter__(self):
+        view = self.view
+        end = len(view)
+        offset = len(CAPTURE_MAGIC) + CAPTURE_HEADER.size
+        unpack_from = CAPTURE_RECORD.unpack_from
+        header_size = CAPTURE_RECORD.size
+        while offset + header_size <= end:
+            timestamp, direction, length = unpack_from(view, offset)
+            offset += header_size
+            if offset + length > end:
+                log.warning("truncated record at end of %s", self.path)
+                return
+            yield timestamp, direction, view[offset:offset + length]
+            offset += length
+
+    def wall_time(self, timestamp):
+        return self.opened_time + (timestamp - self.opened_ns) / 1e9
+
+
+def main():
+    for path in sys.argv[1:]:
+        with CaptureReader(path) as reader:
+            for timestamp, direction, data in reader:
+                print(f'{reader.wall_time(timestamp):.6f} {CaptureDirection(direction).name} {hexdump(data)}')
+                data.release()
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,14 @@ PULSE_REPORT_BYTES = 3
 
 PACKETHEADER_LINKBIT = 0x80
 
+# client -> gateway: cmd, length(2), payload, checksum
+GATEWAY_REQUEST_HEADER_BYTES = 3
+GATEWAY_REQUEST_LENGTH_OFFSET = 1
+# gateway -> client: cmd + 1, rc, reserved(4), length(2), payload, checksum
+GATEWAY_RESPONSE_HEADER_BYTES = 8
+GATEWAY_RESPONSE_LENGTH_OFFSET = 6
+GATEWAY_TRAILER_BYTES = 1
+
 class GatewayCmd(IntEnum):
     KEEP_ALIVE = 0x10
     SET_DATE_TIME = 0x20
@@ -53,6 +61,10 @@ class UpbTransmission(IntEnum):
     UPB_TRANSMISSION_ACK = 0x4b # K
     UPB_TRANSMISSION_NAK = 0x4e # N
 
+    @classmethod
+    def has_value(cls, value):
+        return value in cls._value2member_map_
+
 class UpbMessage(IntEnum):
     UPB_MESSAGE_PIMREPORT = 0x50 # P
     UPB_MESSAGE_START = 0x58 # X
@@ -0,0 +1,75 @@
+"""
+Suppression of the repeated copies UPB sends of each message
+"""
+
+import time
+from collections import OrderedDict
+
+from log import getLogger
+
+log = getLogger('dedupe')
+
+DEDUPE_WINDOW = 2.0
+
+
+class MessageCopies:
+    """
+    One logical message, count is the number of copies seen so far and
+    keeps growing while repeats arrive. relay is cleared when the message
+    is not relayed to clients so its repeats are not either.
+    """
+
+    __slots__ = ('first', 'seq', 'count', 'relay')
+
+    def __init__(self, first, seq):
+        self.first = first
+        self.seq = seq
+        self.count = 1
+        self.relay = True
+
+
+class MessageDeduper:
+    """
+    Groups copies of a message by the packet without its transmit sequence
+    bits and checksum. A copy is a repeat when it arrives within window
+    seconds of the first and carries a higher sequence number, a copy with
+    the same or a lower one starts a new message.
+    """
+
+    def __init__(self, window=DEDUPE_WINDOW, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.messages = OrderedDict()
+        self.repeats = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def expire(self, now):
+        messages = self.messages
+        deadline = now - self.window
+        while messages:
+            key, copies = next(iter(messages.items()))
+            if copies.first > deadline:
+                break
+            del messages[key]
+
+    def observe(self, raw):
+        """
+        Returns the MessageCopies raw belongs to, its count is 1 for the
+        first copy of a message.
+        """
+        now = self.clock()
+        self.expire(now)
+        seq = raw[1] & 0x03
+        key = bytes((raw[0], raw[1] & 0xfc)) + bytes(raw[2:-1])
+        copies = self.messages.get(key)
+        if copies is not None and seq > copies.seq:
+            copies.seq = seq
+            copies.count += 1
+            self.repeats += 1
+            return copies
+        copies = MessageCopies(now, seq)
+        self.messages.pop(key, None)
+        self.messages[key] = copies
+        return copies
@@ -0,0 +1,155 @@
+"""
+Encoding of PIM commands into reusable buffers
+"""
+
+from const import PimCommand, GatewayCmd, UpbDeviceId, UpbReqAck, UpbReqRepeater, MdidSet, MdidCoreCmd, \
+MdidDeviceControlCmd, PACKETHEADER_LINKBIT, GATEWAY_REQUEST_HEADER_BYTES, GATEWAY_TRAILER_BYTES
+from inflight import mdid
+
+HEX_DIGITS = b'0123456789ABCDEF'
+HEX_HIGH = bytes(HEX_DIGITS[value >> 4] for value in range(256))
+HEX_LOW = bytes(HEX_DIGITS[value & 0x0f] for value in range(256))
+
+PACKET_HEADER_BYTES = 6
+MAX_PACKET_BYTES = 0x1f
+MAX_DATA_BYTES = MAX_PACKET_BYTES - PACKET_HEADER_BYTES - 1
+MAX_LINE_BYTES = 1 + 2 * MAX_PACKET_BYTES + 1
+MAX_FRAME_BYTES = GATEWAY_REQUEST_HEADER_BYTES + MAX_LINE_BYTES + GATEWAY_TRAILER_BYTES
+
+ACTIVATELINK = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS, MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_ACTIVATELINK)
+DEACTIVATELINK = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS,
+    MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_DEACTIVATELINK)
+GOTO = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS, MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_GOTO)
+REPORTSTATE = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS, MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_REPORTSTATE)
+GETDEVICESTATUS = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETDEVICESTATUS)
+GETREGISTERVALUES = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETREGISTERVALUES)
+SETREGISTERVALUES = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_SETREGISTERVALUES)
+
+
+def control_word(link=False, repeater=UpbReqRepeater.REP_NONREPEATER, ack=UpbReqAck.REQ_ACKDEFAULT,
+                 transmit_cnt=0, transmit_seq=0):
+    """
+    Control word bits other than the length, as taken by encode_packet().
+    """
+    high = (PACKETHEADER_LINKBIT if link else 0) | ((repeater & 0x03) << 5)
+    low = ((ack & 0x07) << 4) | ((transmit_cnt & 0x03) << 2) | (transmit_seq & 0x03)
+    return (high << 8) | low
+
+
+class CommandEncoder:
+    """
+    Builds PIM command lines, wrapped in a SEND_TO_SERIAL frame when the
+    session is wrapped, into buffers owned by the encoder. Returned views
+    are only valid until the next call, bytes() them to keep one.
+    """
+
+    def __init__(self, wrapped=True, source_id=UpbDeviceId.DEFAULT_DEVICEID):
+        self.wrapped = wrapped
+        self.source_id = source_id
+        self.packet_buf = bytearray(MAX_PACKET_BYTES)
+        self.packet_view = memoryview(self.packet_buf)
+        self.frame_buf = bytearray(MAX_FRAME_BYTES)
+        self.frame_view = memoryview(self.frame_buf)
+        self.packet_len = 0
+
+    @property
+    def packet(self):
+        """
+        The raw packet of the last transmit encoded.
+        """
+        return self.packet_view[:self.packet_len]
+
+    def encode_packet(self, network_id, destination_id, mdid, data=b'', control=0, source_id=None):
+        size = len(data)
+        if size > MAX_DATA_BYTES:
+            raise ValueError(f'{size} data bytes do not fit in a packet')
+        length = PACKET_HEADER_BYTES + size + 1
+        packet = self.packet_buf
+        packet[0] = ((control >> 8) & 0xe0) | length
+        packet[1] = control & 0xff
+        packet[2] = network_id
+        packet[3] = destination_id
+        packet[4] = self.source_id if source_id is None else source_id
+        packet[5] = mdid
+        packet[PACKET_HEADER_BYTES:length - 1] = data
+        packet[length - 1] = -sum(self.packet_view[:length - 1]) & 0xff
+        self.packet_len = length
+        return self.packet_view[:length]
+
+    def encode_command(self, command, body, size):
+        """
+        Encodes command and the first size bytes of body as a line, framed
+        when wrapped.
+        """
+        frame = self.frame_buf
+        offset = GATEWAY_REQUEST_HEADER_BYTES if self.wrapped else 0
+        frame[offset] = command
+        position = offset + 1
+        for index in range(size):
+            value = body[index]
+            frame[position] = HEX_HIGH[value]
+            frame[position + 1] = HEX_LOW[value]
+            position += 2
+        frame[position] = 0x0d
+        position += 1
+        if not self.wrapped:
+            return self.frame_view[:position]
+        length = position - offset
+        frame[0] = GatewayCmd.SEND_TO_SERIAL
+        frame[1] = length >> 8
+        frame[2] = length & 0xff
+        frame[position] = -sum(self.frame_view[:position]) & 0xff
+        return self.frame_view[:position + GATEWAY_TRAILER_BYTES]
+
+    def transmit(self, network_id, destination_id, mdid, data=b'', link=False,
+                 repeater=UpbReqRepeater.REP_NONREPEATER, ack=UpbReqAck.REQ_ACKDEFAULT, transmit_cnt=0,
+                 source_id=None):
+        self.encode_packet(network_id, destination_id, mdid, data,
+            control_word(link, repeater, ack, transmit_cnt), source_id)
+        return self.encode_command(PimCommand.UPB_NETWORK_TRANSMIT, self.packet_buf, self.packet_len)
+
+    def pim_read(self, start, count):
+        body = self.packet_buf
+        body[0] = start
+        body[1] = count
+        body[2] = -(start + count) & 0xff
+        self.packet_len = 0
+        return self.encode_command(PimCommand.UPB_PIM_READ, body, 3)
+
+    def pim_write(self, start, values):
+        size = len(values)
+        if size + 2 > MAX_PACKET_BYTES:
+            raise ValueError(f'{size} register values do not fit in a PIM write')
+        body = self.packet_buf
+        body[0] = start
+        body[1:1 + size] = values
+        body[1 + size] = -sum(self.packet_view[:1 + size]) & 0xff
+        self.packet_len = 0
+        return self.encode_command(PimCommand.UPB_PIM_WRITE, body, size + 2)
+
+    def activate_link(self, network_id, link_id, **kwargs):
+        return self.transmit(network_id, link_id, ACTIVATELINK, link=True, **kwargs)
+
+    def deactivate_link(self, network_id, link_id, **kwargs):
+        return self.transmit(network_id, link_id, DEACTIVATELINK, link=True, **kwargs)
+
+    def goto(self, network_id, destination_id, level, rate=None, channel=None, link=False, **kwargs):
+        if channel is not None:
+            data = bytes((level, 0xff if rate is None else rate, channel))
+        elif rate is not None:
+            data = bytes((level, rate))
+        else:
+            data = bytes((level,))
+        return self.transmit(network_id, destination_id, GOTO, data, link=link, **kwargs)
+
+    def report_state(self, network_id, device_id, **kwargs):
+        return self.transmit(network_id, device_id, REPORTSTATE, **kwargs)
+
+    def get_device_status(self, network_id, device_id, **kwargs):
+        return self.transmit(network_id, device_id, GETDEVICESTATUS, **kwargs)
+
+    def get_registers(self, network_id, device_id, start, count, **kwargs):
+        return self.transmit(network_id, device_id, GETREGISTERVALUES, bytes((start, count)), **kwargs)
+
+    def set_registers(self, network_id, device_id, start, values, **kwargs):
+        return self.transmit(network_id, device_id, SETREGISTERVALUES, bytes((start,)) + bytes(values), **kwargs)
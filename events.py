@@ -0,0 +1,306 @@
+"""
+Decoded event stream for integrations
+
+Subscribers connect to the events port and either send a JSON filter
+line (an empty line for everything) and read newline delimited JSON, or
+open a WebSocket on /events with the filter in the query string and
+read one JSON array per batch:
+
+    {"networks": [1], "devices": [5, 6], "mdids": [134], "types": ["message", "link"]}
+    GET /events?network=1&device=5,6&mdid=0x86&type=message,link
+
+Event types are message, transmit (commands sent to the PIM), link
+(link activations either way) and pim_report. ACK and NAK reports carry
+the network, source, destination and MDID of the transmit they answer.
+A device matches the source or destination of an event. Events are collected for
+batch_interval seconds and each is serialised once for all subscribers.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import time
+from urllib.parse import urlsplit, parse_qs
+
+from const import UpbTransmission, MdidSet, MdidDeviceControlCmd
+from inflight import mdid
+from log import getLogger
+from packet import MDID_CMD_SETS
+
+log = getLogger('events')
+
+EVENTS_BATCH_INTERVAL = 0.05
+EVENTS_WRITE_BUFFER_LIMIT = 256 * 1024
+EVENTS_MAX_REQUEST = 8192
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+ACK_REPORTS = frozenset((UpbTransmission.UPB_TRANSMISSION_ACK, UpbTransmission.UPB_TRANSMISSION_NAK))
+
+ACTIVATELINK = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS, MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_ACTIVATELINK)
+DEACTIVATELINK = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS,
+    MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_DEACTIVATELINK)
+
+
+def mdid_name(packet):
+    cmds = MDID_CMD_SETS.get(packet.mdid_set)
+    if cmds is not None and packet.mdid_cmd in cmds._value2member_map_:
+        return cmds(packet.mdid_cmd).name
+    return None
+
+
+def packet_event(kind, packet, transmitted, repeats=None):
+    if packet.link_bit and (packet.mdid == ACTIVATELINK or packet.mdid == DEACTIVATELINK):
+        kind = 'link'
+    event = {
+        'type': kind,
+        'time': time.time(),
+        'transmitted': transmitted,
+        'network': packet.network_id,
+        'source': packet.source_id,
+        'destination': packet.destination_id,
+        'link': packet.link_bit,
+        'mdid': packet.mdid,
+        'name': mdid_name(packet),
+        'data': bytes(packet.data).hex(),
+    }
+    if repeats is not None:
+        event['repeats'] = repeats
+    return event
+
+
+class EventFilter:
+    """
+    Sets of accepted networks, devices, MDIDs and event types, None
+    accepting any.
+    """
+
+    __slots__ = ('networks', 'devices', 'mdids', 'types')
+
+    def __init__(self, networks=None, devices=None, mdids=None, types=None):
+        self.networks = frozenset(networks) if networks else None
+        self.devices = frozenset(devices) if devices else None
+        self.mdids = frozenset(mdids) if mdids else None
+        self.types = frozenset(types) if types else None
+
+    @classmethod
+    def from_json(cls, line):
+        spec = json.loads(line) if line.strip() else {}
+        return cls(spec.get('networks'), spec.get('devices'), spec.get('mdids'), spec.get('types'))
+
+    @classmethod
+    def from_query(cls, query):
+        spec = parse_qs(query)
+
+        def values(name, convert=lambda value: int(value, 0)):
+            return [convert(value) for item in spec.get(name, ()) for value in item.split(',') if value]
+        return cls(values('network'), values('device'), values('mdid'), values('type', str))
+
+    def match(self, event):
+        if self.types is not None and event['type'] not in self.types:
+            return False
+        if self.networks is not None and event.get('network') not in self.networks:
+            return False
+        if self.devices is not None and event.get('source') not in self.devices and \
+            event.get('destination') not in self.devices:
+            return False
+        if self.mdids is not None and event.get('mdid') not in self.mdids:
+            return False
+        return True
+
+
+class EventHub:
+    """
+    Collects events from a PIM and writes them to subscribers in batches.
+    """
+
+    def __init__(self, loop=None, batch_interval=EVENTS_BATCH_INTERVAL):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.batch_interval = batch_interval
+        self.subscribers = set()
+        self.pending = []
+        self.timer = None
+        self.published = 0
+        self.dropped = 0
+
+    def attach(self, pim):
+        pim.message_listeners.append(self.message)
+        pim.transmission_listeners.append(self.transmission)
+        pim.transmit_listeners.append(self.transmit)
+        pim.ack_listeners.append(self.ack)
+
+    def publish(self, event):
+        if not self.subscribers:
+            return
+        self.pending.append(event)
+        if self.timer is None:
+            self.timer = self.loop.call_later(self.batch_interval, self.flush)
+
+    def message(self, packet, copies):
+        self.publish(packet_event('message', packet, False, copies))
+
+    def transmit(self, packet):
+        self.publish(packet_event('transmit', packet, True))
+
+    def transmission(self, transmission):
+        # ACK/NAK are published by ack() once matched to their transmit
+        if transmission == UpbTransmission.UPB_MESSAGE or transmission in ACK_REPORTS:
+            return
+        self.publish({'type': 'pim_report', 'time': time.time(), 'report': UpbTransmission(transmission).name})
+
+    def ack(self, entry):
+        packet = entry.packet
+        report = UpbTransmission.UPB_TRANSMISSION_NAK if entry.nak else UpbTransmission.UPB_TRANSMISSION_ACK
+        self.publish({
+            'type': 'pim_report',
+            'time': time.time(),
+            'report': report.name,
+            'network': packet.network_id,
+            'source': packet.source_id,
+            'destination': packet.destination_id,
+            'mdid': packet.mdid,
+        })
+
+    def flush(self):
+        self.timer = None
+        events = self.pending
+        self.pending = []
+        for event in events:
+            copies = event.get('repeats')
+            if copies is not None:
+                event['repeats'] = copies.count
+        encoded = [(event, json.dumps(event, separators=(',', ':')).encode('utf-8')) for event in events]
+        self.published += len(encoded)
+        for subscriber in tuple(self.subscribers):
+            matched = [line for event, line in encoded if subscriber.filter.match(event)]
+            if matched:
+                if subscriber.transport.get_write_buffer_size() > EVENTS_WRITE_BUFFER_LIMIT:
+                    self.dropped += len(matched)
+                    subscriber.dropped += len(matched)
+                    continue
+                subscriber.send(matched)
+
+
+class EventSubscriber(asyncio.Protocol):
+    """
+    One subscriber connection, JSON lines or WebSocket depending on the
+    first line it sends.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.request = b''
+        self.filter = None
+        self.websocket = False
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, *args):
+        self.hub.subscribers.discard(self)
+        if self.dropped:
+            log.warning("subscriber missed %d events", self.dropped)
+
+    def data_received(self, data):
+        if self.filter is not None:
+            if self.websocket:
+                self.websocket_received(data)
+            return
+        self.request += data
+        if self.request.startswith(b'GET '):
+            if b'\r\n\r\n' in self.request:
+                self.websocket_handshake()
+        elif b'\n' in self.request:
+            line = self.request.split(b'\n', 1)[0]
+            try:
+                self.filter = EventFilter.from_json(line)
+            except (ValueError, AttributeError, TypeError):
+                self.transport.write(b'{"error":"bad filter"}\n')
+                self.transport.close()
+                return
+            self.hub.subscribers.add(self)
+        if self.filter is None and len(self.request) > EVENTS_MAX_REQUEST:
+            self.transport.close()
+
+    def websocket_handshake(self):
+        head = self.request.split(b'\r\n\r\n', 1)[0].decode('latin-1').split('\r\n')
+        path = head[0].split(' ')[1]
+        headers = {}
+        for line in head[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        key = headers.get('sec-websocket-key')
+        url = urlsplit(path)
+        if url.path != '/events' or key is None:
+            self.transport.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            self.transport.close()
+            return
+        try:
+            self.filter = EventFilter.from_query(url.query)
+        except ValueError:
+            self.transport.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+            self.transport.close()
+            return
+        accept = base64.b64encode(hashlib.sha1(key.encode('ascii') + WEBSOCKET_GUID).digest())
+        self.transport.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+            b'Connection: Upgrade\r\nSec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        self.websocket = True
+        self.request = b''
+        self.hub.subscribers.add(self)
+
+    def websocket_frame(self, opcode, payload):
+        size = len(payload)
+        if size < 126:
+            header = bytes((0x80 | opcode, size))
+        elif size < 65536:
+            header = bytes((0x80 | opcode, 126)) + size.to_bytes(2, 'big')
+        else:
+            header = bytes((0x80 | opcode, 127)) + size.to_bytes(8, 'big')
+        self.transport.write(header + payload)
+
+    def websocket_received(self, data):
+        """
+        Handles close and ping from the client, anything else is ignored.
+        """
+        self.request += data
+        while len(self.request) >= 2:
+            buf = self.request
+            opcode = buf[0] & 0x0f
+            size = buf[1] & 0x7f
+            offset = 2
+            if size == 126:
+                size = int.from_bytes(buf[2:4], 'big')
+                offset = 4
+            elif size == 127:
+                size = int.from_bytes(buf[2:10], 'big')
+                offset = 10
+            masked = buf[1] & 0x80
+            end = offset + (4 if masked else 0) + size
+            if len(buf) < end:
+                return
+            payload = buf[end - size:end]
+            if masked:
+                mask = buf[offset:offset + 4]
+                payload = bytes(value ^ mask[index & 3] for index, value in enumerate(payload))
+            self.request = buf[end:]
+            if opcode == 0x8:
+                self.websocket_frame(0x8, payload[:2])
+                self.transport.close()
+                return
+            if opcode == 0x9:
+                self.websocket_frame(0xa, payload)
+
+    def send(self, lines):
+        if self.websocket:
+            self.websocket_frame(0x1, b'[' + b','.join(lines) + b']')
+        else:
+            lines.append(b'')
+            self.transport.write(b'\n'.join(lines))
+
+
+async def start_events_server(hub, host, port):
+    loop = asyncio.get_event_loop()
+    server = await loop.create_server(lambda: EventSubscriber(hub), host, port)
+    log.info("serving events on %s:%d", host, port)
+    return server
@@ -0,0 +1,174 @@
+"""
+Resumable export of the register space of every device on a network
+
+    python export.py [--username U --password P] [--network 1] [--devices 1-250]
+        [--checkpoint export-registers.json] [--output export.json] HOST PORT
+
+Registers are read in the largest windows each device answers, with
+reads pipelined across devices like the survey. Every report lands in a
+register cache saved to the checkpoint file, a later run only reads what
+is still missing. The export lists each device found with its
+manufacturer, product, names and full register image.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from const import UpbReg, MANUFACTURERS, PRODUCTS
+from log import getLogger, setup_logging
+from registers import REGISTER_COUNT, GETREGISTERVALUES
+from survey import RequestPipeline, connect, device_range, SURVEY_INITIAL_WINDOW, SURVEY_MAX_WINDOW, \
+SURVEY_REPORT_TIMEOUT
+
+log = getLogger('export')
+
+EXPORT_CHECKPOINT_PATH = 'export-registers.json'
+EXPORT_PATH = 'export.json'
+# register values a report carries at most
+EXPORT_READ_WINDOW = 16
+EXPORT_HEADER_BYTES = UpbReg.UPB_REG_RESERVED1
+
+
+def register_text(values, start):
+    return bytes(values[start:start + 16]).decode('ascii', 'replace').rstrip(' \x00\xff')
+
+
+def describe_device(network_id, device_id, image):
+    """
+    The export entry of a device, decoded as far as its header registers
+    are known.
+    """
+    entry = {'network': network_id, 'device': device_id}
+    values = image.values
+    if image.missing(0, EXPORT_HEADER_BYTES) is None:
+        manufacturer = int.from_bytes(values[UpbReg.UPB_REG_MANUFACTURERID:UpbReg.UPB_REG_MANUFACTURERID + 2], 'big')
+        product = int.from_bytes(values[UpbReg.UPB_REG_PRODUCTID:UpbReg.UPB_REG_PRODUCTID + 2], 'big')
+        name, kind = PRODUCTS.get(f'{manufacturer}/{product}', (None, None))
+        entry.update({
+            'manufacturer': MANUFACTURERS.get(str(manufacturer), manufacturer),
+            'product': name if name is not None else product,
+            'kind': kind,
+            'firmware': f'{values[UpbReg.UPB_REG_FIRMWAREVERSION]}.{values[UpbReg.UPB_REG_FIRMWAREVERSION + 1]}',
+            'serial': bytes(values[UpbReg.UPB_REG_SERIALNUMBER:UpbReg.UPB_REG_SERIALNUMBER + 4]).hex(),
+            'network_name': register_text(values, UpbReg.UPB_REG_NETWORKNAME),
+            'room': register_text(values, UpbReg.UPB_REG_ROOMNAME),
+            'name': register_text(values, UpbReg.UPB_REG_DEVICENAME),
+        })
+    entry['complete'] = image.missing(0, REGISTER_COUNT) is None
+    entry['registers'] = values.hex()
+    return entry
+
+
+class DeviceExport:
+
+    __slots__ = ('device_id', 'present', 'window', 'naks', 'timeouts')
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.present = None
+        self.window = EXPORT_READ_WINDOW
+        self.naks = 0
+        self.timeouts = 0
+
+
+class RegisterExport(RequestPipeline):
+    """
+    Reads the registers of device_ids still missing from the PIM's register
+    cache, which doubles as the checkpoint.
+    """
+
+    def __init__(self, pim, network_id, device_ids=range(1, 251), **kwargs):
+        super().__init__(pim, network_id, **kwargs)
+        self.devices = [DeviceExport(device_id) for device_id in device_ids]
+        self.reads = 0
+
+    def missing(self, device_id):
+        image = self.pim.registers.images.get((self.network_id, device_id))
+        if image is None:
+            return 0, REGISTER_COUNT
+        return image.missing(0, REGISTER_COUNT)
+
+    async def export_device(self, device):
+        while True:
+            missing = self.missing(device.device_id)
+            if missing is None:
+                device.present = True
+                return
+            start = missing[0]
+            count = min(device.window, REGISTER_COUNT - start)
+            data = await self.request(device, GETREGISTERVALUES, bytes((start, count)))
+            self.reads += 1
+            if data is False:
+                if device.present is None:
+                    device.present = False
+                return
+            if data is None:
+                # left for the next run
+                return
+            device.present = True
+            received = len(data) - 1
+            if received < 1 or data[0] != start:
+                log.warning("device %d answered a read of %d at %#x with %d at %#x", device.device_id, count,
+                    start, received, data[0] if data else 0)
+                return
+            if received < count:
+                device.window = received
+
+    async def export(self):
+        await self.run(self.export_device, self.devices)
+        self.pim.registers.save()
+        images = self.pim.registers.images
+        return [describe_device(self.network_id, device.device_id, images[(self.network_id, device.device_id)])
+            for device in self.devices if (self.network_id, device.device_id) in images]
+
+
+def write_export(path, network_id, devices):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'network': network_id, 'exported': int(time.time()), 'devices': devices}, f,
+            separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Export UPB device registers')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--network', type=int, default=1)
+    parser.add_argument('--devices', type=device_range, default=range(1, 251))
+    parser.add_argument('--checkpoint', default=EXPORT_CHECKPOINT_PATH)
+    parser.add_argument('--output', default=EXPORT_PATH)
+    parser.add_argument('--window', type=float, default=SURVEY_INITIAL_WINDOW)
+    parser.add_argument('--max-window', type=float, default=SURVEY_MAX_WINDOW)
+    parser.add_argument('--timeout', type=float, default=SURVEY_REPORT_TIMEOUT)
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    args = parser.parse_args()
+
+    listener = setup_logging(os.environ.get('UPBSHARK_LOG_LEVEL', 'WARNING').upper())
+    connection = None
+    pim = None
+    try:
+        pim, connection = await connect(args.host, args.port, args.username, args.password, args.checkpoint)
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        job = RegisterExport(pim, args.network, args.devices, window=args.window, max_window=args.max_window,
+            timeout=args.timeout)
+        devices = await job.export()
+        write_export(args.output, args.network, devices)
+        print(f'exported {len(devices)} devices ({sum(1 for device in devices if device["complete"])} complete) '
+            f'with {job.reads} reads in {loop.time() - started:.1f}s', file=sys.stderr)
+    finally:
+        if pim is not None:
+            pim.registers.save()
+        if connection is not None:
+            connection.cancel()
+        listener.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,263 @@
+"""
+Client for the gateway file commands
+
+    python files.py [--username U --password P] HOST PORT ls
+    python files.py [--username U --password P] HOST PORT get NAME [PATH]
+    python files.py [--username U --password P] HOST PORT put PATH [NAME]
+    python files.py [--username U --password P] HOST PORT rm NAME
+
+Payloads, after the gateway frame header, as spoken here and by the
+simulator (names are NUL terminated, numbers big endian):
+
+    FILE_READ_OPEN    name                  -> -
+    FILE_READ_SIZE    -                     -> size(4)
+    FILE_READ         offset(4) length(2)   -> offset(4) data
+    FILE_READ_CLOSE   -                     -> -
+    FILE_WRITE_OPEN   name                  -> -
+    FILE_WRITE_SIZE   size(4)               -> -
+    FILE_WRITE        offset(4) data        -> offset(4)
+    FILE_WRITE_CLOSE  -                     -> -
+    FILE_READ_DELETE  name                  -> -
+    DIR_LISTING       -                     -> (name size(4))...
+
+A non-zero return code fails the command. The gateway answers commands
+in order; up to window reads or writes are kept outstanding. A transfer
+goes on one at a time when the gateway refuses a pipelined request that
+it then accepts on its own.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from collections import deque
+
+from const import GatewayCmd
+from framer import encode_gateway_request
+from log import getLogger, setup_logging
+from survey import connect
+
+log = getLogger('files')
+
+FILE_CHUNK_BYTES = 1024
+FILE_WINDOW = 4
+FILE_TIMEOUT = 10.0
+
+
+class GatewayFileError(OSError):
+    pass
+
+
+class GatewayFiles:
+    """
+    File commands over a PIM's wrapped gateway connection. They are written
+    straight to the connection, next to the serial traffic rather than
+    through the transmit scheduler. One transfer runs at a time.
+    """
+
+    def __init__(self, pim, chunk_size=FILE_CHUNK_BYTES, window=FILE_WINDOW, timeout=FILE_TIMEOUT):
+        self.pim = pim
+        self.chunk_size = chunk_size
+        self.window = window
+        self.timeout = timeout
+        self.loop = asyncio.get_event_loop()
+        self.outstanding = deque()
+        self.lock = asyncio.Lock()
+        pim.gateway_listeners.append(self.response)
+
+    def close(self):
+        self.pim.gateway_listeners.remove(self.response)
+        while self.outstanding:
+            cmd, future = self.outstanding.popleft()
+            if not future.done():
+                future.set_exception(GatewayFileError(f'{cmd.name}: closed'))
+
+    def response(self, cmd, rc, payload):
+        if not self.outstanding:
+            log.debug("unexpected %s response", cmd.name)
+            return
+        if self.outstanding[0][0] != cmd:
+            log.warning("%s response while waiting for %s", cmd.name, self.outstanding[0][0].name)
+            return
+        future = self.outstanding.popleft()[1]
+        if not future.done():
+            future.set_result((rc, bytes(payload)))
+
+    def send(self, cmd, payload=b''):
+        """
+        Writes a command and returns the future of its (rc, payload).
+        """
+        if not self.pim.ready.is_set() or not self.pim.wrapped:
+            raise GatewayFileError(f'{cmd.name}: gateway connection not wrapped')
+        future = self.loop.create_future()
+        self.outstanding.append((cmd, future))
+        self.pim.write(encode_gateway_request(cmd, payload))
+        return future
+
+    async def result(self, cmd, future):
+        try:
+            rc, payload = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            for entry in self.outstanding:
+                if entry[1] is future:
+                    self.outstanding.remove(entry)
+                    break
+            raise GatewayFileError(f'{cmd.name}: no response') from None
+        if rc != 0:
+            raise GatewayFileError(f'{cmd.name}: gateway returned {rc:#04x}')
+        return payload
+
+    async def command(self, cmd, payload=b''):
+        return await self.result(cmd, self.send(cmd, payload))
+
+    async def listdir(self):
+        async with self.lock:
+            listing = await self.command(GatewayCmd.DIR_LISTING)
+        entries = []
+        while listing:
+            name, _, rest = listing.partition(b'\x00')
+            entries.append((name.decode('latin-1'), int.from_bytes(rest[:4], 'big')))
+            listing = rest[4:]
+        return entries
+
+    async def delete(self, name):
+        async with self.lock:
+            await self.command(GatewayCmd.FILE_READ_DELETE, name.encode('latin-1') + b'\x00')
+
+    async def pipelined(self, cmd, requests):
+        """
+        Sends the (offset, payload) requests keeping up to window of them
+        outstanding and yields (offset, response payload) in order. A request
+        that fails while others were outstanding is sent again on its own
+        once they are answered, if it then succeeds the rest of the transfer
+        goes one at a time, otherwise its error is raised.
+        """
+        requests = iter(requests)
+        window = self.window
+        pending = deque()
+        resend = deque()
+        while True:
+            while len(pending) < window:
+                request = resend.popleft() if resend else next(requests, None)
+                if request is None:
+                    break
+                pending.append((request, self.send(cmd, request[1]), bool(pending)))
+            if not pending:
+                return
+            request, future, overlapped = pending.popleft()
+            try:
+                payload = await self.result(cmd, future)
+            except GatewayFileError:
+                if not overlapped:
+                    raise
+                # let the requests sent after the failed one finish, they are sent again after it
+                for later, future, _ in pending:
+                    try:
+                        await self.result(cmd, future)
+                    except GatewayFileError:
+                        pass
+                    resend.append(later)
+                pending.clear()
+                payload = await self.command(cmd, request[1])
+                log.info("gateway refused pipelined %s, sending one at a time", cmd.name)
+                window = 1
+            yield request[0], payload
+
+    async def read(self, name):
+        """
+        Yields the chunks of a gateway file in order.
+        """
+        async with self.lock:
+            await self.command(GatewayCmd.FILE_READ_OPEN, name.encode('latin-1') + b'\x00')
+            try:
+                size = int.from_bytes(await self.command(GatewayCmd.FILE_READ_SIZE), 'big')
+                requests = ((offset, offset.to_bytes(4, 'big') +
+                    min(self.chunk_size, size - offset).to_bytes(2, 'big'))
+                    for offset in range(0, size, self.chunk_size))
+                async for offset, payload in self.pipelined(GatewayCmd.FILE_READ, requests):
+                    if int.from_bytes(payload[:4], 'big') != offset:
+                        raise GatewayFileError(f'{name}: read at {offset} answered out of order')
+                    yield payload[4:]
+            finally:
+                await self.command(GatewayCmd.FILE_READ_CLOSE)
+
+    async def download(self, name, path):
+        """
+        Writes a gateway file to path as it arrives, returns its size.
+        """
+        size = 0
+        tmp = f'{path}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                async for chunk in self.read(name):
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        os.replace(tmp, path)
+        return size
+
+    async def upload(self, path, name):
+        """
+        Writes a local file to the gateway, returns its size.
+        """
+        size = os.path.getsize(path)
+        async with self.lock:
+            await self.command(GatewayCmd.FILE_WRITE_OPEN, name.encode('latin-1') + b'\x00')
+            try:
+                await self.command(GatewayCmd.FILE_WRITE_SIZE, size.to_bytes(4, 'big'))
+                with open(path, 'rb') as f:
+                    requests = ((offset, offset.to_bytes(4, 'big') + f.read(self.chunk_size))
+                        for offset in range(0, size, self.chunk_size))
+                    async for offset, payload in self.pipelined(GatewayCmd.FILE_WRITE, requests):
+                        if int.from_bytes(payload[:4], 'big') != offset:
+                            raise GatewayFileError(f'{name}: write at {offset} answered out of order')
+            finally:
+                await self.command(GatewayCmd.FILE_WRITE_CLOSE)
+        return size
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Gateway file transfer')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--chunk-size', type=int, default=FILE_CHUNK_BYTES)
+    parser.add_argument('--window', type=int, default=FILE_WINDOW)
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('command', choices=('ls', 'get', 'put', 'rm'))
+    parser.add_argument('name', nargs='?')
+    parser.add_argument('path', nargs='?')
+    args = parser.parse_args()
+    if args.command != 'ls' and args.name is None:
+        parser.error(f'{args.command} needs a NAME')
+
+    listener = setup_logging(os.environ.get('UPBSHARK_LOG_LEVEL', 'WARNING').upper())
+    connection = None
+    try:
+        pim, connection = await connect(args.host, args.port, args.username, args.password)
+        files = GatewayFiles(pim, args.chunk_size, args.window)
+        if args.command == 'ls':
+            for name, size in await files.listdir():
+                print(f'{size:10d} {name}')
+        elif args.command == 'get':
+            path = args.path or os.path.basename(args.name)
+            print(f'{args.name}: {await files.download(args.name, path)} bytes', file=sys.stderr)
+        elif args.command == 'put':
+            name = args.path or os.path.basename(args.name)
+            print(f'{name}: {await files.upload(args.name, name)} bytes', file=sys.stderr)
+        else:
+            await files.delete(args.name)
+        files.close()
+    except GatewayFileError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if connection is not None:
+            connection.cancel()
+        listener.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,88 @@
+"""
+Stream framing for the PIM and client connections
+"""
+
+from struct import pack
+
+from const import GatewayCmd
+from util import cksum
+
+
+class Framer:
+    """
+    Accumulates stream data in a preallocated ring and yields frames as
+    memoryviews into it. Yielded views are only valid until the next feed().
+    """
+
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def clear(self):
+        self.start = 0
+        self.end = 0
+
+    def feed(self, data):
+        size = len(data)
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        if self.end + size > len(self.buf):
+            pending = self.end - self.start
+            if pending + size > len(self.buf):
+                buf = bytearray(max(len(self.buf) * 2, pending + size))
+                buf[0:pending] = self.view[self.start:self.end]
+                self.buf = buf
+                self.view = memoryview(buf)
+            elif pending:
+                self.view[0:pending] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        self.view[self.end:self.end + size] = data
+        self.end += size
+
+    def lines(self, sep):
+        while self.start < self.end:
+            index = self.buf.find(sep, self.start, self.end)
+            if index < 0:
+                return
+            line = self.view[self.start:index]
+            self.start = index + 1
+            yield line
+
+    def gateway_frames(self, header_len, length_offset, trailer_len, cmd_offset=0):
+        buf = self.buf
+        while self.end - self.start >= header_len:
+            start = self.start
+            cmd = buf[start] - cmd_offset
+            if not GatewayCmd.has_value(cmd):
+                return
+            length = (buf[start + length_offset] << 8) | buf[start + length_offset + 1]
+            if self.end - start < header_len + length + trailer_len:
+                return
+            end = start + header_len + length + trailer_len
+            frame = self.view[start:end]
+            payload = self.view[start + header_len:start + header_len + length]
+            self.start = end
+            yield GatewayCmd(cmd), frame, payload
+
+
+def encode_gateway_response(cmd, payload):
+    """
+    Builds a gateway -> client frame as parsed by gateway_frames() with cmd_offset=1.
+    """
+    frame = pack('>BBxxxxH', cmd + 1, 0x00, len(payload)) + bytes(payload)
+    return frame + bytes((cksum(frame),))
+
+
+def encode_gateway_request(cmd, payload):
+    """
+    Builds a client -> gateway frame as parsed by gateway_frames() with cmd_offset=0.
+    """
+    frame = pack('>BH', cmd, len(payload)) + bytes(payload)
+    return frame + bytes((cksum(frame),))
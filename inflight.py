@@ -0,0 +1,187 @@
+"""
+Correlation of transmitted commands with PIM acknowledgements and device reports
+"""
+
+import asyncio
+from bisect import bisect_left
+from collections import deque
+
+from const import UpbTransmission, MdidSet, MdidCoreCmd, MdidDeviceControlCmd, MdidCoreReport
+from log import getLogger
+
+log = getLogger('inflight')
+
+INFLIGHT_TIMEOUT = 5.0
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0)
+
+
+def mdid(mdid_set, mdid_cmd):
+    return mdid_set | mdid_cmd
+
+
+# report MDID that answers each command MDID
+REPORTS = {
+    mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETSETUPTIME):
+        mdid(MdidSet.MDID_CORE_REPORTS, MdidCoreReport.MDID_DEVICE_CORE_REPORT_SETUPTIME),
+    mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETDEVICESTATUS):
+        mdid(MdidSet.MDID_CORE_REPORTS, MdidCoreReport.MDID_DEVICE_CORE_REPORT_DEVICESTATUS),
+    mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETSIGNALSTRENGTH):
+        mdid(MdidSet.MDID_CORE_REPORTS, MdidCoreReport.MDID_DEVICE_CORE_REPORT_SIGNALSTRENGTH),
+    mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETNOISELEVEL):
+        mdid(MdidSet.MDID_CORE_REPORTS, MdidCoreReport.MDID_DEVICE_CORE_REPORT_NOISELEVEL),
+    mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETDEVICESIGNATURE):
+        mdid(MdidSet.MDID_CORE_REPORTS, MdidCoreReport.MDID_DEVICE_CORE_REPORT_DEVICESIGNATURE),
+    mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETREGISTERVALUES):
+        mdid(MdidSet.MDID_CORE_REPORTS, MdidCoreReport.MDID_DEVICE_CORE_REPORT_REGISTERVALUES),
+    mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS, MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_REPORTSTATE):
+        mdid(MdidSet.MDID_CORE_REPORTS, MdidCoreReport.MDID_DEVICE_CORE_REPORT_DEVICESTATE),
+}
+COMMANDS = {report: command for command, report in REPORTS.items()}
+
+
+class LatencyStats:
+    """
+    Count, sum, min, max and a cumulative bucket histogram of latencies in seconds.
+    """
+
+    __slots__ = ('buckets', 'counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'min': self.min,
+            'max': self.max,
+            'buckets': dict(zip(self.buckets + (float('inf'),), self.counts)),
+        }
+
+
+class InflightEntry:
+
+    __slots__ = ('packet', 'owner', 'sent', 'acked', 'nak', 'report')
+
+    def __init__(self, packet, sent, owner=None):
+        self.packet = packet
+        self.owner = owner
+        self.sent = sent
+        self.acked = None
+        self.nak = False
+        self.report = REPORTS.get(packet.mdid)
+
+
+class InflightTable:
+    """
+    Outstanding network transmits keyed by (network, destination, MDID).
+    PIM ACK/NAK reports are matched in send order, device reports by the
+    reporting device and the MDID of the command that requests them.
+    """
+
+    def __init__(self, loop=None, timeout=INFLIGHT_TIMEOUT, ack_latency=None, report_latency=None, expired=None):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.timeout = timeout
+        # called with each entry that times out or is dropped after its ACK
+        self.expired = expired
+        self.entries = {}
+        self.unacked = deque()
+        self.timer = None
+        self.ack_latency = ack_latency if ack_latency is not None else LatencyStats()
+        self.report_latency = report_latency if report_latency is not None else LatencyStats()
+        self.naks = 0
+        self.timeouts = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.expired is not None:
+            # unacknowledged transmits are sent again, acknowledged ones only wait for a report
+            for entry in list(self.entries.values()):
+                if entry.acked is not None:
+                    self.expired(entry)
+        self.entries.clear()
+        self.unacked.clear()
+
+    def sent(self, packet, owner=None):
+        key = (packet.network_id, packet.destination_id, packet.mdid)
+        entry = InflightEntry(packet, self.loop.time(), owner)
+        self.entries[key] = entry
+        self.unacked.append(entry)
+        if self.timer is None:
+            self.timer = self.loop.call_later(self.timeout, self.expire)
+        return entry
+
+    def transmission(self, transmission):
+        if transmission != UpbTransmission.UPB_TRANSMISSION_ACK and \
+            transmission != UpbTransmission.UPB_TRANSMISSION_NAK:
+            return None
+        while self.unacked:
+            entry = self.unacked.popleft()
+            if entry.acked is None:
+                break
+        else:
+            return None
+        now = self.loop.time()
+        entry.acked = now
+        self.ack_latency.observe(now - entry.sent)
+        if transmission == UpbTransmission.UPB_TRANSMISSION_NAK:
+            entry.nak = True
+            self.naks += 1
+        if entry.nak or entry.report is None:
+            self.remove(entry)
+        return entry
+
+    def reported(self, packet):
+        command = COMMANDS.get(packet.mdid)
+        if command is None:
+            return None
+        entry = self.entries.get((packet.network_id, packet.source_id, command))
+        if entry is None:
+            return None
+        self.report_latency.observe(self.loop.time() - entry.sent)
+        self.remove(entry)
+        return entry
+
+    def remove(self, entry):
+        packet = entry.packet
+        key = (packet.network_id, packet.destination_id, packet.mdid)
+        if self.entries.get(key) is entry:
+            del self.entries[key]
+
+    def expire(self):
+        self.timer = None
+        deadline = self.loop.time() - self.timeout
+        for key, entry in list(self.entries.items()):
+            if entry.sent <= deadline:
+                del self.entries[key]
+                self.timeouts += 1
+                log.debug("transmit timed out: %r", entry.packet)
+                if self.expired is not None:
+                    self.expired(entry)
+        while self.unacked and (self.unacked[0].sent <= deadline or self.unacked[0].acked is not None):
+            self.unacked.popleft()
+        if self.entries:
+            self.timer = self.loop.call_later(self.timeout, self.expire)
@@ -0,0 +1,122 @@
+"""
+Index from link ID to the devices that respond to the link
+"""
+
+from const import MdidSet, MdidCoreCmd
+from inflight import mdid
+from log import getLogger
+
+log = getLogger('links')
+
+# receive component table of standard UPB devices: link ID, preset level, fade rate
+LINK_TABLE_START = 0x40
+LINK_TABLE_ENTRIES = 16
+LINK_ENTRY_BYTES = 3
+LINK_TABLE_BYTES = LINK_TABLE_ENTRIES * LINK_ENTRY_BYTES
+UNUSED_LINK = 0xff
+LAST_LEVEL = 0xff
+
+ADDLINK = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_ADDLINK)
+DELETELINK = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_DELETELINK)
+
+
+class LinkTarget:
+    """
+    A device responding to a link, level is the preset it goes to on
+    activation or LAST_LEVEL when it restores its last level.
+    """
+
+    __slots__ = ('device_id', 'channel', 'level')
+
+    def __init__(self, device_id, channel, level):
+        self.device_id = device_id
+        self.channel = channel
+        self.level = level
+
+    def __repr__(self):
+        return f'LinkTarget({self.device_id}, {self.channel}, {self.level})'
+
+
+def link_table(values):
+    """
+    Returns (link ID, level) for each used entry of a receive component
+    table.
+    """
+    entries = []
+    for offset in range(0, LINK_TABLE_BYTES, LINK_ENTRY_BYTES):
+        link_id = values[offset]
+        if link_id != UNUSED_LINK and link_id != 0:
+            entries.append((link_id, values[offset + 1]))
+    return entries
+
+
+class LinkIndex:
+    """
+    Targets per (network, link), kept alongside the link IDs each device is
+    indexed under so a device can be reindexed when its table changes.
+    """
+
+    def __init__(self):
+        self.links = {}
+        self.devices = {}
+
+    def __len__(self):
+        return len(self.links)
+
+    def targets(self, network_id, link_id):
+        return self.links.get((network_id, link_id), ())
+
+    def remove_device(self, network_id, device_id):
+        for link_id in self.devices.pop((network_id, device_id), ()):
+            self.delete(network_id, device_id, link_id)
+
+    def add(self, network_id, device_id, link_id, level, channel=0):
+        targets = self.links.setdefault((network_id, link_id), [])
+        for target in targets:
+            if target.device_id == device_id and target.channel == channel:
+                target.level = level
+                break
+        else:
+            targets.append(LinkTarget(device_id, channel, level))
+        linked = self.devices.setdefault((network_id, device_id), set())
+        linked.add(link_id)
+
+    def delete(self, network_id, device_id, link_id):
+        key = (network_id, link_id)
+        targets = self.links.get(key)
+        if targets is not None:
+            targets[:] = [target for target in targets if target.device_id != device_id]
+            if not targets:
+                del self.links[key]
+        linked = self.devices.get((network_id, device_id))
+        if linked is not None:
+            linked.discard(link_id)
+
+    def index_image(self, network_id, device_id, image):
+        """
+        Reindexes a device from its register image, returns False while its
+        link table is not fully known.
+        """
+        if image.missing(LINK_TABLE_START, LINK_TABLE_BYTES) is not None:
+            return False
+        self.remove_device(network_id, device_id)
+        for link_id, level in link_table(image.read(LINK_TABLE_START, LINK_TABLE_BYTES)):
+            self.add(network_id, device_id, link_id, level)
+        return True
+
+    def build(self, images):
+        for (network_id, device_id), image in images.items():
+            self.index_image(network_id, device_id, image)
+        log.debug("indexed %d links", len(self.links))
+
+    def command(self, packet):
+        """
+        Follows ADDLINK and DELETELINK sent to a device.
+        """
+        if packet.link_bit:
+            return
+        data = packet.data
+        if packet.mdid == ADDLINK and len(data) >= 2:
+            self.add(packet.network_id, packet.destination_id, data[0], data[1])
+        elif packet.mdid == DELETELINK and len(data) >= 1:
+            self.delete(packet.network_id, packet.destination_id, data[0])
@@ -0,0 +1,77 @@
+"""
+Logging with formatting and output on a background thread
+"""
+
+import logging
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue, Full
+
+LOG_ROOT = 'upbshark'
+LOG_QUEUE_SIZE = 10000
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+def getLogger(component):
+    return logging.getLogger(f'{LOG_ROOT}.{component}')
+
+
+class lazy:
+    """
+    Defers an expensive log argument such as a hexdump until the record is
+    actually emitted.
+    """
+
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Renders the message in the calling thread, so arguments that point into
+    reused buffers are safe, and drops records when the queue is full rather
+    than blocking the event loop.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def setup_logging(level=logging.INFO, stream=None, queue_size=LOG_QUEUE_SIZE):
+    """
+    Routes the upbshark loggers through a bounded queue to a writer thread.
+    Returns the started QueueListener, stop() it to flush on shutdown.
+    """
+    output = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    queue = Queue(queue_size)
+    root = logging.getLogger(LOG_ROOT)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DroppingQueueHandler(queue))
+    root.setLevel(level)
+    root.propagate = False
+    listener = QueueListener(queue, output)
+    listener.start()
+    return listener
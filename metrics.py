@@ -0,0 +1,153 @@
+"""
+Counters, gauges and histograms served in the Prometheus text format
+"""
+
+import asyncio
+from itertools import accumulate
+
+from inflight import LatencyStats, LATENCY_BUCKETS
+from log import getLogger
+
+log = getLogger('metrics')
+
+METRICS_MAX_REQUEST = 8192
+
+
+class Counter:
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+def format_labels(labels, extra=None):
+    items = list(labels)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in items) + '}'
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """
+    Metric families by name, each holding one metric per label set. A
+    metric is a Counter, Gauge or LatencyStats updated by its owner, or a
+    callable returning the current value (or LatencyStats) at scrape time.
+    """
+
+    def __init__(self):
+        self.families = {}
+
+    def register(self, kind, name, help, metric, labels):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = (kind, help, {})
+        elif family[0] != kind:
+            raise ValueError(f'metric {name} already registered as a {family[0]}')
+        family[2][tuple(sorted(labels.items()))] = metric
+        return metric
+
+    def counter(self, name, help, func=None, **labels):
+        return self.register('counter', name, help, func if func is not None else Counter(), labels)
+
+    def gauge(self, name, help, func=None, **labels):
+        return self.register('gauge', name, help, func if func is not None else Gauge(), labels)
+
+    def histogram(self, name, help, func=None, buckets=LATENCY_BUCKETS, **labels):
+        return self.register('histogram', name, help, func if func is not None else LatencyStats(buckets), labels)
+
+    def render(self):
+        out = []
+        for name, (kind, help, metrics) in sorted(self.families.items()):
+            out.append(f'# HELP {name} {help}')
+            out.append(f'# TYPE {name} {kind}')
+            for labels, metric in metrics.items():
+                value = metric() if callable(metric) else metric
+                if kind == 'histogram':
+                    for bound, count in zip(value.buckets + (float('inf'),), accumulate(value.counts)):
+                        out.append(f'{name}_bucket{format_labels(labels, ("le", format_value(bound)))} {count}')
+                    out.append(f'{name}_sum{format_labels(labels)} {format_value(value.total)}')
+                    out.append(f'{name}_count{format_labels(labels)} {value.count}')
+                else:
+                    if not isinstance(value, (int, float)):
+                        value = value.value
+                    out.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        out.append('')
+        return '\n'.join(out)
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer(asyncio.Protocol):
+    """
+    Minimal HTTP/1.0 responder for GET /metrics, one request per connection.
+    """
+
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+        self.request = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.request += data
+        if b'\r\n\r\n' not in self.request and b'\n\n' not in self.request:
+            if len(self.request) > METRICS_MAX_REQUEST:
+                self.transport.close()
+            return
+        try:
+            method, path = self.request.split(b' ', 2)[:2]
+        except ValueError:
+            self.respond(b'400 Bad Request', b'bad request\n')
+            return
+        if method != b'GET':
+            self.respond(b'405 Method Not Allowed', b'method not allowed\n')
+        elif path.split(b'?', 1)[0] != b'/metrics':
+            self.respond(b'404 Not Found', b'not found\n')
+        else:
+            self.respond(b'200 OK', self.registry.render().encode('utf-8'),
+                b'text/plain; version=0.0.4; charset=utf-8')
+
+    def respond(self, status, body, content_type=b'text/plain'):
+        self.transport.write(b'HTTP/1.0 ' + status + b'\r\nContent-Type: ' + content_type +
+            b'\r\nContent-Length: ' + str(len(body)).encode('ascii') + b'\r\nConnection: close\r\n\r\n' + body)
+        self.transport.close()
+
+
+async def start_metrics_server(host, port, registry=REGISTRY):
+    loop = asyncio.get_event_loop()
+    server = await loop.create_server(lambda: MetricsServer(registry), host, port)
+    log.info("serving metrics on %s:%d", host, port)
+    return server
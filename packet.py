@@ -0,0 +1,160 @@
+"""
+Lazily decoded UPB packets
+"""
+
+from functools import lru_cache
+from pprint import pformat
+
+from const import UpbReqAck, UpbReqRepeater, MdidSet, MdidCoreCmd, MdidDeviceControlCmd, MdidCoreReport, \
+PACKETHEADER_LINKBIT
+from util import cksum
+
+MDID_CMD_SETS = {
+    MdidSet.MDID_CORE_COMMANDS: MdidCoreCmd,
+    MdidSet.MDID_DEVICE_CONTROL_COMMANDS: MdidDeviceControlCmd,
+    MdidSet.MDID_CORE_REPORTS: MdidCoreReport,
+}
+
+PACKET_CACHE_SIZE = 1024
+
+
+def to_enum(cls, value):
+    if value in cls._value2member_map_:
+        return cls(value)
+    return value
+
+
+class UpbPacket:
+    """
+    A UPB packet including its checksum. Fields are decoded from the raw
+    bytes on access, the raw bytes must not change after construction.
+    """
+
+    __slots__ = ('raw', '_mdid_set', '_mdid_cmd')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._mdid_set = None
+        self._mdid_cmd = None
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def link_bit(self):
+        return (self.raw[0] & PACKETHEADER_LINKBIT) != 0
+
+    @property
+    def repeater_request(self):
+        return UpbReqRepeater((self.raw[0] >> 5) & 0x03)
+
+    @property
+    def length(self):
+        return self.raw[0] & 0x1f
+
+    @property
+    def reserved(self):
+        return self.raw[1] >> 7
+
+    @property
+    def ack_request(self):
+        return to_enum(UpbReqAck, (self.raw[1] >> 4) & 0x07)
+
+    @property
+    def transmit_cnt(self):
+        return (self.raw[1] >> 2) & 0x03
+
+    @property
+    def transmit_seq(self):
+        return self.raw[1] & 0x03
+
+    @property
+    def network_id(self):
+        return self.raw[2]
+
+    @property
+    def destination_id(self):
+        return self.raw[3]
+
+    @property
+    def source_id(self):
+        return self.raw[4]
+
+    @property
+    def mdid(self):
+        return self.raw[5]
+
+    @property
+    def mdid_set(self):
+        if self._mdid_set is None:
+            self._mdid_set = MdidSet(self.raw[5] & 0xe0)
+        return self._mdid_set
+
+    @property
+    def mdid_cmd(self):
+        if self._mdid_cmd is None:
+            cmd_set = MDID_CMD_SETS.get(self.mdid_set)
+            if cmd_set is None:
+                self._mdid_cmd = self.raw[5] & 0x1f
+            else:
+                self._mdid_cmd = to_enum(cmd_set, self.raw[5] & 0x1f)
+        return self._mdid_cmd
+
+    @property
+    def data(self):
+        return self.raw[6:self.length - 1]
+
+    @property
+    def crc(self):
+        return self.raw[self.length - 1]
+
+    @property
+    def valid(self):
+        if not self.raw:
+            return False
+        length = self.length
+        return 7 <= length <= len(self.raw) and cksum(self.raw[0:length - 1]) == self.raw[length - 1]
+
+    def as_dict(self):
+        return {
+            'link_bit': self.link_bit,
+            'repeater_request': self.repeater_request,
+            'ack_request': self.ack_request,
+            'transmit_cnt': self.transmit_cnt,
+            'transmit_seq': self.transmit_seq,
+            'network_id': self.network_id,
+            'destination_id': self.destination_id,
+            'source_id': self.source_id,
+            'mdid_set': self.mdid_set,
+            'mdid_cmd': self.mdid_cmd,
+            'data': self.data
+        }
+
+    def __str__(self):
+        return pformat(self.as_dict())
+
+    def __repr__(self):
+        return f'UpbPacket({self.raw.hex()})'
+
+
+@lru_cache(maxsize=PACKET_CACHE_SIZE)
+def decode_packet(raw):
+    return UpbPacket(bytes(raw))
+
+
+def encode_packet(network_id, destination_id, source_id, mdid, data=b'', control=0):
+    """
+    Builds raw packet bytes with length and checksum, control holds the
+    control word bits other than the length.
+    """
+    length = 7 + len(data)
+    packet = bytearray(length)
+    packet[0] = ((control >> 8) & 0xe0) | length
+    packet[1] = control & 0xff
+    packet[2] = network_id
+    packet[3] = destination_id
+    packet[4] = source_id
+    packet[5] = mdid
+    packet[6:length - 1] = data
+    packet[length - 1] = cksum(packet[0:length - 1])
+    return bytes(packet)
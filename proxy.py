@@ -1,434 +1,969 @@
 import asyncio
+import os
+import random
 import sys
 import hmac
-from pprint import pprint, pformat
-from binascii import unhexlify
-from struct import unpack
+from collections import deque
+from pprint import pformat
+from binascii import hexlify, unhexlify
 
-from const import PimCommand, UpbMessage, UpbDeviceId, UpbTransmission, UpbReqAck, UpbReqRepeater, \
-MdidSet, MdidCoreCmd, MdidDeviceControlCmd, MdidCoreReport, GatewayCmd, \
-UPB_MESSAGE_TYPE, UPB_MESSAGE_PIMREPORT_TYPE, INITIAL_PIM_REG_QUERY_BASE, PACKETHEADER_LINKBIT, PULSE_REPORT_BYTES
+from const import PimCommand, UpbMessage, UpbDeviceId, UpbTransmission, \
+MdidCoreCmd, MdidCoreReport, GatewayCmd, \
+UPB_MESSAGE_TYPE, UPB_MESSAGE_PIMREPORT_TYPE, INITIAL_PIM_REG_QUERY_BASE, \
+GATEWAY_REQUEST_HEADER_BYTES, GATEWAY_REQUEST_LENGTH_OFFSET, GATEWAY_RESPONSE_HEADER_BYTES, \
+GATEWAY_RESPONSE_LENGTH_OFFSET, GATEWAY_TRAILER_BYTES
+from capture import CaptureWriter, CaptureDirection, CAPTURE_MAX_BYTES
+from framer import Framer, encode_gateway_request, encode_gateway_response
+from packet import decode_packet
+from encoder import CommandEncoder
+from dedupe import MessageDeduper, DEDUPE_WINDOW
+from events import EventHub, start_events_server
+from pulse import PulseDecoder, PulseEvent
+from inflight import InflightTable, LatencyStats
+from scheduler import TransmitScheduler, transmit_priority, coalesce_key, TRANSMIT_BUSY_RETRIES
+from state import DeviceStateCache, DEVICE_STATE_TTL
+from registers import RegisterCache, REGISTER_CACHE_PATH, REGISTER_SAVE_DELAY, GETREGISTERVALUES
+from schedule import ScheduleEngine, load_schedule
 from util import cksum, hexdump
+from log import getLogger, lazy, setup_logging
+from metrics import REGISTRY, Counter, start_metrics_server
+
+log_pim = getLogger('pim')
+log_upstart = getLogger('upstart')
+
+SESSION_WRITE_BUFFER_HIGH = 64 * 1024
+SESSION_QUEUE_LIMIT = 1024 * 1024
+PIM_RECONNECT_MIN_DELAY = 0.5
+PIM_RECONNECT_MAX_DELAY = 10.0
+# a wrapped PIM link silent this long is sent a keep-alive, and dropped after PIM_TIMEOUT
+PIM_KEEPALIVE_INTERVAL = 30.0
+PIM_TIMEOUT = 75.0
+# sessions that send keep-alives are dropped when silent this long
+SESSION_TIMEOUT = 90.0
+# sessions sending nothing but keep-alives are closed after this long, 0 keeps them. Off by
+# default as clients that only follow the network traffic are idle for as long as they run
+SESSION_IDLE_TIMEOUT = 0.0
+WATCHDOG_INTERVAL = 5.0
+
+KEEP_ALIVE_REQUEST = encode_gateway_request(GatewayCmd.KEEP_ALIVE, b'')
+KEEP_ALIVE_RESPONSE = encode_gateway_response(GatewayCmd.KEEP_ALIVE, b'')
+
+
+def auth_digest(password, challenge):
+    return hmac.new(password.encode('utf-8'), challenge, 'md5').hexdigest().swapcase().encode('ascii')
 
 class PIM(asyncio.Protocol):
 
-    def __init__(self):
-        self.server_transport = None
-        self.buffer = b''
-        self.last_command = {}
-        self.message_buffer = b''
+    def __init__(self, state_ttl=DEVICE_STATE_TTL, register_path=REGISTER_CACHE_PATH, capture=None,
+                 username=None, password=None, dedupe_window=DEDUPE_WINDOW,
+                 keepalive_interval=PIM_KEEPALIVE_INTERVAL, pim_timeout=PIM_TIMEOUT,
+                 session_timeout=SESSION_TIMEOUT, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.loop = asyncio.get_event_loop()
+        self.sessions = set()
+        self.deduper = MessageDeduper(dedupe_window) if dedupe_window else None
+        # called with (packet, MessageCopies) for the first copy of each message
+        self.message_listeners = []
+        # called with each UpbTransmission the PIM reports
+        self.transmission_listeners = []
+        # called with the packet of each network transmit as it is written
+        self.transmit_listeners = []
+        # called with the InflightEntry each PIM ACK/NAK is matched to
+        self.ack_listeners = []
+        # called with (cmd, rc, payload) for each gateway response other than SEND_TO_SERIAL,
+        # payload is only valid during the call
+        self.gateway_listeners = []
+        self.username = username
+        self.password = password
+        self.capture = capture
+        self.registers = RegisterCache(register_path)
+        self.state = DeviceStateCache(state_ttl, self.registers.links)
+        self.registers_timer = None
+        self.framer = Framer()
+        self.decoder = PulseDecoder()
         self.pim_accept = False
-        self.transmitted = False
-        self.upb_packet = bytearray(64)
-        self.pulse_data_seq = 0
-        self.packet_byte = 0
-        self.packet_crumb = 0
-        self.data_counter = 0
+        # set while the PIM reports network traffic as pulse mode lines instead of PU messages
+        self.pulse_mode = False
         self.protocol = None
         self.initial = True
         self.challenge = None
         self.authenticated = False
         self.wrapped = False
         self.pim_info = {}
+        self.banner = None
+        self.auth_result = None
+        self.hello = None
+        self.reconnecting = False
+        self.connected = False
+        self.transport = None
+        self.up = asyncio.Event()
+        # set while the handshake is done and commands can be originated
+        self.ready = asyncio.Event()
+        self.lost = None
+        self.keepalive_interval = keepalive_interval
+        self.pim_timeout = pim_timeout
+        self.session_timeout = session_timeout
+        self.idle_timeout = idle_timeout
+        self.last_received = 0.0
+        self.last_keepalive = 0.0
+        # keep-alives sent to the PIM whose response is still to be dropped
+        self.keepalive_probes = 0
+        self.watchdog_timer = None
+        # counters registered with the gateway's labels by register_metrics()
+        self.metric_pim_frames = Counter()
+        self.metric_client_frames = Counter()
+        self.metric_pim_reports = {transmission: Counter() for transmission in UpbTransmission}
+        self.metric_pulse_drops = Counter()
+        self.metric_pulse_sequence_errors = Counter()
+        self.metric_message_repeats = Counter()
+        self.metric_checksum_failures = Counter()
+        self.metric_bad_lines = Counter()
+        self.metric_keepalives_answered = Counter()
+        self.metric_pim_keepalives = Counter()
+        self.metric_pim_timeouts = Counter()
+        self.metric_sessions_expired = {reason: Counter() for reason in ('dead', 'idle')}
+        self.ack_latency = LatencyStats()
+        self.report_latency = LatencyStats()
+        self.inflight = InflightTable(ack_latency=self.ack_latency, report_latency=self.report_latency,
+            expired=self.read_failed)
+        self.scheduler = TransmitScheduler(self.write, sent=self.sent, dropped=self.dropped)
+        self.encoder = CommandEncoder(wrapped=False)
 
     def connection_made(self, transport):
-        print("connected to PIM")
-        self.initial = True
+        log_pim.info("connected to PIM")
+        self.framer.clear()
+        self.decoder.reset()
+        self.pulse_mode = False
+        self.connected = True
+        self.transport = transport
+        self.keepalive_probes = 0
+        self.last_received = self.loop.time()
+        self.lost = self.loop.create_future()
+        self.up.set()
         self.challenge = None
-        self.authenticated = False
         self.wrapped = False
+        if self.hello is not None:
+            # sessions are kept across a reconnect, redo their handshake with the cached hello and credentials
+            log_pim.info("redoing PIM handshake")
+            self.reconnecting = True
+            self.write(self.hello + b'\x00')
+            return
+        self.initial = True
+        self.authenticated = False
         self.pim_info = {}
-        self.connected = True
-        self.transport = transport
+        self.banner = None
+        self.auth_result = None
+        self.encoder.wrapped = False
+        self.scheduler.resume()
 
-    def set_state_zero(self):
-        self.transmitted = False
-        self.pulse_data_seq = 0
-        self.packet_crumb = 0
-        self.packet_byte = 0
+    def write(self, data):
+        if self.capture is not None:
+            self.capture.write(CaptureDirection.TO_PIM, data)
+        self.transport.write(data)
 
-    def process_packet(self, packet):
-        control_word = packet[0:2]
-        data_len = (control_word[0] & 0x1f) - 6
-        transmit_cnt = control_word[1] & 0x0c >> 2
-        transmit_seq = control_word[1] & 0x03
-        network_id = packet[2]
-        destination_id = packet[3]
-        source_id = packet[4]
-        mdid_set = MdidSet(packet[5] & 0xe0)
-        if mdid_set == MdidSet.MDID_CORE_COMMANDS:
-            mdid_cmd = MdidCoreCmd(packet[5] & 0x1f)
-        elif mdid_set == MdidSet.MDID_DEVICE_CONTROL_COMMANDS:
-            mdid_cmd = MdidDeviceControlCmd(packet[5] & 0x1f)
-        elif mdid_set == MdidSet.MDID_CORE_REPORTS:
-            mdid_cmd = MdidCoreReport(packet[5] & 0x1f)
-        crc = packet[data_len + 5]
-        computed_crc = cksum(packet[0:data_len + 5])
-        assert(crc == computed_crc)
-        response = {
-            'transmit_cnt': transmit_cnt,
-            'transmit_seq': transmit_seq,
-            'network_id': network_id,
-            'destination_id': destination_id,
-            'device_id': source_id,
-            'mdid_set': mdid_set,
-            'mdid_cmd': mdid_cmd
-        }
-        if mdid_cmd == MdidCoreReport.MDID_DEVICE_CORE_REPORT_REGISTERVALUES:
-            response['setup_register'] = packet[6]
-            response['register_val'] = packet[7:data_len + 5]
-            for index in range(len(response['register_val'])):
-                print(f"Reg index: {index}, value: {hex(response['register_val'][index])}")
+    def sent(self, packet, owner):
+        self.inflight.sent(packet, owner)
+        for listener in self.transmit_listeners:
+            listener(packet)
+
+    def dropped(self, packet, owner):
+        if owner is None:
+            self.read_failed(None, packet)
+
+    def read_failed(self, entry, packet=None):
+        """
+        Answers the sessions waiting on a narrowed register read that was
+        NAKed, never reported or dropped with the PIM reports they would
+        have seen for their own read.
+        """
+        if entry is not None:
+            if entry.owner is not None:
+                return
+            packet = entry.packet
+        if packet.mdid != GETREGISTERVALUES:
+            return
+        if entry is None:
+            transmissions = (UpbTransmission.UPB_PIM_BUSY,)
+        elif entry.nak:
+            transmissions = (UpbTransmission.UPB_PIM_ACCEPT, UpbTransmission.UPB_TRANSMISSION_NAK)
+        elif entry.acked is not None:
+            transmissions = (UpbTransmission.UPB_PIM_ACCEPT, UpbTransmission.UPB_TRANSMISSION_ACK)
         else:
-            response['data'] = packet[6:data_len + 5]
-        pprint(response)
+            transmissions = ()
+        for session, request in self.registers.fail(packet):
+            log_pim.debug("narrowed register read failed for %r", request)
+            if session in self.sessions:
+                session.send_reports(*transmissions)
+
+    def originate(self, frame, priority=None):
+        """
+        Queues a command the proxy sends itself, frame being the last one
+        built by self.encoder, e.g. pim.originate(pim.encoder.report_state(1, 5)).
+        The PIM reports answering it are not relayed to the sessions.
+        """
+        encoder = self.encoder
+        command = PimCommand(frame[GATEWAY_REQUEST_HEADER_BYTES if encoder.wrapped else 0])
+        packet = None
+        if command == PimCommand.UPB_NETWORK_TRANSMIT:
+            packet = decode_packet(bytes(encoder.packet))
+            self.registers.command(packet)
+        if priority is None:
+            priority = transmit_priority(command, packet)
+        self.scheduler.submit(bytes(frame), priority, coalesce_key(command, packet),
+            needs_ack=command == PimCommand.UPB_NETWORK_TRANSMIT, packet=packet)
+
+    def start_watchdog(self):
+        self.watchdog_timer = self.loop.call_later(WATCHDOG_INTERVAL, self.watchdog)
+
+    def stop_watchdog(self):
+        if self.watchdog_timer is not None:
+            self.watchdog_timer.cancel()
+            self.watchdog_timer = None
+
+    def watchdog(self):
+        """
+        Keeps the one keep-alive cadence toward the PIM, drops a silent PIM
+        link so maintain_pim reconnects, and expires client sessions.
+        """
+        now = self.loop.time()
+        if self.connected and self.wrapped and not self.reconnecting:
+            silent = now - self.last_received
+            if self.pim_timeout and silent > self.pim_timeout:
+                log_pim.warning("nothing from PIM for %.0fs, dropping the connection", silent)
+                self.metric_pim_timeouts.inc()
+                self.transport.abort()
+            elif self.keepalive_interval and silent >= self.keepalive_interval and \
+                    now - self.last_keepalive >= self.keepalive_interval:
+                # only a silent link is probed, traffic shows it is alive
+                self.last_keepalive = now
+                self.keepalive_probes += 1
+                self.metric_pim_keepalives.inc()
+                self.write(KEEP_ALIVE_REQUEST)
+        for session in tuple(self.sessions):
+            session.expire(now)
+        self.watchdog_timer = self.loop.call_later(WATCHDOG_INTERVAL, self.watchdog)
+
+    def reconnected(self):
+        log_pim.info("PIM handshake redone, resuming transmits")
+        self.reconnecting = False
+        self.encoder.wrapped = self.wrapped
+        self.ready.set()
+        self.scheduler.resume()
+
+    def process_packet(self, packet):
+        packet = decode_packet(packet)
+        if not packet.valid:
+            return None
+        if packet.mdid_cmd == MdidCoreReport.MDID_DEVICE_CORE_REPORT_REGISTERVALUES:
+            data = packet.data
+            log_pim.debug("Setup register: %#x, registers: %s", data[0], lazy(hexdump, data[1:]))
+        log_pim.debug("packet:\n%s", packet)
+        return packet
+
+    def bad_line(self, line):
+        self.metric_bad_lines.inc()
+        log_pim.warning('got corrupt pim line: %s', lazy(bytes, line))
+
+    def save_registers(self):
+        self.registers_timer = None
+        self.registers.save()
 
     def nt_line_received(self, line):
-        print(f'pim null terminated line: {line}, hex: {hexdump(line)}')
+        log_pim.debug('pim null terminated line: %s, hex: %s', line, lazy(hexdump, line))
         errors = {
             'MAX CONNECTIONS REACHED',
             'PULSE MODE ACTIVE',
             'PIM NOT INITIALIZED',
             'FIRMWARE CORRUPT - FLASH WITH UPSTART'
         }
-        if self.initial and self.authenticated:
+        if self.reconnecting:
+            self.reconnect_line_received(line)
+        elif self.initial and self.authenticated:
             result, client = line.split(b'/', maxsplit=1)
             if result == b'AUTHENTICATION FAILED':
-                print("auth failed")
+                log_pim.error("auth failed")
             elif result == b'AUTH SUCCEEDED':
-                print("auth succeded")
+                log_pim.info("auth succeded")
+                self.auth_result = line
+                self.encoder.wrapped = True
                 self.initial = False
                 self.wrapped = True
+                self.ready.set()
             else:
-                print(f"unexpected auth result: {result}")
+                log_pim.warning("unexpected auth result: %s", result)
         elif self.initial:
             if line in errors or len(line) < 12:
-                print(f"unhandled error: {line}")
+                log_pim.error("unhandled error: %s", line)
                 return
-            prefix, version, protocol, auth, suffix = line.split(b'/', maxsplit=4)
-            majorVersion, minorVersion = version.split(b'.', maxsplit=1)
-            assert(self.protocol == protocol)
-            self.pim_info = {
-                'prefix': prefix,
-                'version': version,
-                'protocol': protocol,
-                'auth': auth,
-                'majorVersion': majorVersion,
-                'minorVersion': minorVersion
-            }
-            self.challenge = unhexlify(suffix)
-            print(f'self.pim_info:\n{pformat(self.pim_info)}')
+            self.banner_received(line)
+            if self.pim_info['auth'] != b'AUTH REQUIRED':
+                # nothing to authenticate, the banner completes the handshake
+                self.initial = False
+                self.ready.set()
+
+    def banner_received(self, line):
+        prefix, version, protocol, auth, suffix = line.split(b'/', maxsplit=4)
+        majorVersion, minorVersion = version.split(b'.', maxsplit=1)
+        assert(self.protocol == protocol)
+        self.pim_info = {
+            'prefix': prefix,
+            'version': version,
+            'protocol': protocol,
+            'auth': auth,
+            'majorVersion': majorVersion,
+            'minorVersion': minorVersion
+        }
+        self.challenge = unhexlify(suffix)
+        self.banner = line
+        log_pim.info('self.pim_info:\n%s', lazy(pformat, self.pim_info))
+
+    def reconnect_line_received(self, line):
+        if self.challenge is None:
+            try:
+                self.banner_received(line)
+            except (ValueError, AssertionError):
+                log_pim.error("unexpected PIM banner on reconnect: %s", line)
+                self.transport.close()
+                return
+            if self.pim_info['auth'] != b'AUTH REQUIRED':
+                self.reconnected()
+            elif self.username is None or self.password is None:
+                log_pim.error("PIM requires auth but no credentials are configured")
+                self.transport.close()
+            else:
+                self.send_credentials()
+        elif line.split(b'/', maxsplit=1)[0] == b'AUTH SUCCEEDED':
+            self.auth_result = line
+            self.wrapped = True
+            self.reconnected()
+        else:
+            log_pim.error("auth failed on reconnect: %s", line)
+            self.transport.close()
+
+    def send_credentials(self):
+        self.write(self.username.encode('utf-8') + b'/' + auth_digest(self.password, self.challenge) + b'\x00')
+
+    def packet_received(self, packet, transmitted, result):
+        if transmitted:
+            log_pim.debug("Got upb pim message data: %s %s", packet, result.name)
+            return
+        log_pim.debug("Got upb message data: %s %s", packet, result.name)
+        self.message_received(packet)
+
+    def message_received(self, packet):
+        raw = packet
+        packet = self.process_packet(raw)
+        if packet is None:
+            # relayed as the PIM sent it, clients see the same corrupt message they would without the proxy
+            self.metric_bad_lines.inc()
+            log_pim.warning('got invalid upb message: %s', lazy(hexdump, raw))
+            return True
+        copies = None
+        if self.deduper is not None:
+            copies = self.deduper.observe(packet.raw)
+            if copies.count > 1:
+                self.metric_message_repeats.inc()
+                log_pim.debug("repeat %d of %r", copies.count, packet)
+                return copies.relay
+        for listener in self.message_listeners:
+            listener(packet, copies)
+        # commands from other controllers and link activations from switches leave device state unknown
+        self.state.forget(packet)
+        self.state.report(packet)
+        # register writes from other controllers leave the cached ranges and links stale
+        self.registers.command(packet)
+        for session, request, report in self.registers.report(packet):
+            if session in self.sessions:
+                session.reply(report)
+        if self.registers.dirty and self.registers_timer is None:
+            self.registers_timer = asyncio.get_event_loop().call_later(REGISTER_SAVE_DELAY, self.save_registers)
+        entry = self.inflight.reported(packet)
+        if entry is None:
+            return True
+        log_pim.debug("report for %r after %.3fs", entry.packet, self.inflight.loop.time() - entry.sent)
+        if entry.packet.mdid_cmd == MdidCoreCmd.MDID_CORE_COMMAND_GETDEVICESIGNATURE:
+            log_pim.debug("Decoding signature with length %d: %s", len(packet.data), lazy(hexdump, packet.data))
+        # reports for the proxy's own reads, narrowed ones included, are not relayed
+        if copies is not None:
+            copies.relay = entry.owner is not None
+        return entry.owner is not None
+
+    def lines_received(self, lines):
+        """
+        Handles a batch of PIM lines, returns the relay target of those not
+        relayed to every session by line id.
+        """
+        routes = {}
+        for event in self.decoder.decode(lines):
+            kind = event[0]
+            if kind == PulseEvent.PACKET:
+                self.pulse_mode = True
+                self.packet_received(event[1], event[2], event[3])
+            elif kind == PulseEvent.LINE:
+                relay = self.line_received(event[1])
+                if relay is not True:
+                    routes[id(event[1])] = relay
+            elif kind == PulseEvent.DROP:
+                self.metric_pulse_drops.inc()
+                log_pim.info('dropped message: %s', event[1])
+            elif kind == PulseEvent.SEQUENCE_ERROR:
+                self.metric_pulse_sequence_errors.inc()
+                log_pim.warning("Got upb message data bad seq: %#x, expected: %#x", event[2], event[1])
+        return routes
 
     def line_received(self, line):
-        print(f'pim line: {line}')
+        """
+        Returns where to relay the line: True for every session, the owning
+        session for PIM reports answering its transmits, False for those
+        answering the proxy's own.
+        """
+        log_pim.debug('pim line: %s', lazy(bytes, line))
+        relay = True
         if UpbMessage.has_value(line[UPB_MESSAGE_TYPE]):
             command = UpbMessage(line[UPB_MESSAGE_TYPE])
             data = line[1:]
-            if command != UpbMessage.UPB_MESSAGE_IDLE and \
-            command != UpbMessage.UPB_MESSAGE_TRANSMITTED and \
-            not UpbMessage.is_message_data(command):
-                print(f"PIM {command.name} data: {data}")
-            if command == UpbMessage.UPB_MESSAGE_IDLE:
-                assert(self.packet_byte == 0)
-                assert(self.pulse_data_seq == 0)
-                assert(self.packet_crumb == 0)
-                self.set_state_zero()
-            elif command == UpbMessage.UPB_MESSAGE_DROP:
-                print('dropped message')
-                self.set_state_zero()
-            elif command == UpbMessage.UPB_MESSAGE_PIMREPORT:
-                print(f"got pim report: {hex(line[UPB_MESSAGE_PIMREPORT_TYPE])} with len: {len(line)}")
-                if len(line) > UPB_MESSAGE_PIMREPORT_TYPE:
+            log_pim.debug("PIM %s data: %s", command.name, lazy(bytes, data))
+            if command == UpbMessage.UPB_MESSAGE_PIMREPORT:
+                if len(line) > UPB_MESSAGE_PIMREPORT_TYPE and \
+                        UpbTransmission.has_value(line[UPB_MESSAGE_PIMREPORT_TYPE]):
                     transmission = UpbTransmission(line[UPB_MESSAGE_PIMREPORT_TYPE])
-                    print(f"transmission: {transmission.name}")
+                    log_pim.debug("got pim report: %s with len: %d", transmission.name, len(line))
+                    self.metric_pim_reports[transmission].inc()
+                    for listener in self.transmission_listeners:
+                        listener(transmission)
+                    outstanding = self.scheduler.outstanding
+                    if outstanding is not None and transmission != UpbTransmission.UPB_MESSAGE:
+                        relay = outstanding.owner or False
+                    self.scheduler.transmission(transmission)
+                    if transmission == UpbTransmission.UPB_PIM_BUSY and outstanding is not None and \
+                            outstanding.retries <= TRANSMIT_BUSY_RETRIES:
+                        # the proxy retries, the owner only sees PB once the transmit is dropped
+                        relay = False
+                    entry = self.inflight.transmission(transmission)
+                    if entry is not None:
+                        relay = entry.owner or False
+                        if entry.nak:
+                            self.read_failed(entry)
+                        else:
+                            # cached levels only follow commands the PIM acknowledged
+                            self.state.command(entry.packet)
+                        log_pim.debug("%s for %r after %.3fs", transmission.name, entry.packet, entry.acked - entry.sent)
+                        for listener in self.ack_listeners:
+                            listener(entry)
                     if transmission == UpbTransmission.UPB_PIM_REGISTERS:
-                        register_data = unhexlify(line[UPB_MESSAGE_PIMREPORT_TYPE + 1:])
-                        start = register_data[0]
-                        register_val = register_data[1:]
-                        print(f"start: {hex(start)} register_val: {register_val}")
-                        if start == INITIAL_PIM_REG_QUERY_BASE:
-                            print("got pim in initial phase query mode")
+                        try:
+                            register_data = unhexlify(line[UPB_MESSAGE_PIMREPORT_TYPE + 1:])
+                            start = register_data[0]
+                        except (ValueError, IndexError):
+                            self.bad_line(line)
+                        else:
+                            register_val = register_data[1:]
+                            log_pim.debug("start: %#x register_val: %s", start, register_val)
+                            if start == INITIAL_PIM_REG_QUERY_BASE:
+                                log_pim.info("got pim in initial phase query mode")
                     elif transmission == UpbTransmission.UPB_PIM_ACCEPT:
                         self.pim_accept = True
-                        print("got pim accept")
+                        log_pim.debug("got pim accept")
+                    elif transmission == UpbTransmission.UPB_MESSAGE:
+                        self.pulse_mode = False
+                        try:
+                            packet = unhexlify(line[UPB_MESSAGE_PIMREPORT_TYPE + 1:])
+                        except ValueError:
+                            self.bad_line(line)
+                        else:
+                            relay = self.message_received(packet)
                 else:
-                    print(f'got corrupt pim report: {hex(line[UPB_MESSAGE_PIMREPORT_TYPE])} with len: {len(line)}')
-
-            elif command == UpbMessage.UPB_MESSAGE_SYNC:
-                self.packet_byte = 0
-                self.packet_crumb = 0
-            elif command == UpbMessage.UPB_MESSAGE_START:
-                self.packet_byte = 0
-                self.packet_crumb = 0
-            elif UpbMessage.is_message_data(command):
-                self.data_counter += 1
-                if len(data) == 2:
-                    seq = unhexlify(b'0' + data[1:2])[0]
-                    two_bits = command.value - 0x30
-                    assert(seq == self.pulse_data_seq)
-                    if seq == self.pulse_data_seq:
-                        if self.packet_crumb == 0:
-                            self.upb_packet[self.packet_byte] = (two_bits << 6)
-                            self.packet_crumb += 1
-                        elif self.packet_crumb == 1:
-                            self.upb_packet[self.packet_byte] |= (two_bits << 4)
-                            self.packet_crumb += 1
-                        elif self.packet_crumb == 2:
-                            self.upb_packet[self.packet_byte] |= (two_bits << 2)
-                            self.packet_crumb += 1
-                        elif self.packet_crumb == 3:
-                            self.upb_packet[self.packet_byte] |= two_bits
-                            self.packet_crumb = 0
-                            self.packet_byte += 1
-                        self.pulse_data_seq += 1
-                        if self.pulse_data_seq > 0x0f:
-                            self.pulse_data_seq = 0
-                    else:
-                        print(f"Got upb message data bad seq: {hex(self.seq)}")
-
-            elif command == UpbMessage.UPB_MESSAGE_TRANSMITTED:
-                self.transmitted = True
-                if len(data) == 2:
-                    seq = unhexlify(b'0' + data[1:2])[0]
-                    two_bits = data[0] - 0x30
-                    assert(seq == self.pulse_data_seq)
-                    if seq == self.pulse_data_seq:
-                        if self.packet_crumb == 0:
-                            self.upb_packet[self.packet_byte] = (two_bits << 6)
-                            self.packet_crumb += 1
-                        elif self.packet_crumb == 1:
-                            self.upb_packet[self.packet_byte] |= (two_bits << 4)
-                            self.packet_crumb += 1
-                        elif self.packet_crumb == 2:
-                            self.upb_packet[self.packet_byte] |= (two_bits << 2)
-                            self.packet_crumb += 1
-                        elif self.packet_crumb == 3:
-                            self.upb_packet[self.packet_byte] |= two_bits
-                            self.packet_crumb = 0
-                            self.packet_byte += 1
-                        self.pulse_data_seq += 1
-                        if self.pulse_data_seq > 0x0f:
-                            self.pulse_data_seq = 0
-                    else:
-                        print(f"Got upb message data bad seq: {hex(self.seq)}")
-            elif command == UpbMessage.UPB_MESSAGE_ACK or command == UpbMessage.UPB_MESSAGE_NAK:
-                if self.transmitted:
-                    self.message_buffer = bytes(self.upb_packet[1:self.packet_byte - 1])
-                else:
-                    self.message_buffer = bytes(self.upb_packet[0:self.packet_byte])
-                    if len(self.message_buffer) != 0:
-                        self.process_packet(self.message_buffer)
-                if self.transmitted and len(self.message_buffer) != 0:
-                    print(f"Got upb pim message data: {self.message_buffer}")
-                elif len(self.message_buffer) != 0:
-                    print(f"Got upb message data: {self.message_buffer}")
-                if len(self.message_buffer) != 0:
-                    if self.last_command.get('mdid_cmd', None) == MdidCoreCmd.MDID_CORE_COMMAND_GETDEVICESIGNATURE:
-                        print(f"Decoding signature with length {len(self.message_buffer)}")
-                        for index in range(len(self.message_buffer)):
-                            print(f"Reg index: {index}, value: {hex(self.message_buffer[index])}")
-                self.message_buffer = b''
-                self.data_counter = 0
-                if self.packet_byte > 0:
-                    self.set_state_zero()
+                    self.bad_line(line)
         else:
-            print(f'PIM failed to parse line: {line}')
+            self.bad_line(line)
+        return relay
 
     def data_received(self, data):
-        self.buffer += data
-        #print(f'pim buffer: {self.buffer}, hex: {hexdump(self.buffer)}')
-        if self.server_transport:
-            self.server_transport.write(data)
+        log_pim.debug('pim data: %s, hex: %s', data, lazy(hexdump, data))
+        self.last_received = self.loop.time()
+        if self.capture is not None:
+            self.capture.write(CaptureDirection.FROM_PIM, data)
+        self.framer.feed(data)
+        # frames and lines are relayed once handled, paired with the sessions they go to
+        relay = []
+        if not self.wrapped:
+            for line in self.framer.lines(b'\x00'):
+                line = bytes(line)
+                if not self.reconnecting:
+                    relay.append((line + b'\x00', True))
+                if len(line) >= 1:
+                    self.nt_line_received(line)
+                if self.wrapped:
+                    break
+            if not self.wrapped:
+                lines = list(self.framer.lines(b'\r'))
+                parsed = [line for line in lines if len(line) > 1]
+                self.metric_pim_frames.inc(len(parsed))
+                routes = self.lines_received(parsed) if parsed else {}
+                if not self.reconnecting:
+                    relay.extend((bytes(line) + b'\r', routes.get(id(line), True)) for line in lines)
         if self.wrapped:
-            while len(self.buffer) > 0 and GatewayCmd.has_value(self.buffer[0]-1):
-                if len(self.buffer) >= 8:
-                    rcCommand = self.buffer[1]
-                    assert(rcCommand == 0x00)
-                    length = unpack('>H', self.buffer[6:8])[0]
-                    #print(f"pim length: {length}")
-                    if len(self.buffer) >= length + 9:
-                        cmd = GatewayCmd(self.buffer[0]-1)
-                        #print(f"pim cmd: {cmd.name}")
-                        if cmd == GatewayCmd.SEND_TO_SERIAL:
-                            line = self.buffer[8:length+7]
-                            self.buffer = self.buffer[length+10:]
-                            #print(f"pim gateway response: {line}, hex: {hexdump(line)} length: {length}")
-                            self.line_received(line)
-                        elif cmd == GatewayCmd.KEEP_ALIVE:
-                            self.buffer = self.buffer[length+4:]
-                    else:
-                        return
+            lines = []
+            frames = []
+            for cmd, frame, payload in self.framer.gateway_frames(GATEWAY_RESPONSE_HEADER_BYTES,
+                    GATEWAY_RESPONSE_LENGTH_OFFSET, GATEWAY_TRAILER_BYTES, cmd_offset=1):
+                rcCommand = frame[1]
+                if cmd == GatewayCmd.SEND_TO_SERIAL and rcCommand != 0x00:
+                    log_pim.warning("PIM serial data with result %#x: %s", rcCommand, lazy(hexdump, frame))
+                    self.metric_bad_lines.inc()
+                    frames.append((frame, None))
+                elif cmd == GatewayCmd.SEND_TO_SERIAL:
+                    line = payload[:-1]
+                    lines.append(line)
+                    frames.append((frame, line))
+                elif cmd == GatewayCmd.KEEP_ALIVE and self.keepalive_probes:
+                    # answers the proxy's own probe, sessions get their keep-alives answered locally
+                    self.keepalive_probes -= 1
+                    self.metric_pim_frames.inc()
                 else:
-                    return
+                    for listener in self.gateway_listeners:
+                        listener(cmd, rcCommand, payload)
+                    frames.append((frame, None))
+            self.metric_pim_frames.inc(len(frames))
+            routes = self.lines_received(lines) if lines else {}
+            if not self.reconnecting:
+                relay.extend((bytes(frame), True if line is None else routes.get(id(line), True))
+                    for frame, line in frames)
+        if all(target is True for data, target in relay):
+            data = b''.join(data for data, target in relay)
+            if data:
+                for session in tuple(self.sessions):
+                    session.forward(data)
         else:
-            while b'\x00' in self.buffer:
-                line, self.buffer = self.buffer.split(b'\x00', 1)
-                if len(line) >= 1:
-                    self.nt_line_received(line)
-            while b'\r' in self.buffer and not self.wrapped:
-                line, self.buffer = self.buffer.split(b'\r', 1)
-                if len(line) > 1:
-                    self.line_received(line)
+            for session in tuple(self.sessions):
+                data = b''.join(data for data, target in relay if target is True or target is session)
+                if data:
+                    session.forward(data)
 
     def connection_lost(self, *args):
-        print("pim connection lost")
+        log_pim.warning("pim connection lost")
         self.connected = False
+        self.reconnecting = False
+        self.up.clear()
+        self.ready.clear()
+        self.scheduler.pause()
+        self.inflight.close()
+        if self.lost is not None and not self.lost.done():
+            self.lost.set_result(None)
 
 class Upstart(asyncio.Protocol):
 
     def __init__(self, transport, protocol, username=None, password=None):
         self.client = protocol
         self.initial = False
+        self.local_handshake = False
         self.client_info = {}
-        self.buffer = b''
+        self.framer = Framer()
         self.username = username
         self.password = password
+        self.paused = False
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.session_wrapped = False
+        self.last_received = 0.0
+        self.last_active = 0.0
+        self.keepalives = 0
 
     def connection_made(self, transport):
-        print("Upstart connected")
+        log_upstart.info("Upstart connected")
         # save the transport
         self.initial = True
         self.client_info = {}
-        self.client.protocol = None
         self.transport = transport
-        self.client.server_transport = self.transport
+        self.transport.set_write_buffer_limits(high=SESSION_WRITE_BUFFER_HIGH)
+        self.last_received = self.last_active = self.client.loop.time()
+        # once the PIM session is established later clients are answered locally
+        self.local_handshake = not self.client.initial
+        if not self.local_handshake:
+            self.client.protocol = None
+        self.client.sessions.add(self)
+
+    @property
+    def wrapped(self):
+        # once wrapped a session stays wrapped, also while the PIM reconnects
+        if not self.session_wrapped:
+            self.session_wrapped = self.client.wrapped and not (self.local_handshake and self.initial)
+        return self.session_wrapped
+
+    def forward(self, data):
+        if (self.local_handshake and self.initial) or self.transport.is_closing():
+            return
+        if self.paused or self.pending:
+            if self.pending_bytes + len(data) > SESSION_QUEUE_LIMIT:
+                log_upstart.warning("upstart session queue full, dropping client")
+                self.pending.clear()
+                self.pending_bytes = 0
+                self.transport.abort()
+                return
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+        else:
+            self.transport.write(data)
+
+    def expire(self, now):
+        """
+        Drops the session once its client has stopped sending keep-alives, or
+        closes it when it has only sent keep-alives for longer than the idle
+        timeout. Clients that never send keep-alives are left to TCP.
+        """
+        if self.transport.is_closing():
+            return
+        timeout = self.client.session_timeout
+        if timeout and self.keepalives and now - self.last_received > timeout:
+            log_upstart.warning("upstart client silent for %.0fs, dropping it", now - self.last_received)
+            self.client.metric_sessions_expired['dead'].inc()
+            self.transport.abort()
+        elif self.client.idle_timeout and now - self.last_active > self.client.idle_timeout:
+            log_upstart.info("closing upstart session idle for %.0fs", now - self.last_active)
+            self.client.metric_sessions_expired['idle'].inc()
+            self.transport.close()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        while self.pending and not self.paused:
+            data = self.pending.popleft()
+            self.pending_bytes -= len(data)
+            self.transport.write(data)
 
     def send_data(self, data):
-        self.client.transport.write(data)
+        if self.client.connected and not self.client.reconnecting:
+            self.client.write(data)
+        else:
+            log_upstart.debug("PIM not connected, dropping: %s", lazy(hexdump, data))
+
+    def send_line(self, line):
+        if self.wrapped:
+            self.forward(encode_gateway_response(GatewayCmd.SEND_TO_SERIAL, line + b'\r'))
+        else:
+            self.forward(line + b'\r')
+
+    def encode_line(self, line):
+        if self.wrapped:
+            return encode_gateway_request(GatewayCmd.SEND_TO_SERIAL, line + b'\r')
+        return line + b'\r'
+
+    def send_reports(self, *transmissions):
+        for transmission in transmissions:
+            self.send_line(bytes((UpbMessage.UPB_MESSAGE_PIMREPORT, transmission)))
+
+    def reply(self, report):
+        self.send_reports(UpbTransmission.UPB_PIM_ACCEPT, UpbTransmission.UPB_TRANSMISSION_ACK)
+        self.send_line(bytes((UpbMessage.UPB_MESSAGE_PIMREPORT, UpbTransmission.UPB_MESSAGE)) + hexlify(report).upper())
+
+    def check_credentials(self, line):
+        gatewayUserName, _, gatewayPasswordHash = line.partition(b'/')
+        if self.username is None or self.password is None or self.client.challenge is None:
+            return False
+        if self.username.encode('utf-8') != gatewayUserName:
+            return False
+        return hmac.compare_digest(auth_digest(self.password, self.client.challenge), gatewayPasswordHash)
+
+    def parse_client_info(self, line):
+        prefix, version, protocol = line.split(b'/', maxsplit=2)
+        majorVersion, minorVersion, buildNumber = version.split(b'.', maxsplit=2)
+        self.client_info = {
+            'prefix': prefix,
+            'version': version,
+            'protocol': protocol,
+            'majorVersion': majorVersion,
+            'minorVersion': minorVersion,
+            'buildNumber': buildNumber
+        }
+
+    def local_nt_line_received(self, line):
+        if not self.client_info:
+            self.parse_client_info(line)
+            if self.client_info['protocol'] != self.client.protocol:
+                log_upstart.warning("upstart protocol mismatch: %s", self.client_info['protocol'])
+            self.transport.write(self.client.banner + b'\x00')
+            if self.client.pim_info.get('auth') != b'AUTH REQUIRED':
+                self.initial = False
+        elif self.check_credentials(line):
+            self.client_info['gatewayUserName'] = self.username
+            self.transport.write(self.client.auth_result + b'\x00')
+            self.initial = False
+        else:
+            log_upstart.warning("upstart session auth failed")
+            self.transport.write(b'AUTHENTICATION FAILED/' + self.client.auth_result.split(b'/', 1)[1] + b'\x00')
+            self.transport.close()
 
     def nt_line_received(self, line):
-        print(f'upstart null terminated line: {line}, hex: {hexdump(line)}')
-        if self.initial:
+        log_upstart.debug('upstart null terminated line: %s, hex: %s', line, lazy(hexdump, line))
+        if self.initial and self.local_handshake:
+            self.local_nt_line_received(line)
+        elif self.initial:
             if self.client.pim_info.get('auth', None) == b'AUTH REQUIRED' and \
                 self.client.challenge is not None and self.client.authenticated is not True:
-                assert(len(self.client.challenge) == 64)
-                gatewayUserName, gatewayPasswordHash = line.split(b'/', maxsplit=1)
-                assert(self.username.encode('utf-8') == gatewayUserName)
-                digest = hmac.new(self.password.encode('utf-8'), self.client.challenge, 'md5').hexdigest().swapcase().encode('ascii')
-                assert(digest == gatewayPasswordHash)
+                if len(self.client.challenge) != 64 or not self.check_credentials(line):
+                    log_upstart.warning("upstart session auth failed")
+                    self.transport.close()
+                    if self.username is not None and self.password is not None:
+                        # the PIM still waits for credentials, the proxy answers with its own
+                        self.client.authenticated = True
+                        self.client.send_credentials()
+                    return
                 self.client_info['gatewayUserName'] = self.username
                 self.client_info['gatewayPassword'] = self.password
                 self.client.authenticated = True
             elif self.client.authenticated is not True:
-                prefix, version, protocol = line.split(b'/', maxsplit=2)
-                majorVersion, minorVersion, buildNumber = version.split(b'.', maxsplit=2)
-                self.client_info = {
-                    'prefix': prefix,
-                    'version': version,
-                    'protocol': protocol,
-                    'majorVersion': majorVersion,
-                    'minorVersion': minorVersion,
-                    'buildNumber': buildNumber
-                }
-                self.client.protocol = protocol
-            print(f'self.client_info:\n{pformat(self.client_info)}')
+                self.parse_client_info(line)
+                self.client.protocol = self.client_info['protocol']
+                self.client.hello = line
+            log_upstart.info('self.client_info:\n%s', lazy(pformat, self.client_info))
 
     def line_received(self, line):
-        #print(f'upstart line: {line}')
+        """
+        Returns the command and network packet of a client line, raises
+        ValueError for lines the PIM would answer with PE.
+        """
         command = PimCommand(line[0])
-        data = unhexlify(line[1:-2])
-        crc = int(line[-2:], 16)
-        computed_crc = cksum(data)
-        if crc == computed_crc:
-            print(f'Upstart {command.name} line: {line}, data: {data}')
+        data = unhexlify(line[1:])
+        packet = None
+        if len(data) > 1 and cksum(data[:-1]) == data[-1]:
+            log_upstart.debug('Upstart %s line: %s, data: %s', command.name, lazy(bytes, line), data)
             if command == PimCommand.UPB_NETWORK_TRANSMIT:
-                control_word = data[0:2]
-                link_bit = (control_word[0] >> PACKETHEADER_LINKBIT) & 7
-                repeater_request = UpbReqRepeater((control_word[0] >> 0x60) & 5)
-                data_len = control_word[0] & 0x1f
-                assert(data_len == len(data) + 1)
-                reserved = control_word[1] & 0x80 >> 7
-                assert(reserved == 0x00)
-                ack_request = UpbReqAck((control_word[1] >> 0x70) & 4)
-                transmit_cnt = (control_word[1] >> 0x0c) & 2
-                transmit_seq = control_word[1] & 0x03
-                network_id = data[2]
-                destination_id = data[3]
-                device_id = UpbDeviceId(data[4])
-                mdid_set = MdidSet(data[5] & 0xe0)
-                if mdid_set == MdidSet.MDID_CORE_COMMANDS:
-                    mdid_cmd = MdidCoreCmd(data[5] & 0x1f)
-                elif mdid_set == MdidSet.MDID_DEVICE_CONTROL_COMMANDS:
-                    mdid_cmd = MdidDeviceControlCmd(data[5] & 0x1f)
-                elif mdid_set == MdidSet.MDID_CORE_REPORTS:
-                    mdid_cmd = MdidCoreReport(data[5] & 0x1f)
-                last_command = {
-                    'link_bit': link_bit,
-                    'repeater_request': repeater_request,
-                    'ack_request': ack_request,
-                    'transmit_cnt': transmit_cnt,
-                    'transmit_seq': transmit_seq,
-                    'network_id': network_id,
-                    'destination_id': destination_id,
-                    'device_id': device_id,
-                    'mdid_set': mdid_set,
-                    'mdid_cmd': mdid_cmd,
-                    'data_len': data_len
-                }
-                if mdid_cmd == MdidCoreCmd.MDID_CORE_COMMAND_GETREGISTERVALUES:
-                    last_command['register_start'] = data[6]
-                    last_command['registers'] = data[7]
-                    last_command['data'] = data[8:]
-                else:
-                    last_command['data'] = data[6:]
-                self.client.last_command = last_command
-                pprint(last_command)
-                if UpbDeviceId.has_value(destination_id):
-                    if UpbDeviceId(destination_id) == UpbDeviceId.BROADCAST_DEVICEID:
-                        print('Broadcasting')
+                packet = decode_packet(data)
+                if not packet.valid or packet.length != len(data) or packet.reserved != 0x00:
+                    raise ValueError(f'malformed packet {data.hex()}')
+                log_upstart.debug("packet:\n%s", packet)
+                if UpbDeviceId.has_value(packet.destination_id):
+                    if packet.destination_id == UpbDeviceId.BROADCAST_DEVICEID:
+                        log_upstart.debug('Broadcasting')
                     else:
-                        print(f'Have device id type: {UpbDeviceId.BROADCAST_DEVICEID.name}')
+                        log_upstart.debug('Have device id type: %s', UpbDeviceId(packet.destination_id).name)
         else:
-            print(f'Upstart corrupt data line: {line}')
+            self.client.metric_checksum_failures.inc()
+            log_upstart.warning('Upstart corrupt data line: %s', lazy(bytes, line))
+        return command, packet
+
+    def transmit(self, line, frame):
+        try:
+            command, packet = self.line_received(line)
+        except ValueError:
+            log_upstart.warning('Upstart unparsable line: %s', lazy(bytes, line))
+            self.send_reports(UpbTransmission.UPB_PIM_ERROR)
+            return
+        owner = self
+        if packet is not None:
+            self.client.registers.command(packet)
+        # cached replies are PU reports, clients of a PIM in pulse mode expect pulse lines
+        if packet is not None and not self.client.pulse_mode:
+            report = self.client.state.answer(packet)
+            if report is not None:
+                self.reply(report)
+                return
+            report, request = self.client.registers.answer(packet, self)
+            if report is not None:
+                self.reply(report)
+                return
+            if request is not None:
+                log_upstart.debug("narrowed register read to %s", lazy(hexdump, request))
+                packet = decode_packet(request)
+                frame = self.encode_line(bytes((command,)) + hexlify(request).upper())
+                # the narrowed read is the proxy's own, the session is answered from the cache once it is reported
+                owner = None
+        self.client.scheduler.submit(frame, transmit_priority(command, packet), coalesce_key(command, packet),
+            needs_ack=command == PimCommand.UPB_NETWORK_TRANSMIT, packet=packet, owner=owner)
 
     def data_received(self, data):
-        self.buffer += data
-        #print(f'upstart buffer: {self.buffer}, hex: {hexdump(self.buffer)}')
-        self.send_data(data)
-        if self.client.wrapped:
-            while len(self.buffer) > 0 and GatewayCmd.has_value(self.buffer[0]):
-                if len(self.buffer) >= 4:
-                    length = unpack('>H', self.buffer[1:3])[0]
-                    if len(self.buffer) > length + 4:
-                        #print(f"length: {length}")
-                        cmd = GatewayCmd(self.buffer[0])
-                        #print(f"cmd: {cmd.name}")
-                        if cmd == GatewayCmd.SEND_TO_SERIAL:
-                            line = self.buffer[3:length+2]
-                            self.buffer = self.buffer[length+4:]
-                            #print(f"gateway to serial line: {line}, hex: {hexdump(line)} length: {length}")
-                            self.line_received(line)
-                        elif cmd == GatewayCmd.KEEP_ALIVE:
-                            self.buffer = self.buffer[length+4:]
-                    else:
-                        return
+        log_upstart.debug('upstart data: %s, hex: %s', data, lazy(hexdump, data))
+        now = self.client.loop.time()
+        self.last_received = now
+        if self.client.capture is not None:
+            self.client.capture.write(CaptureDirection.FROM_CLIENT, data)
+        self.framer.feed(data)
+        if self.wrapped:
+            for cmd, frame, payload in self.framer.gateway_frames(GATEWAY_REQUEST_HEADER_BYTES,
+                    GATEWAY_REQUEST_LENGTH_OFFSET, GATEWAY_TRAILER_BYTES):
+                self.client.metric_client_frames.inc()
+                if cmd == GatewayCmd.KEEP_ALIVE:
+                    # answered here, the proxy keeps its own cadence toward the PIM
+                    self.keepalives += 1
+                    self.client.metric_keepalives_answered.inc()
+                    self.forward(KEEP_ALIVE_RESPONSE)
+                    continue
+                self.last_active = now
+                if cmd == GatewayCmd.SEND_TO_SERIAL:
+                    self.transmit(payload[:-1], bytes(frame))
                 else:
-                    return
+                    self.send_data(bytes(frame))
         else:
-            while b'\x00' in self.buffer:
-                line, self.buffer = self.buffer.split(b'\x00', 1)
+            self.last_active = now
+            for line in self.framer.lines(b'\x00'):
+                line = bytes(line)
+                forward = not (self.local_handshake and self.initial)
                 if len(line) > 0:
                     self.nt_line_received(line)
-            while b'\r' in self.buffer and not self.client.wrapped:
-                line, self.buffer = self.buffer.split(b'\r', 1)
-                if len(line) >= 1:
-                    self.line_received(line)
+                # checked first, credentials that fail are not passed on
+                if forward and not self.transport.is_closing():
+                    self.send_data(line + b'\x00')
+            if not self.wrapped:
+                for line in self.framer.lines(b'\r'):
+                    self.client.metric_client_frames.inc()
+                    if len(line) >= 1:
+                        self.transmit(line, bytes(line) + b'\r')
+                    else:
+                        self.send_data(b'\r')
+                    if self.wrapped:
+                        break
 
     def connection_lost(self, *args):
-        print("upstart connection lost")
+        log_upstart.info("upstart connection lost")
         self.initial = False
-        self.client.server_transport = None
+        self.pending.clear()
+        self.pending_bytes = 0
+        self.client.sessions.discard(self)
+        self.client.registers.drop_session(self)
 
-async def main():
+def register_metrics(pim, capture=None, registry=REGISTRY, **labels):
+    registry.counter('upbshark_frames_total', 'Frames or lines received', pim.metric_pim_frames, source='pim',
+        **labels)
+    registry.counter('upbshark_frames_total', 'Frames or lines received', pim.metric_client_frames,
+        source='client', **labels)
+    for transmission, counter in pim.metric_pim_reports.items():
+        registry.counter('upbshark_pim_reports_total', 'PIM reports by type', counter,
+            transmission=transmission.name, **labels)
+    registry.counter('upbshark_pulse_drops_total', 'Pulse mode packets dropped', pim.metric_pulse_drops, **labels)
+    registry.counter('upbshark_pulse_sequence_errors_total', 'Pulse mode sequence errors',
+        pim.metric_pulse_sequence_errors, **labels)
+    registry.counter('upbshark_message_repeats_total', 'Repeated copies of UPB messages suppressed',
+        pim.metric_message_repeats, **labels)
+    registry.counter('upbshark_checksum_failures_total', 'Client lines with a bad checksum',
+        pim.metric_checksum_failures, **labels)
+    registry.counter('upbshark_pim_bad_lines_total', 'PIM lines or messages that could not be decoded',
+        pim.metric_bad_lines, **labels)
+    registry.counter('upbshark_keepalives_answered_total', 'Client keep-alives answered by the proxy',
+        pim.metric_keepalives_answered, **labels)
+    registry.counter('upbshark_pim_keepalives_total', 'Keep-alives sent to the PIM', pim.metric_pim_keepalives,
+        **labels)
+    registry.counter('upbshark_pim_timeouts_total', 'PIM connections dropped as silent', pim.metric_pim_timeouts,
+        **labels)
+    for reason, counter in pim.metric_sessions_expired.items():
+        registry.counter('upbshark_sessions_expired_total', 'Client sessions closed by the proxy', counter,
+            reason=reason, **labels)
+    registry.gauge('upbshark_clients', 'Connected client sessions', lambda: len(pim.sessions), **labels)
+    registry.gauge('upbshark_pim_connected', 'Whether the PIM connection is up', lambda: int(pim.connected), **labels)
+    registry.gauge('upbshark_transmit_queue', 'Frames waiting for the PIM', lambda: len(pim.scheduler), **labels)
+    registry.counter('upbshark_transmits_coalesced_total', 'Queued transmits superseded before reaching the PIM',
+        lambda: pim.scheduler.coalesced, **labels)
+    registry.gauge('upbshark_inflight', 'Transmits waiting for a report', lambda: len(pim.inflight), **labels)
+    registry.counter('upbshark_inflight_timeouts_total', 'Transmits never reported',
+        lambda: pim.inflight.timeouts, **labels)
+    registry.histogram('upbshark_ack_latency_seconds', 'Transmit to PIM ACK/NAK', lambda: pim.ack_latency, **labels)
+    registry.histogram('upbshark_report_latency_seconds', 'Transmit to device report',
+        lambda: pim.report_latency, **labels)
+    for cache, counters in (('state', pim.state), ('registers', pim.registers)):
+        registry.counter('upbshark_cache_hits_total', 'Queries answered from a cache',
+            lambda counters=counters: counters.hits, cache=cache, **labels)
+        registry.counter('upbshark_cache_misses_total', 'Queries sent to the device',
+            lambda counters=counters: counters.misses, cache=cache, **labels)
+    registry.gauge('upbshark_links', 'Links with known target devices', lambda: len(pim.registers.links), **labels)
+    if capture is not None:
+        registry.counter('upbshark_capture_dropped_total', 'Capture records dropped', lambda: capture.dropped, **labels)
+
+async def maintain_pim(pim, host, port):
+    """
+    Keeps the PIM connected, retrying with jittered exponential backoff.
+    """
     loop = asyncio.get_event_loop()
+    delay = PIM_RECONNECT_MIN_DELAY
+    while True:
+        try:
+            await loop.create_connection(lambda: pim, host, port)
+        except OSError as e:
+            log_pim.warning("could not connect to PIM %s:%d: %s", host, port, e)
+        else:
+            connected = loop.time()
+            await pim.lost
+            if loop.time() - connected > PIM_RECONNECT_MAX_DELAY:
+                delay = PIM_RECONNECT_MIN_DELAY
+        wait = random.uniform(delay / 2, delay)
+        log_pim.info("reconnecting to PIM in %.1fs", wait)
+        await asyncio.sleep(wait)
+        delay = min(delay * 2, PIM_RECONNECT_MAX_DELAY)
+
+async def serve_gateway(host, port, username=None, password=None, listen_host='0.0.0.0', listen_port=2101,
+                        state_ttl=DEVICE_STATE_TTL, register_path=REGISTER_CACHE_PATH, capture=None,
+                        dedupe_window=DEDUPE_WINDOW, events_host='127.0.0.1', events_port=None, schedule_path=None,
+                        keepalive_interval=PIM_KEEPALIVE_INTERVAL, pim_timeout=PIM_TIMEOUT,
+                        session_timeout=SESSION_TIMEOUT, idle_timeout=SESSION_IDLE_TIMEOUT, **labels):
+    """
+    Proxies one PIM gateway to the clients connecting on listen_port.
+    """
+    loop = asyncio.get_event_loop()
+    pim = PIM(state_ttl, register_path, capture, username, password, dedupe_window, keepalive_interval,
+        pim_timeout, session_timeout, idle_timeout)
+    register_metrics(pim, capture, **labels)
+    if events_port:
+        hub = EventHub()
+        hub.attach(pim)
+        await start_events_server(hub, events_host, events_port)
+    schedule = None
+    if schedule_path:
+        schedule = ScheduleEngine(pim, load_schedule(schedule_path))
+        log_pim.info("scheduled %d entries from %s", len(schedule), schedule_path)
+        REGISTRY.gauge('upbshark_schedule_entries', 'Pending schedule entries', lambda: len(schedule), **labels)
+        REGISTRY.counter('upbshark_schedule_fired_total', 'Schedule entries fired', lambda: schedule.fired, **labels)
+        REGISTRY.counter('upbshark_schedule_skipped_total', 'Schedule entries skipped',
+            lambda: schedule.skipped, **labels)
+        REGISTRY.histogram('upbshark_schedule_lateness_seconds', 'Due time to transmit queued',
+            lambda: schedule.lateness, **labels)
+    reconnect = asyncio.ensure_future(maintain_pim(pim, host, port))
+    pim.start_watchdog()
+    try:
+        await pim.up.wait()
+        server = await loop.create_server(lambda: Upstart(pim.transport, pim, username, password),
+            listen_host, listen_port)
+        async with server:
+            await server.serve_forever()
+    finally:
+        reconnect.cancel()
+        pim.stop_watchdog()
+        if schedule is not None:
+            schedule.close()
+        pim.registers.save()
+
+async def main():
+    listener = setup_logging(os.environ.get('UPBSHARK_LOG_LEVEL', 'INFO').upper())
+
+    state_ttl = float(os.environ.get('UPBSHARK_STATE_TTL', DEVICE_STATE_TTL))
+    dedupe_window = float(os.environ.get('UPBSHARK_DEDUPE_WINDOW', DEDUPE_WINDOW))
+    events_port = int(os.environ.get('UPBSHARK_EVENTS_PORT', 0))
+    events_host = os.environ.get('UPBSHARK_EVENTS_HOST', '127.0.0.1')
+    schedule_path = os.environ.get('UPBSHARK_SCHEDULE')
+    keepalive_interval = float(os.environ.get('UPBSHARK_KEEPALIVE_INTERVAL', PIM_KEEPALIVE_INTERVAL))
+    pim_timeout = float(os.environ.get('UPBSHARK_PIM_TIMEOUT', PIM_TIMEOUT))
+    session_timeout = float(os.environ.get('UPBSHARK_SESSION_TIMEOUT', SESSION_TIMEOUT))
+    idle_timeout = float(os.environ.get('UPBSHARK_SESSION_IDLE_TIMEOUT', SESSION_IDLE_TIMEOUT))
+
+    register_path = os.environ.get('UPBSHARK_REGISTER_CACHE', REGISTER_CACHE_PATH) or None
+    capture = None
+    if os.environ.get('UPBSHARK_CAPTURE'):
+        capture = CaptureWriter(os.environ['UPBSHARK_CAPTURE'],
+            int(os.environ.get('UPBSHARK_CAPTURE_MAX_BYTES', CAPTURE_MAX_BYTES)))
 
-    client_t, client_p = await loop.create_connection(PIM, sys.argv[1], int(sys.argv[2]))
+    metrics_port = int(os.environ.get('UPBSHARK_METRICS_PORT', 0))
+    if metrics_port:
+        await start_metrics_server(os.environ.get('UPBSHARK_METRICS_HOST', '0.0.0.0'), metrics_port)
 
-    if len(sys.argv) > 3:
-        server = await loop.create_server(lambda: Upstart(client_t, client_p, sys.argv[3], sys.argv[4]), '0.0.0.0', 2101)
-    else:
-        server = await loop.create_server(lambda: Upstart(client_t, client_p), '0.0.0.0', 2101)
-    async with server:
-        await server.serve_forever()
+    username, password = (sys.argv[3], sys.argv[4]) if len(sys.argv) > 3 else (None, None)
+    try:
+        await serve_gateway(sys.argv[1], int(sys.argv[2]), username, password, state_ttl=state_ttl,
+            register_path=register_path, capture=capture, dedupe_window=dedupe_window,
+            events_host=events_host, events_port=events_port, schedule_path=schedule_path,
+            keepalive_interval=keepalive_interval, pim_timeout=pim_timeout, session_timeout=session_timeout,
+            idle_timeout=idle_timeout)
+    finally:
+        if capture is not None:
+            capture.close()
+        listener.stop()
 
-asyncio.run(main())
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,131 @@
+"""
+Pulse mode packet assembly
+"""
+
+from enum import IntEnum
+
+from const import UpbMessage, UPB_MESSAGE_TYPE, PULSE_MODE_ENERGY, PULSE_MODE_SEQUENCE, PULSE_REPORT_BYTES
+
+# two bit value of a data character, -1 for anything else
+CRUMB_VALUE = [-1] * 256
+for _bits in range(4):
+    CRUMB_VALUE[0x30 + _bits] = _bits
+
+# sequence character to value, -1 for anything that is not a hex digit
+SEQ_VALUE = [-1] * 256
+for _seq, _char in enumerate(b'0123456789ABCDEF'):
+    SEQ_VALUE[_char] = _seq
+    SEQ_VALUE[ord(chr(_char).lower())] = _seq
+
+CRUMB_SHIFT = (6, 4, 2, 0)
+NEXT_SEQ = [(_seq + 1) & 0x0f for _seq in range(16)]
+
+DATA_COMMANDS = frozenset(
+    command.value for command in UpbMessage if UpbMessage.is_message_data(command))
+RESET_COMMANDS = frozenset((UpbMessage.UPB_MESSAGE_SYNC.value, UpbMessage.UPB_MESSAGE_START.value))
+END_COMMANDS = frozenset((UpbMessage.UPB_MESSAGE_ACK.value, UpbMessage.UPB_MESSAGE_NAK.value))
+MESSAGE_TRANSMITTED = UpbMessage.UPB_MESSAGE_TRANSMITTED.value
+MESSAGE_IDLE = UpbMessage.UPB_MESSAGE_IDLE.value
+MESSAGE_DROP = UpbMessage.UPB_MESSAGE_DROP.value
+
+
+class PulseEvent(IntEnum):
+    PACKET = 0
+    SEQUENCE_ERROR = 1
+    DROP = 2
+    LINE = 3
+
+
+class PulseDecoder:
+    """
+    Assembles UPB packets from batches of pulse mode lines.
+
+    decode() returns a list of event tuples:
+        (PulseEvent.PACKET, packet, transmitted, UpbMessage)
+        (PulseEvent.SEQUENCE_ERROR, expected, received)
+        (PulseEvent.DROP, partial_packet)
+        (PulseEvent.LINE, line) for lines that are not part of a packet
+    """
+
+    def __init__(self, size=64):
+        self.packet = bytearray(size)
+        self.reset()
+
+    def reset(self):
+        self.seq = 0
+        self.packet_byte = 0
+        self.packet_crumb = 0
+        self.current = 0
+        self.transmitted = False
+        self.discard = False
+
+    def decode(self, lines):
+        events = []
+        packet = self.packet
+        seq = self.seq
+        packet_byte = self.packet_byte
+        packet_crumb = self.packet_crumb
+        current = self.current
+        transmitted = self.transmitted
+        discard = self.discard
+        for line in lines:
+            if len(line) == 0:
+                continue
+            command = line[UPB_MESSAGE_TYPE]
+            if command in DATA_COMMANDS or command == MESSAGE_TRANSMITTED:
+                if command == MESSAGE_TRANSMITTED:
+                    transmitted = True
+                    if len(line) != PULSE_REPORT_BYTES:
+                        continue
+                    bits = CRUMB_VALUE[line[PULSE_MODE_ENERGY]]
+                else:
+                    if len(line) != PULSE_REPORT_BYTES:
+                        continue
+                    bits = CRUMB_VALUE[command]
+                received = SEQ_VALUE[line[PULSE_MODE_SEQUENCE]]
+                if received != seq or bits < 0:
+                    events.append((PulseEvent.SEQUENCE_ERROR, seq, received))
+                    discard = True
+                    packet_byte = packet_crumb = current = 0
+                    seq = NEXT_SEQ[received & 0x0f]
+                    continue
+                seq = NEXT_SEQ[seq]
+                if discard:
+                    continue
+                current |= bits << CRUMB_SHIFT[packet_crumb]
+                if packet_crumb == 3:
+                    if packet_byte == len(packet):
+                        packet.extend(bytes(len(packet)))
+                    packet[packet_byte] = current
+                    packet_byte += 1
+                    packet_crumb = 0
+                    current = 0
+                else:
+                    packet_crumb += 1
+            elif command in END_COMMANDS:
+                if not discard and packet_byte > 0:
+                    if transmitted:
+                        message = bytes(packet[1:packet_byte - 1])
+                    else:
+                        message = bytes(packet[0:packet_byte])
+                    if message:
+                        events.append((PulseEvent.PACKET, message, transmitted, UpbMessage(command)))
+                seq = packet_byte = packet_crumb = current = 0
+                transmitted = discard = False
+            elif command in RESET_COMMANDS:
+                packet_byte = packet_crumb = current = 0
+                discard = False
+            elif command == MESSAGE_IDLE or command == MESSAGE_DROP:
+                if command == MESSAGE_DROP or packet_byte or packet_crumb:
+                    events.append((PulseEvent.DROP, bytes(packet[0:packet_byte])))
+                seq = packet_byte = packet_crumb = current = 0
+                transmitted = discard = False
+            else:
+                events.append((PulseEvent.LINE, line))
+        self.seq = seq
+        self.packet_byte = packet_byte
+        self.packet_crumb = packet_crumb
+        self.current = current
+        self.transmitted = transmitted
+        self.discard = discard
+        return events
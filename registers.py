@@ -0,0 +1,230 @@
+"""
+Persistent cache of device register values
+"""
+
+import json
+import os
+
+from const import MdidSet, MdidCoreCmd, MdidCoreReport
+from inflight import mdid
+from links import LinkIndex, LINK_TABLE_START, LINK_TABLE_BYTES, ADDLINK, DELETELINK
+from packet import encode_packet
+from log import getLogger
+
+log = getLogger('registers')
+
+REGISTER_COUNT = 256
+REGISTER_CACHE_PATH = 'registers.json'
+REGISTER_SAVE_DELAY = 5.0
+
+GETREGISTERVALUES = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETREGISTERVALUES)
+SETREGISTERVALUES = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_SETREGISTERVALUES)
+WRITEENABLE = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_WRITEENABLE)
+REGISTERVALUES = mdid(MdidSet.MDID_CORE_REPORTS, MdidCoreReport.MDID_DEVICE_CORE_REPORT_REGISTERVALUES)
+
+
+def register_mask(start, count):
+    return ((1 << count) - 1) << start
+
+
+LINK_TABLE_MASK = register_mask(LINK_TABLE_START, LINK_TABLE_BYTES)
+
+
+class RegisterImage:
+    """
+    Sparse image of a device's register space, known holds one bit per
+    register whose value has been reported.
+    """
+
+    __slots__ = ('values', 'known')
+
+    def __init__(self, values=None, known=0):
+        self.values = bytearray(values if values is not None else REGISTER_COUNT)
+        self.known = known
+
+    def update(self, start, values):
+        values = values[:REGISTER_COUNT - start]
+        self.values[start:start + len(values)] = values
+        self.known |= register_mask(start, len(values))
+
+    def invalidate(self, start=0, count=REGISTER_COUNT):
+        self.known &= ~register_mask(start, min(count, REGISTER_COUNT - start))
+
+    def missing(self, start, count):
+        """
+        Returns (start, count) of the smallest window covering every register
+        of the range that is not known, or None when all of it is.
+        """
+        missing = register_mask(start, count) & ~self.known
+        if not missing:
+            return None
+        first = (missing & -missing).bit_length() - 1
+        return first, missing.bit_length() - first
+
+    def read(self, start, count):
+        return bytes(self.values[start:start + count])
+
+
+class RegisterCache:
+    """
+    Register images per (network, device), loaded from and saved to a JSON
+    file. Reads are answered from the image when every requested register
+    is known, partially known reads are narrowed to the missing window and
+    kept pending as (session, request, window) until the report completes
+    them or the narrowed read fails.
+    The link index is rebuilt for a device once its whole link table is
+    known.
+    """
+
+    def __init__(self, path=REGISTER_CACHE_PATH):
+        self.path = path
+        self.images = {}
+        self.pending = {}
+        self.links = LinkIndex()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self.images)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning("could not load register cache %s: %s", self.path, e)
+            return
+        for key, image in saved.items():
+            network_id, device_id = key.split('/')
+            self.images[(int(network_id), int(device_id))] = \
+                RegisterImage(bytes.fromhex(image['values']), int(image['known'], 16))
+        self.links.build(self.images)
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        saved = {
+            f'{network_id}/{device_id}': {'values': image.values.hex(), 'known': f'{image.known:x}'}
+            for (network_id, device_id), image in self.images.items()
+        }
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def image(self, network_id, device_id):
+        image = self.images.get((network_id, device_id))
+        if image is None:
+            image = self.images[(network_id, device_id)] = RegisterImage()
+        return image
+
+    def report(self, packet):
+        """
+        Stores a register report, returns the pending reads it completed as
+        (session, request packet, report) tuples.
+        """
+        data = packet.data
+        if packet.mdid != REGISTERVALUES or len(data) < 1:
+            return ()
+        key = (packet.network_id, packet.source_id)
+        image = self.image(*key)
+        image.update(data[0], data[1:])
+        self.dirty = True
+        if register_mask(data[0], len(data) - 1) & LINK_TABLE_MASK:
+            self.links.index_image(*key, image)
+        pending = self.pending.get(key)
+        if not pending:
+            return ()
+        completed = []
+        for entry in list(pending):
+            session, request, window = entry
+            start, count = request.data[0], request.data[1]
+            if image.missing(start, count) is None:
+                pending.remove(entry)
+                completed.append((session, request, self.encode_report(request, image)))
+        if not pending:
+            del self.pending[key]
+        return completed
+
+    def command(self, packet):
+        if packet.link_bit:
+            return
+        data = packet.data
+        key = (packet.network_id, packet.destination_id)
+        if packet.mdid == SETREGISTERVALUES and len(data) > 1:
+            image = self.images.get(key)
+            if image is not None:
+                image.invalidate(data[0], len(data) - 1)
+                self.dirty = True
+            if register_mask(data[0], len(data) - 1) & LINK_TABLE_MASK:
+                # the link table is rewritten, its targets are unknown until it is read back
+                self.links.remove_device(*key)
+        elif packet.mdid == ADDLINK or packet.mdid == DELETELINK:
+            self.links.command(packet)
+            image = self.images.get(key)
+            if image is not None:
+                image.invalidate(LINK_TABLE_START, LINK_TABLE_BYTES)
+                self.dirty = True
+        elif packet.mdid == WRITEENABLE:
+            if self.images.pop(key, None) is not None:
+                self.dirty = True
+
+    def encode_report(self, request, image):
+        start, count = request.data[0], request.data[1]
+        return encode_packet(request.network_id, request.source_id, request.destination_id,
+            REGISTERVALUES, bytes((start,)) + image.read(start, count))
+
+    def answer(self, packet, session):
+        """
+        Returns (report, None) when the read is answered from the cache,
+        (None, narrowed request) when only part of it has to be fetched, or
+        (None, None) when the request has to go out unchanged.
+        """
+        data = packet.data
+        if packet.mdid != GETREGISTERVALUES or packet.link_bit or len(data) < 2:
+            return None, None
+        start, count = data[0], data[1]
+        if count == 0 or start + count > REGISTER_COUNT:
+            return None, None
+        key = (packet.network_id, packet.destination_id)
+        image = self.images.get(key)
+        missing = image.missing(start, count) if image is not None else (start, count)
+        if missing is None:
+            self.hits += 1
+            return self.encode_report(packet, image), None
+        self.misses += 1
+        if missing == (start, count):
+            return None, None
+        self.pending.setdefault(key, []).append((session, packet, missing))
+        raw = packet.raw
+        control = ((raw[0] & 0xe0) << 8) | raw[1]
+        return None, encode_packet(packet.network_id, packet.destination_id, packet.source_id,
+            packet.mdid, bytes(missing), control)
+
+    def fail(self, request):
+        """
+        Drops the pending reads waiting on a narrowed request that failed,
+        returns them as (session, request) pairs.
+        """
+        key = (request.network_id, request.destination_id)
+        pending = self.pending.get(key)
+        if not pending:
+            return ()
+        window = (request.data[0], request.data[1])
+        failed = [(session, packet) for session, packet, missing in pending if missing == window]
+        pending[:] = [entry for entry in pending if entry[2] != window]
+        if not pending:
+            del self.pending[key]
+        return failed
+
+    def drop_session(self, session):
+        for key, pending in list(self.pending.items()):
+            pending[:] = [entry for entry in pending if entry[0] is not session]
+            if not pending:
+                del self.pending[key]
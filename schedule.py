@@ -0,0 +1,258 @@
+"""
+Timed link activations run by the proxy
+
+Schedules are loaded from a JSON list:
+
+    [
+        {"at": "18:30", "days": "mon,tue,wed,thu,fri", "network": 1, "link": 5},
+        {"at": "23:00:30", "network": 1, "link": 5, "action": "deactivate"},
+        {"at": "2026-12-24T17:45:00", "network": 1, "link": 9}
+    ]
+
+A time of day repeats on the given days (every day by default), a full
+date and time fires once. Due entries are kept in a hierarchical timer
+wheel driven by a single timer, so inserting and expiring an entry are
+constant time however many there are, and the timer only wakes for
+ticks with something to do.
+"""
+
+import asyncio
+import json
+import math
+import time
+from datetime import datetime, timedelta
+
+from inflight import LatencyStats
+from log import getLogger
+
+log = getLogger('schedule')
+
+SCHEDULE_TICK = 0.02
+SCHEDULE_WHEEL_BITS = 6
+SCHEDULE_WHEEL_LEVELS = 4
+SCHEDULE_MAX_LATE = 60.0
+SCHEDULE_LATENESS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+ALL_DAYS = 0x7f
+
+
+def parse_days(spec):
+    if not spec:
+        return ALL_DAYS
+    mask = 0
+    for day in spec.split(','):
+        mask |= 1 << DAYS.index(day.strip().lower()[:3])
+    return mask
+
+
+class ScheduleEntry:
+    """
+    One timed activation, at is a datetime for a one shot entry or a
+    (hour, minute, second) time of day repeating on the days in the mask.
+    """
+
+    __slots__ = ('network_id', 'link_id', 'activate', 'at', 'days', 'due', 'cancelled')
+
+    def __init__(self, network_id, link_id, at, days=ALL_DAYS, activate=True):
+        self.network_id = network_id
+        self.link_id = link_id
+        self.activate = activate
+        self.at = at
+        self.days = days
+        self.due = None
+        self.cancelled = False
+
+    @classmethod
+    def from_dict(cls, spec):
+        at = spec['at']
+        if 'T' in at:
+            at = datetime.fromisoformat(at)
+        else:
+            at = tuple(int(part) for part in at.split(':'))
+            at = (at + (0, 0))[:3]
+        action = spec.get('action', 'activate')
+        if action not in ('activate', 'deactivate'):
+            raise ValueError(f'unknown schedule action {action}')
+        return cls(spec['network'], spec['link'], at, parse_days(spec.get('days')), action == 'activate')
+
+    def next_after(self, now):
+        """
+        Returns the next datetime at or after now the entry fires, or None
+        once a one shot entry has passed.
+        """
+        if isinstance(self.at, datetime):
+            return self.at if self.at >= now else None
+        hour, minute, second = self.at
+        day = now.replace(hour=hour, minute=minute, second=second, microsecond=0)
+        if day < now:
+            day += timedelta(days=1)
+        for _ in range(7):
+            if self.days & (1 << day.weekday()):
+                return day
+            day += timedelta(days=1)
+        return None
+
+    def __repr__(self):
+        action = 'activate' if self.activate else 'deactivate'
+        return f'ScheduleEntry({action} {self.network_id}/{self.link_id} at {self.at})'
+
+
+def load_schedule(path):
+    with open(path) as f:
+        return [ScheduleEntry.from_dict(spec) for spec in json.load(f)]
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel of levels wheels with 2**bits slots each,
+    level n slots spanning tick * 2**(bits * n) seconds. Entries need a due
+    time and a cancelled flag, cancelled entries are dropped when their
+    slot expires. Entries further out than the top level are parked in
+    its last slot and placed again when it comes round.
+    """
+
+    def __init__(self, now, tick=SCHEDULE_TICK, bits=SCHEDULE_WHEEL_BITS, levels=SCHEDULE_WHEEL_LEVELS):
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = levels
+        self.wheels = [[[] for _ in range(1 << bits)] for _ in range(levels)]
+        self.current = int(now / tick)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def insert(self, entry):
+        self.place(entry, self.current + 1)
+
+    def place(self, entry, earliest):
+        due = max(math.ceil(entry.due / self.tick), earliest)
+        delta = due - self.current
+        for level in range(self.levels):
+            if delta < 1 << (self.bits * (level + 1)):
+                self.wheels[level][(due >> (self.bits * level)) & self.mask].append(entry)
+                break
+        else:
+            top = self.levels - 1
+            self.wheels[top][((self.current >> (self.bits * top)) - 1) & self.mask].append(entry)
+        self.count += 1
+
+    def next_tick(self):
+        """
+        Returns the next tick that has entries due or cascades the next
+        level, the wheel has nothing to do before it.
+        """
+        for offset in range(1, self.mask + 1):
+            if self.wheels[0][(self.current + offset) & self.mask]:
+                return self.current + offset
+        return ((self.current >> self.bits) + 1) << self.bits
+
+    def advance(self, now):
+        """
+        Moves the wheel up to now, returning the entries that came due.
+        """
+        # timers can run a clock resolution early, allow for it and float error
+        target = math.floor(now / self.tick + 1e-3)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            for level in range(1, self.levels):
+                if (self.current >> (self.bits * (level - 1))) & self.mask:
+                    break
+                slot = self.wheels[level][(self.current >> (self.bits * level)) & self.mask]
+                if slot:
+                    cascaded = slot[:]
+                    slot.clear()
+                    self.count -= len(cascaded)
+                    for entry in cascaded:
+                        if not entry.cancelled:
+                            # the current level 0 slot is still to expire below
+                            self.place(entry, self.current)
+            slot = self.wheels[0][self.current & self.mask]
+            if slot:
+                self.count -= len(slot)
+                expired.extend(entry for entry in slot if not entry.cancelled)
+                slot.clear()
+        return expired
+
+
+class ScheduleEngine:
+    """
+    Fires schedule entries through pim.originate(). Due times are kept on
+    the event loop clock, recurring entries are placed again after each
+    firing from the wall clock so DST and clock changes are followed.
+    """
+
+    def __init__(self, pim, entries=(), tick=SCHEDULE_TICK, loop=None):
+        self.pim = pim
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.wheel = TimerWheel(self.loop.time(), tick)
+        self.timer = None
+        self.timer_at = None
+        self.lateness = LatencyStats(SCHEDULE_LATENESS_BUCKETS)
+        self.fired = 0
+        self.skipped = 0
+        for entry in entries:
+            self.add(entry)
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def add(self, entry):
+        at = entry.next_after(datetime.now())
+        if at is None:
+            return False
+        entry.due = self.loop.time() + (at.timestamp() - time.time())
+        self.wheel.insert(entry)
+        self.kick()
+        return True
+
+    def cancel(self, entry):
+        entry.cancelled = True
+
+    def kick(self):
+        if not len(self.wheel):
+            return
+        when = self.wheel.next_tick() * self.wheel.tick
+        if self.timer is not None:
+            if self.timer_at <= when:
+                return
+            self.timer.cancel()
+        self.timer_at = when
+        self.timer = self.loop.call_at(when, self.tick)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def tick(self):
+        self.timer = None
+        now = self.loop.time()
+        for entry in self.wheel.advance(now):
+            self.fire(entry, now)
+        self.kick()
+
+    def fire(self, entry, now):
+        late = now - entry.due
+        if late > SCHEDULE_MAX_LATE or not self.pim.ready.is_set():
+            self.skipped += 1
+            log.warning("skipping %r, %s", entry, f'{late:.0f}s late' if late > SCHEDULE_MAX_LATE else 'PIM not ready')
+        else:
+            self.lateness.observe(max(late, 0.0))
+            self.fired += 1
+            log.debug("firing %r %.3fs late", entry, late)
+            encoder = self.pim.encoder
+            if entry.activate:
+                frame = encoder.activate_link(entry.network_id, entry.link_id)
+            else:
+                frame = encoder.deactivate_link(entry.network_id, entry.link_id)
+            self.pim.originate(frame)
+        if not isinstance(entry.at, datetime):
+            # one second on so a firing a little early does not repeat today
+            at = entry.next_after(datetime.now() + timedelta(seconds=1))
+            if at is not None:
+                entry.due = self.loop.time() + (at.timestamp() - time.time())
+                self.wheel.insert(entry)
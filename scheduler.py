@@ -0,0 +1,221 @@
+"""
+Prioritised transmit queue between clients and the PIM
+"""
+
+import asyncio
+from enum import IntEnum
+from heapq import heappush, heappop
+from itertools import count
+
+from const import PimCommand, UpbTransmission, MdidSet, MdidCoreCmd
+from log import getLogger
+
+log = getLogger('scheduler')
+
+TRANSMIT_MIN_INTERVAL = 0.05
+TRANSMIT_TIMEOUT = 2.0
+TRANSMIT_BUSY_DELAY = 0.25
+TRANSMIT_BUSY_RETRIES = 5
+
+BULK_COMMANDS = frozenset((
+    MdidCoreCmd.MDID_CORE_COMMAND_GETREGISTERVALUES,
+    MdidCoreCmd.MDID_CORE_COMMAND_SETREGISTERVALUES,
+    MdidCoreCmd.MDID_CORE_COMMAND_GETDEVICESIGNATURE,
+    MdidCoreCmd.MDID_CORE_COMMAND_GETSIGNALSTRENGTH,
+    MdidCoreCmd.MDID_CORE_COMMAND_GETNOISELEVEL,
+))
+
+COMPLETE_TRANSMISSIONS = frozenset((
+    UpbTransmission.UPB_TRANSMISSION_ACK,
+    UpbTransmission.UPB_TRANSMISSION_NAK,
+    UpbTransmission.UPB_PIM_ERROR,
+    UpbTransmission.UPB_PIM_REGISTERS,
+))
+
+
+class TransmitPriority(IntEnum):
+    INTERACTIVE = 1
+    NORMAL = 2
+    BULK = 3
+
+
+def transmit_priority(command, packet):
+    if command != PimCommand.UPB_NETWORK_TRANSMIT or packet is None:
+        return TransmitPriority.NORMAL
+    if packet.mdid_set == MdidSet.MDID_DEVICE_CONTROL_COMMANDS:
+        return TransmitPriority.INTERACTIVE
+    if packet.mdid_cmd in BULK_COMMANDS:
+        return TransmitPriority.BULK
+    return TransmitPriority.NORMAL
+
+
+def coalesce_key(command, packet):
+    """
+    Device control commands to the same target supersede each other, any
+    other transmit is only coalesced with an identical one.
+    """
+    if command != PimCommand.UPB_NETWORK_TRANSMIT or packet is None:
+        return None
+    key = (packet.network_id, packet.destination_id, packet.link_bit, packet.mdid)
+    if packet.mdid_set == MdidSet.MDID_DEVICE_CONTROL_COMMANDS:
+        return key
+    return key + (bytes(packet.data),)
+
+
+class TransmitEntry:
+    """
+    A queued transmit, ordered by priority then submission order. frame
+    is None once a later submit has superseded it.
+    """
+
+    __slots__ = ('priority', 'order', 'frame', 'key', 'needs_ack', 'retries', 'packet', 'owner')
+
+    def __init__(self, priority, order, frame, key=None, needs_ack=False, packet=None, owner=None):
+        self.priority = priority
+        self.order = order
+        self.frame = frame
+        self.key = key
+        self.needs_ack = needs_ack
+        self.retries = 0
+        self.packet = packet
+        self.owner = owner
+
+    def __lt__(self, other):
+        return (self.priority, self.order) < (other.priority, other.order)
+
+
+class TransmitScheduler:
+    """
+    Sends one PIM command at a time, waiting for the PIM to report the
+    outcome (or a timeout) before the next, and retries on PIM busy.
+    While paused everything submitted is held until resume().
+    Each queued TransmitEntry has an owner, the client session a command
+    is sent for or None for the proxy's own. sent is called with the packet and owner of each network
+    transmit as it is written, dropped with those of one given up on after
+    the PIM stayed busy.
+    """
+
+    def __init__(self, write, sent=None, loop=None, min_interval=TRANSMIT_MIN_INTERVAL,
+                 timeout=TRANSMIT_TIMEOUT, busy_delay=TRANSMIT_BUSY_DELAY, dropped=None):
+        self.write = write
+        self.sent = sent
+        self.dropped = dropped
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.busy_delay = busy_delay
+        self.queue = []
+        self.queued = {}
+        self.order = count()
+        self.outstanding = None
+        self.timer = None
+        self.last_send = 0.0
+        self.coalesced = 0
+        self.paused = False
+
+    def __len__(self):
+        return sum(1 for entry in self.queue if entry.frame is not None)
+
+    def close(self):
+        self.cancel_timer()
+        self.queue.clear()
+        self.queued.clear()
+        self.outstanding = None
+
+    def pause(self):
+        """
+        Holds the queue, putting back a transmit still waiting for its
+        outcome so it is sent again on resume.
+        """
+        self.paused = True
+        self.cancel_timer()
+        entry = self.outstanding
+        self.outstanding = None
+        if entry is not None and (entry.key is None or entry.key not in self.queued):
+            heappush(self.queue, entry)
+            if entry.key is not None:
+                self.queued[entry.key] = entry
+
+    def resume(self):
+        self.paused = False
+        self.kick()
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def submit(self, frame, priority=TransmitPriority.NORMAL, key=None, needs_ack=False, packet=None, owner=None):
+        if key is not None:
+            previous = self.queued.pop(key, None)
+            if previous is not None:
+                previous.frame = None
+                self.coalesced += 1
+                log.debug("coalesced transmit %s", key)
+                if owner is None:
+                    # a client whose command is superseded still waits for the outcome
+                    owner = previous.owner
+        entry = TransmitEntry(priority, next(self.order), frame, key, needs_ack, packet, owner)
+        heappush(self.queue, entry)
+        if key is not None:
+            self.queued[key] = entry
+        self.kick()
+
+    def kick(self):
+        if self.paused or self.outstanding is not None or self.timer is not None:
+            return
+        while self.queue:
+            delay = self.last_send + self.min_interval - self.loop.time()
+            if delay > 0:
+                self.timer = self.loop.call_later(delay, self.timer_fired)
+                return
+            entry = heappop(self.queue)
+            if entry.frame is None:
+                continue
+            if entry.key is not None:
+                self.queued.pop(entry.key, None)
+            self.outstanding = entry
+            self.last_send = self.loop.time()
+            self.write(entry.frame)
+            if self.sent is not None and entry.packet is not None:
+                self.sent(entry.packet, entry.owner)
+            self.timer = self.loop.call_later(self.timeout, self.timed_out)
+            return
+
+    def timer_fired(self):
+        self.timer = None
+        self.kick()
+
+    def timed_out(self):
+        self.timer = None
+        log.warning("no PIM response to transmit, sending next")
+        self.complete()
+
+    def complete(self):
+        self.cancel_timer()
+        self.outstanding = None
+        self.kick()
+
+    def transmission(self, transmission):
+        entry = self.outstanding
+        if entry is None:
+            return
+        if transmission == UpbTransmission.UPB_PIM_ACCEPT:
+            if not entry.needs_ack:
+                self.complete()
+        elif transmission == UpbTransmission.UPB_PIM_BUSY:
+            self.cancel_timer()
+            self.outstanding = None
+            entry.retries += 1
+            if entry.retries > TRANSMIT_BUSY_RETRIES:
+                log.warning("PIM busy, dropping transmit after %d retries", TRANSMIT_BUSY_RETRIES)
+                if self.dropped is not None and entry.packet is not None:
+                    self.dropped(entry.packet, entry.owner)
+            elif entry.key is None or entry.key not in self.queued:
+                # keep its original order so it goes ahead of its peers
+                heappush(self.queue, entry)
+                if entry.key is not None:
+                    self.queued[entry.key] = entry
+            self.timer = self.loop.call_later(self.busy_delay, self.timer_fired)
+        elif transmission in COMPLETE_TRANSMISSIONS:
+            self.complete()
@@ -0,0 +1,450 @@
+"""
+Local stand-in for a UPB PIM gateway and capture replayer
+
+    python simulator.py [--port 2101] [--username U --password P] [--pulse] [--files DIR [--refuse-pipelined]]
+    python simulator.py --replay FILE [--speed 0]
+    python simulator.py --replay FILE --client HOST:PORT [--speed 1]
+
+The first form serves simulated devices, the second replays the PIM side
+of a capture to every client that connects and the third plays the
+client side of a capture into a running proxy. A speed of 0 replays as
+fast as the connection accepts the data. With --files the gateway file
+commands, as laid out in files.py, work on the files in DIR. With
+--refuse-pipelined file commands are answered after a short delay and a
+read or write arriving before the earlier ones are answered is refused,
+like a gateway that handles one at a time.
+"""
+
+import argparse
+import asyncio
+import hmac
+import os
+from binascii import hexlify, unhexlify
+from struct import pack
+
+from capture import CaptureReader, CaptureDirection
+from const import PimCommand, UpbMessage, UpbTransmission, UpbReg, GatewayCmd, MdidSet, MdidCoreCmd, \
+MdidDeviceControlCmd, MdidCoreReport, GATEWAY_REQUEST_HEADER_BYTES, GATEWAY_REQUEST_LENGTH_OFFSET, \
+GATEWAY_TRAILER_BYTES
+from framer import Framer, encode_gateway_response
+from inflight import mdid
+from log import getLogger, setup_logging
+from packet import decode_packet, encode_packet
+from util import cksum
+
+log = getLogger('simulator')
+
+SIM_VERSION = b'1.0'
+SIM_PIM_ID = 0xff
+SIM_SIGNATURE = b'\x55\xaa\x55\xaa'
+SIM_FILE_ERROR = 0x01
+SIM_FILE_DELAY = 0.01
+
+GETDEVICESTATUS = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETDEVICESTATUS)
+GETSIGNALSTRENGTH = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETSIGNALSTRENGTH)
+GETNOISELEVEL = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETNOISELEVEL)
+GETDEVICESIGNATURE = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETDEVICESIGNATURE)
+GETREGISTERVALUES = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETREGISTERVALUES)
+SETREGISTERVALUES = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_SETREGISTERVALUES)
+GOTO = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS, MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_GOTO)
+FADESTART = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS, MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_FADESTART)
+REPORTSTATE = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS, MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_REPORTSTATE)
+
+
+def report_mdid(report):
+    return mdid(MdidSet.MDID_CORE_REPORTS, report)
+
+
+def pulse_lines(packet):
+    """
+    Pulse mode lines for a received packet, as assembled by PulseDecoder.
+    """
+    lines = [bytes((UpbMessage.UPB_MESSAGE_START, 0x30))]
+    seq = 0
+    for byte in packet:
+        for shift in (6, 4, 2, 0):
+            lines.append(bytes((0x30 + ((byte >> shift) & 0x03), 0x30, b'0123456789ABCDEF'[seq])))
+            seq = (seq + 1) & 0x0f
+    lines.append(bytes((UpbMessage.UPB_MESSAGE_ACK, 0x30)))
+    return lines
+
+
+class SimulatedDevice:
+    """
+    A device answering the core and device control commands from its
+    register image and channel levels.
+    """
+
+    def __init__(self, network_id, device_id, channels=1, manufacturer=4, product=1):
+        self.network_id = network_id
+        self.device_id = device_id
+        self.levels = bytearray(channels)
+        self.registers = bytearray(256)
+        self.registers[UpbReg.UPB_REG_NETWORKID] = network_id
+        self.registers[UpbReg.UPB_REG_MODULEID] = device_id
+        self.registers[UpbReg.UPB_REG_MANUFACTURERID + 1] = manufacturer
+        self.registers[UpbReg.UPB_REG_PRODUCTID + 1] = product
+        name = f'DEVICE {device_id}'.encode('ascii')
+        self.registers[UpbReg.UPB_REG_DEVICENAME:UpbReg.UPB_REG_DEVICENAME + len(name)] = name
+        self.registers[UpbReg.UPB_REG_SIGNALSTRENGTH] = 0x40
+        self.registers[UpbReg.UPB_REG_NOISEFLOOR] = 0x02
+
+    def handle(self, packet):
+        """
+        Returns a list of (report mdid, data) replies to a command.
+        """
+        command = packet.mdid
+        data = packet.data
+        if command == GETDEVICESTATUS:
+            return [(report_mdid(MdidCoreReport.MDID_DEVICE_CORE_REPORT_DEVICESTATUS), bytes(self.levels))]
+        if command == REPORTSTATE:
+            return [(report_mdid(MdidCoreReport.MDID_DEVICE_CORE_REPORT_DEVICESTATE), bytes(self.levels))]
+        if command == GETREGISTERVALUES and len(data) >= 2:
+            start, count = data[0], min(data[1], 16)
+            return [(report_mdid(MdidCoreReport.MDID_DEVICE_CORE_REPORT_REGISTERVALUES),
+                bytes((start,)) + bytes(self.registers[start:start + count]))]
+        if command == SETREGISTERVALUES and len(data) >= 2:
+            self.registers[data[0]:data[0] + len(data) - 1] = data[1:]
+        elif command == GETSIGNALSTRENGTH:
+            return [(report_mdid(MdidCoreReport.MDID_DEVICE_CORE_REPORT_SIGNALSTRENGTH),
+                bytes((self.registers[UpbReg.UPB_REG_SIGNALSTRENGTH],)))]
+        elif command == GETNOISELEVEL:
+            return [(report_mdid(MdidCoreReport.MDID_DEVICE_CORE_REPORT_NOISELEVEL),
+                bytes((self.registers[UpbReg.UPB_REG_NOISEFLOOR], self.registers[UpbReg.UPB_REG_NOISECOUNTS])))]
+        elif command == GETDEVICESIGNATURE:
+            return [(report_mdid(MdidCoreReport.MDID_DEVICE_CORE_REPORT_DEVICESIGNATURE), SIM_SIGNATURE)]
+        elif (command == GOTO or command == FADESTART) and len(data) >= 1:
+            channel = data[2] if len(data) > 2 else 0
+            if channel == 0:
+                self.levels[:] = bytes((data[0],)) * len(self.levels)
+            elif channel <= len(self.levels):
+                self.levels[channel - 1] = data[0]
+        return []
+
+
+class SimulatedNetwork:
+    """
+    Devices by (network, device) id. script maps (device id, mdid) to a
+    list of (report mdid, data) replies or a callable returning one, and
+    overrides the simulated device.
+    """
+
+    def __init__(self, network_id=1, device_ids=range(1, 11), script=None):
+        self.network_id = network_id
+        self.devices = {(network_id, device_id): SimulatedDevice(network_id, device_id)
+            for device_id in device_ids}
+        self.script = script if script is not None else {}
+
+    def handle(self, packet):
+        scripted = self.script.get((packet.destination_id, packet.mdid))
+        if scripted is not None:
+            return True, scripted(packet) if callable(scripted) else scripted
+        device = self.devices.get((packet.network_id, packet.destination_id))
+        if device is None or packet.link_bit:
+            return packet.link_bit, []
+        return True, device.handle(packet)
+
+
+class SimulatedPIM(asyncio.Protocol):
+    """
+    One gateway connection: banner and auth handshake on NUL terminated
+    lines, then PIM commands in SEND_TO_SERIAL frames (or CR lines when no
+    auth is configured) answered with accept, ACK/NAK and device reports.
+    """
+
+    def __init__(self, network, username=None, password=None, pulse=False, latency=0.0, replay=None, speed=0.0,
+                 files=None, refuse_pipelined=False):
+        self.network = network
+        self.files = files
+        self.refuse_pipelined = refuse_pipelined
+        # file command responses still to be written when refusing pipelined ones
+        self.file_responses = []
+        self.reading = None
+        self.writing = None
+        self.username = username
+        self.password = password
+        self.pulse = pulse
+        self.latency = latency
+        self.replay = replay
+        self.speed = speed
+        self.framer = Framer()
+        self.wrapped = False
+        self.challenge = None
+        self.protocol = None
+        self.replaying = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def connection_made(self, transport):
+        log.info("client connected to simulator")
+        self.transport = transport
+
+    def connection_lost(self, *args):
+        log.info("client disconnected from simulator")
+        if self.replaying is not None:
+            self.replaying.cancel()
+        for f in (self.reading, self.writing):
+            if f is not None:
+                f.close()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def send_line(self, line):
+        if self.wrapped:
+            self.transport.write(encode_gateway_response(GatewayCmd.SEND_TO_SERIAL, line + b'\r'))
+        else:
+            self.transport.write(line + b'\r')
+
+    def send_report(self, transmission, data=b''):
+        self.send_line(bytes((UpbMessage.UPB_MESSAGE_PIMREPORT, transmission)) + data)
+
+    def send_packet(self, packet):
+        if self.pulse:
+            for line in pulse_lines(packet):
+                self.send_line(line)
+        else:
+            self.send_report(UpbTransmission.UPB_MESSAGE, hexlify(packet).upper())
+
+    def later(self, callback, *args):
+        if self.latency:
+            asyncio.get_event_loop().call_later(self.latency, callback, *args)
+        else:
+            callback(*args)
+
+    def nt_line_received(self, line):
+        if self.challenge is None:
+            self.protocol = line.split(b'/', maxsplit=2)[2]
+            if self.password is None:
+                self.challenge = b''
+                self.transport.write(b'PIM/' + SIM_VERSION + b'/' + self.protocol + b'/NO AUTH/00\x00')
+                return
+            self.challenge = os.urandom(64)
+            self.transport.write(b'PIM/' + SIM_VERSION + b'/' + self.protocol + b'/AUTH REQUIRED/' +
+                hexlify(self.challenge) + b'\x00')
+        elif self.password is not None and not self.wrapped:
+            username, digest = line.split(b'/', maxsplit=1)
+            expected = hmac.new(self.password.encode('utf-8'), self.challenge, 'md5').hexdigest().swapcase().encode('ascii')
+            if username == (self.username or '').encode('utf-8') and hmac.compare_digest(digest, expected):
+                self.transport.write(b'AUTH SUCCEEDED/' + username + b'\x00')
+                self.wrapped = True
+            else:
+                self.transport.write(b'AUTHENTICATION FAILED/' + username + b'\x00')
+                self.transport.close()
+
+    def line_received(self, line):
+        try:
+            command = PimCommand(line[0])
+            data = unhexlify(line[1:])
+        except ValueError:
+            self.send_report(UpbTransmission.UPB_PIM_ERROR)
+            return
+        if len(data) < 2 or cksum(data[:-1]) != data[-1]:
+            self.send_report(UpbTransmission.UPB_PIM_ERROR)
+            return
+        if command == PimCommand.UPB_NETWORK_TRANSMIT:
+            packet = decode_packet(data)
+            acked, reports = self.network.handle(packet)
+            self.send_report(UpbTransmission.UPB_PIM_ACCEPT)
+            self.later(self.transmitted, packet, acked, reports)
+        elif command == PimCommand.UPB_PIM_READ:
+            start, count = data[0], data[1]
+            self.send_report(UpbTransmission.UPB_PIM_REGISTERS, hexlify(bytes((start,)) + bytes(count)).upper())
+        else:
+            self.send_report(UpbTransmission.UPB_PIM_ACCEPT)
+
+    def transmitted(self, packet, acked, reports):
+        if self.transport.is_closing():
+            return
+        self.send_report(UpbTransmission.UPB_TRANSMISSION_ACK if acked else UpbTransmission.UPB_TRANSMISSION_NAK)
+        for report, data in reports:
+            self.send_packet(encode_packet(packet.network_id, packet.source_id, packet.destination_id, report, data))
+
+    def data_received(self, data):
+        if self.replay is not None:
+            if self.replaying is None:
+                self.replaying = asyncio.ensure_future(replay(self.replay, CaptureDirection.FROM_PIM,
+                    self.transport.write, self.writable, self.speed))
+            return
+        self.framer.feed(data)
+        if self.wrapped:
+            for cmd, frame, payload in self.framer.gateway_frames(GATEWAY_REQUEST_HEADER_BYTES,
+                    GATEWAY_REQUEST_LENGTH_OFFSET, GATEWAY_TRAILER_BYTES):
+                if cmd == GatewayCmd.SEND_TO_SERIAL:
+                    self.line_received(bytes(payload[:-1]))
+                elif cmd == GatewayCmd.KEEP_ALIVE:
+                    self.transport.write(encode_gateway_response(GatewayCmd.KEEP_ALIVE, b''))
+                elif self.files is not None:
+                    self.file_received(cmd, bytes(payload))
+        else:
+            for line in self.framer.lines(b'\x00'):
+                if len(line) > 0:
+                    self.nt_line_received(bytes(line))
+            if not self.wrapped:
+                for line in self.framer.lines(b'\r'):
+                    if len(line) > 0:
+                        self.line_received(bytes(line))
+
+    def file_received(self, cmd, payload):
+        if self.refuse_pipelined and self.file_responses and \
+                (cmd == GatewayCmd.FILE_READ or cmd == GatewayCmd.FILE_WRITE):
+            log.info("refusing pipelined %s", cmd.name)
+            response = file_error(cmd)
+        else:
+            try:
+                response = encode_gateway_response(cmd, self.file_command(cmd, payload))
+            except (OSError, ValueError, AttributeError) as e:
+                log.info("%s failed: %s", cmd.name, e)
+                response = file_error(cmd)
+        if not self.refuse_pipelined:
+            self.transport.write(response)
+            return
+        if not self.file_responses:
+            asyncio.get_event_loop().call_later(SIM_FILE_DELAY, self.file_answered)
+        self.file_responses.append(response)
+
+    def file_answered(self):
+        if not self.transport.is_closing():
+            self.transport.write(b''.join(self.file_responses))
+        self.file_responses.clear()
+
+    def file_path(self, payload):
+        name = payload.split(b'\x00', 1)[0].decode('latin-1')
+        if not name or os.path.basename(name) != name:
+            raise ValueError(f'bad file name {name!r}')
+        return os.path.join(self.files, name)
+
+    def file_command(self, cmd, payload):
+        """
+        Returns the response payload of a file command, raising on failure.
+        """
+        if cmd == GatewayCmd.DIR_LISTING:
+            return b''.join(name.encode('latin-1') + b'\x00' +
+                pack('>I', os.path.getsize(os.path.join(self.files, name)))
+                for name in sorted(os.listdir(self.files)))
+        if cmd == GatewayCmd.FILE_READ_OPEN:
+            self.reading = open(self.file_path(payload), 'rb')
+            return b''
+        if cmd == GatewayCmd.FILE_READ_SIZE:
+            return pack('>I', os.fstat(self.reading.fileno()).st_size)
+        if cmd == GatewayCmd.FILE_READ:
+            offset = int.from_bytes(payload[:4], 'big')
+            self.reading.seek(offset)
+            return payload[:4] + self.reading.read(int.from_bytes(payload[4:6], 'big'))
+        if cmd == GatewayCmd.FILE_READ_CLOSE:
+            self.reading.close()
+            self.reading = None
+            return b''
+        if cmd == GatewayCmd.FILE_WRITE_OPEN:
+            self.writing = open(self.file_path(payload), 'wb')
+            return b''
+        if cmd == GatewayCmd.FILE_WRITE_SIZE:
+            self.writing.truncate(int.from_bytes(payload[:4], 'big'))
+            return b''
+        if cmd == GatewayCmd.FILE_WRITE:
+            self.writing.seek(int.from_bytes(payload[:4], 'big'))
+            self.writing.write(payload[4:])
+            return payload[:4]
+        if cmd == GatewayCmd.FILE_WRITE_CLOSE:
+            self.writing.close()
+            self.writing = None
+            return b''
+        if cmd == GatewayCmd.FILE_READ_DELETE:
+            os.unlink(self.file_path(payload))
+            return b''
+        raise ValueError(f'{cmd.name} not simulated')
+
+
+def file_error(cmd):
+    frame = bytearray(encode_gateway_response(cmd, b''))
+    frame[1] = SIM_FILE_ERROR
+    frame[-1] = cksum(frame[:-1])
+    return bytes(frame)
+
+
+async def replay(path, direction, write, writable, speed=0.0):
+    """
+    Writes the records of one direction of a capture, spaced by their
+    recorded intervals divided by speed, or back to back when speed is 0.
+    """
+    loop = asyncio.get_event_loop()
+    count = 0
+    with CaptureReader(path) as reader:
+        first = None
+        started = loop.time()
+        for timestamp, record_direction, data in reader:
+            if record_direction != direction:
+                data.release()
+                continue
+            if first is None:
+                first = timestamp
+            if speed > 0:
+                delay = started + (timestamp - first) / 1e9 / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            write(bytes(data))
+            data.release()
+            count += 1
+            if not writable.is_set():
+                await writable.wait()
+    log.info("replayed %d records from %s", count, path)
+    return count
+
+
+class ReplayClient(asyncio.Protocol):
+
+    def __init__(self):
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Simulated UPB PIM gateway')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2101)
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--network', type=int, default=1)
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--pulse', action='store_true')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--replay')
+    parser.add_argument('--speed', type=float, default=0.0)
+    parser.add_argument('--client')
+    parser.add_argument('--files')
+    parser.add_argument('--refuse-pipelined', action='store_true')
+    args = parser.parse_args()
+
+    listener = setup_logging(os.environ.get('UPBSHARK_LOG_LEVEL', 'INFO').upper())
+    loop = asyncio.get_event_loop()
+    try:
+        if args.client:
+            host, port = args.client.rsplit(':', 1)
+            transport, protocol = await loop.create_connection(ReplayClient, host, int(port))
+            await replay(args.replay, CaptureDirection.FROM_CLIENT, transport.write, protocol.writable, args.speed)
+            transport.close()
+            return
+        network = SimulatedNetwork(args.network, range(1, args.devices + 1))
+        server = await loop.create_server(lambda: SimulatedPIM(network, args.username, args.password,
+            args.pulse, args.latency, args.replay, args.speed, args.files, args.refuse_pipelined),
+            args.host, args.port)
+        async with server:
+            await server.serve_forever()
+    finally:
+        listener.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,159 @@
+"""
+Cache of device state and status reports
+"""
+
+import time
+
+from const import MdidSet, MdidDeviceControlCmd, MdidCoreReport
+from inflight import REPORTS, mdid
+from links import LinkIndex, LAST_LEVEL
+from packet import encode_packet
+from log import getLogger
+
+log = getLogger('state')
+
+DEVICE_STATE_TTL = 30.0
+
+STATE_REPORT = mdid(MdidSet.MDID_CORE_REPORTS, MdidCoreReport.MDID_DEVICE_CORE_REPORT_DEVICESTATE)
+STATUS_REPORT = mdid(MdidSet.MDID_CORE_REPORTS, MdidCoreReport.MDID_DEVICE_CORE_REPORT_DEVICESTATUS)
+CACHED_REPORTS = frozenset((STATE_REPORT, STATUS_REPORT))
+
+GOTO = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS, MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_GOTO)
+FADESTART = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS, MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_FADESTART)
+FADESTOP = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS, MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_FADESTOP)
+BLINK = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS, MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_BLINK)
+ACTIVATELINK = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS, MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_ACTIVATELINK)
+DEACTIVATELINK = mdid(MdidSet.MDID_DEVICE_CONTROL_COMMANDS,
+    MdidDeviceControlCmd.MDID_DEVICE_CONTROL_COMMAND_DEACTIVATELINK)
+OUTPUT_COMMANDS = frozenset((GOTO, FADESTART, FADESTOP, BLINK, ACTIVATELINK, DEACTIVATELINK))
+
+
+class DeviceState:
+
+    __slots__ = ('data', 'updated')
+
+    def __init__(self, data, updated):
+        self.data = data
+        self.updated = updated
+
+
+class DeviceStateCache:
+    """
+    Last state (0x86) and status (0x87) report data per (network, device).
+    Entries are only created by reports. Acknowledged GOTO and FADESTART
+    update the cached levels, anything else that changes a device's output
+    invalidates it until the device reports again. Link commands are
+    applied to every device the link index lists for the link.
+    """
+
+    def __init__(self, ttl=DEVICE_STATE_TTL, links=None, clock=time.monotonic):
+        self.ttl = ttl
+        self.links = links if links is not None else LinkIndex()
+        self.clock = clock
+        self.reports = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.reports)
+
+    def report(self, packet):
+        if packet.mdid in CACHED_REPORTS:
+            self.reports[(packet.network_id, packet.source_id, packet.mdid)] = \
+                DeviceState(bytes(packet.data), self.clock())
+
+    def set_level(self, network_id, device_id, level, channel=0):
+        key = (network_id, device_id, STATE_REPORT)
+        state = self.reports.get(key)
+        if state is None:
+            # the channel count is only known once the device has reported
+            return
+        levels = bytearray(state.data)
+        if channel == 0:
+            levels[:] = bytes((level,)) * len(levels)
+        elif channel <= len(levels):
+            levels[channel - 1] = level
+        else:
+            return
+        self.reports[key] = DeviceState(bytes(levels), self.clock())
+
+    def invalidate(self, network_id, device_id):
+        self.reports.pop((network_id, device_id, STATE_REPORT), None)
+        self.reports.pop((network_id, device_id, STATUS_REPORT), None)
+
+    def link_command(self, packet):
+        network_id = packet.network_id
+        targets = self.links.targets(network_id, packet.destination_id)
+        if not targets:
+            return
+        command = packet.mdid
+        data = packet.data
+        reports = self.reports
+        for target in targets:
+            device_id = target.device_id
+            if command == ACTIVATELINK:
+                level = target.level
+            elif command == DEACTIVATELINK:
+                level = 0
+            elif (command == GOTO or command == FADESTART) and len(data) > 0:
+                level = data[0]
+            else:
+                level = LAST_LEVEL
+            if level == LAST_LEVEL:
+                self.invalidate(network_id, device_id)
+            else:
+                reports.pop((network_id, device_id, STATUS_REPORT), None)
+                self.set_level(network_id, device_id, level, target.channel)
+        log.debug("link %d updated %d devices", packet.destination_id, len(targets))
+
+    def command(self, packet):
+        if packet.mdid_set != MdidSet.MDID_DEVICE_CONTROL_COMMANDS:
+            return
+        if packet.link_bit:
+            self.link_command(packet)
+            return
+        network_id = packet.network_id
+        device_id = packet.destination_id
+        data = packet.data
+        if (packet.mdid == GOTO or packet.mdid == FADESTART) and len(data) > 0:
+            self.reports.pop((network_id, device_id, STATUS_REPORT), None)
+            self.set_level(network_id, device_id, data[0], data[2] if len(data) > 2 else 0)
+        elif packet.mdid == FADESTOP or packet.mdid == BLINK:
+            self.invalidate(network_id, device_id)
+
+    def forget(self, packet):
+        """
+        Invalidates the devices a command seen on the network changes, it is
+        not known whether they received it.
+        """
+        if packet.mdid not in OUTPUT_COMMANDS:
+            return
+        if not packet.link_bit:
+            self.invalidate(packet.network_id, packet.destination_id)
+            return
+        for target in self.links.targets(packet.network_id, packet.destination_id):
+            self.invalidate(packet.network_id, target.device_id)
+
+    def lookup(self, network_id, device_id, report_mdid):
+        state = self.reports.get((network_id, device_id, report_mdid))
+        if state is None or self.clock() - state.updated > self.ttl:
+            return None
+        return state.data
+
+    def answer(self, packet):
+        """
+        Returns the raw report packet answering a state or status query from
+        the cache, or None when the query has to go to the device.
+        """
+        if packet.link_bit:
+            return None
+        report_mdid = REPORTS.get(packet.mdid)
+        if report_mdid not in CACHED_REPORTS:
+            return None
+        data = self.lookup(packet.network_id, packet.destination_id, report_mdid)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        log.debug("answering %#x for device %d from cache", packet.mdid, packet.destination_id)
+        return encode_packet(packet.network_id, packet.source_id, packet.destination_id, report_mdid, data)
@@ -0,0 +1,207 @@
+"""
+Proxies many PIM gateways from a pool of worker processes
+
+    python supervisor.py gateways.json
+
+The config lists the gateways and how many workers to spread them over:
+
+    {
+        "workers": 2,
+        "log_level": "INFO",
+        "metrics_port": 9101,
+        "gateways": [
+            {"name": "home", "host": "192.168.1.20", "port": 2101, "listen_port": 2101,
+             "username": "user", "password": "secret"},
+            {"name": "office", "host": "10.0.0.20", "port": 2101, "listen_port": 2102}
+        ]
+    }
+
+Each gateway gets its own listen port, optional listen_host, state_ttl,
+dedupe_window, register_cache (registers-<name>.json by default, null to
+keep it in memory), capture file, events_port (with events_host),
+schedule file, keepalive_interval, pim_timeout, session_timeout and
+idle_timeout.
+Gateways are assigned to workers round robin. Each worker runs its own
+event loop and serves metrics on metrics_port plus its index. The
+supervisor restarts workers that exit.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import signal
+import sys
+import time
+
+from capture import CaptureWriter, CAPTURE_MAX_BYTES
+from dedupe import DEDUPE_WINDOW
+from log import getLogger, setup_logging
+from metrics import start_metrics_server
+from proxy import serve_gateway, PIM_KEEPALIVE_INTERVAL, PIM_TIMEOUT, SESSION_TIMEOUT, SESSION_IDLE_TIMEOUT
+from state import DEVICE_STATE_TTL
+
+log = getLogger('supervisor')
+
+WORKER_RESTART_MIN_DELAY = 1.0
+WORKER_RESTART_MAX_DELAY = 30.0
+WORKER_STABLE_TIME = 60.0
+WORKER_STOP_TIMEOUT = 5.0
+SUPERVISOR_POLL_INTERVAL = 0.5
+
+
+def load_config(path):
+    with open(path) as f:
+        config = json.load(f)
+    gateways = config.get('gateways')
+    if not gateways:
+        raise ValueError(f'{path}: no gateways configured')
+    names = set()
+    ports = set()
+    for index, gateway in enumerate(gateways):
+        for key in ('host', 'port', 'listen_port'):
+            if key not in gateway:
+                raise ValueError(f'{path}: gateway {index} has no {key}')
+        gateway.setdefault('name', str(index))
+        if gateway['name'] in names:
+            raise ValueError(f'{path}: duplicate gateway name {gateway["name"]}')
+        listen = (gateway.get('listen_host', '0.0.0.0'), gateway['listen_port'])
+        if listen in ports:
+            raise ValueError(f'{path}: gateway {gateway["name"]} reuses listen port {listen[1]}')
+        names.add(gateway['name'])
+        ports.add(listen)
+    config['workers'] = max(1, min(int(config.get('workers', 1)), len(gateways)))
+    return config
+
+
+def assign_workers(gateways, workers):
+    return [gateways[index::workers] for index in range(workers)]
+
+
+async def serve_gateways(gateways, metrics_port=None):
+    if metrics_port:
+        await start_metrics_server('0.0.0.0', metrics_port)
+    captures = []
+    tasks = []
+    for gateway in gateways:
+        name = gateway['name']
+        capture = None
+        if gateway.get('capture'):
+            capture = CaptureWriter(gateway['capture'], gateway.get('capture_max_bytes', CAPTURE_MAX_BYTES))
+            captures.append(capture)
+        tasks.append(serve_gateway(gateway['host'], gateway['port'], gateway.get('username'),
+            gateway.get('password'), gateway.get('listen_host', '0.0.0.0'), gateway['listen_port'],
+            gateway.get('state_ttl', DEVICE_STATE_TTL), gateway.get('register_cache', f'registers-{name}.json'),
+            capture, gateway.get('dedupe_window', DEDUPE_WINDOW), gateway.get('events_host', '127.0.0.1'),
+            gateway.get('events_port'), gateway.get('schedule'),
+            gateway.get('keepalive_interval', PIM_KEEPALIVE_INTERVAL), gateway.get('pim_timeout', PIM_TIMEOUT),
+            gateway.get('session_timeout', SESSION_TIMEOUT), gateway.get('idle_timeout', SESSION_IDLE_TIMEOUT),
+            gateway=name))
+    gathered = asyncio.gather(*tasks)
+    # stop cleanly on terminate so register caches are saved
+    asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, gathered.cancel)
+    try:
+        await gathered
+    except asyncio.CancelledError:
+        log.info("worker stopping")
+    finally:
+        for capture in captures:
+            capture.close()
+
+
+def run_worker(index, gateways, log_level, metrics_port):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    listener = setup_logging(log_level)
+    log.info("worker %d serving %s", index, ', '.join(gateway['name'] for gateway in gateways))
+    try:
+        asyncio.run(serve_gateways(gateways, metrics_port))
+    finally:
+        listener.stop()
+
+
+class Worker:
+
+    def __init__(self, index, gateways, log_level, metrics_port):
+        self.index = index
+        self.gateways = gateways
+        self.log_level = log_level
+        self.metrics_port = metrics_port
+        self.process = None
+        self.started = 0.0
+        self.delay = WORKER_RESTART_MIN_DELAY
+        self.restart_at = 0.0
+
+    def start(self, context):
+        self.process = context.Process(target=run_worker, name=f'upbshark-worker-{self.index}',
+            args=(self.index, self.gateways, self.log_level, self.metrics_port))
+        self.process.start()
+        self.started = time.monotonic()
+
+    def exited(self, now):
+        """
+        Schedules the restart of a worker that exited.
+        """
+        if now - self.started > WORKER_STABLE_TIME:
+            self.delay = WORKER_RESTART_MIN_DELAY
+        log.error("worker %d exited with %s, restarting in %.0fs", self.index, self.process.exitcode, self.delay)
+        self.process = None
+        self.restart_at = now + self.delay
+        self.delay = min(self.delay * 2, WORKER_RESTART_MAX_DELAY)
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.terminate()
+        self.process.join(WORKER_STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+def supervise(config):
+    context = multiprocessing.get_context('spawn')
+    log_level = config.get('log_level', 'INFO').upper()
+    metrics_port = config.get('metrics_port')
+    workers = [Worker(index, gateways, log_level, metrics_port + index if metrics_port else None)
+        for index, gateways in enumerate(assign_workers(config['gateways'], config['workers']))]
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for worker in workers:
+        worker.start(context)
+    try:
+        while not stopping:
+            time.sleep(SUPERVISOR_POLL_INTERVAL)
+            now = time.monotonic()
+            for worker in workers:
+                # workers get the same SIGINT and exit with the supervisor, they are not restarted then
+                if stopping:
+                    break
+                if worker.process is not None and not worker.process.is_alive():
+                    worker.exited(now)
+                elif worker.process is None and now >= worker.restart_at:
+                    worker.start(context)
+    finally:
+        log.info("stopping workers")
+        for worker in workers:
+            worker.stop()
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(f'usage: {sys.argv[0]} CONFIG', file=sys.stderr)
+        sys.exit(2)
+    config = load_config(sys.argv[1])
+    listener = setup_logging(config.get('log_level', 'INFO').upper())
+    try:
+        supervise(config)
+    finally:
+        listener.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""
+Signal strength and noise survey of every device ID on a network
+
+    python survey.py [--username U --password P] [--network 1] [--devices 1-250] HOST PORT
+
+Each device ID is asked for its signal strength and, when it answers,
+its noise level. Requests are pipelined through the PIM's transmit
+scheduler with a window of devices in flight that grows while reports
+come back and halves on PIM busy, on lost reports and on NAKs from
+devices that have answered before. IDs that NAK the first request are
+reported absent. Prints one JSON row per device.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from const import MdidSet, MdidCoreCmd, UpbTransmission
+from inflight import REPORTS, mdid
+from log import getLogger, setup_logging
+from proxy import PIM, maintain_pim
+
+log = getLogger('survey')
+
+SURVEY_HELLO = b'UPStart/5.0.1/UPBSHARK'
+SURVEY_INITIAL_WINDOW = 4.0
+SURVEY_MAX_WINDOW = 16.0
+SURVEY_REPORT_TIMEOUT = 3.0
+SURVEY_RETRIES = 2
+
+GETSIGNALSTRENGTH = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETSIGNALSTRENGTH)
+GETNOISELEVEL = mdid(MdidSet.MDID_CORE_COMMANDS, MdidCoreCmd.MDID_CORE_COMMAND_GETNOISELEVEL)
+
+
+def device_range(spec):
+    first, _, last = spec.partition('-')
+    return range(int(first), int(last or first) + 1)
+
+
+class SurveyRequest:
+
+    __slots__ = ('future', 'timer')
+
+    def __init__(self, future):
+        self.future = future
+        self.timer = None
+
+
+class DeviceSurvey:
+
+    __slots__ = ('device_id', 'present', 'signal', 'noise', 'naks', 'timeouts')
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.present = None
+        self.signal = None
+        self.noise = None
+        self.naks = 0
+        self.timeouts = 0
+
+    def as_dict(self):
+        return {
+            'device': self.device_id,
+            'present': self.present,
+            'signal': self.signal[0] if self.signal else None,
+            'noise_floor': self.noise[0] if self.noise else None,
+            'noise_counts': self.noise[1] if self.noise and len(self.noise) > 1 else None,
+            'naks': self.naks,
+            'timeouts': self.timeouts,
+        }
+
+
+class RequestPipeline:
+    """
+    Runs a job per device on one network through pim, keeping up to window
+    devices with a request queued or waiting for its report. A request
+    times out timeout seconds after it is written to the PIM, not after it
+    is queued. Devices need present, naks and timeouts attributes.
+    """
+
+    def __init__(self, pim, network_id, window=SURVEY_INITIAL_WINDOW, max_window=SURVEY_MAX_WINDOW,
+                 timeout=SURVEY_REPORT_TIMEOUT, retries=SURVEY_RETRIES):
+        self.pim = pim
+        self.network_id = network_id
+        self.window = window
+        self.max_window = max_window
+        self.timeout = timeout
+        self.retries = retries
+        self.loop = asyncio.get_event_loop()
+        self.requests = {}
+        self.active = 0
+        self.changed = asyncio.Condition()
+        self.busy = 0
+
+    def attach(self):
+        self.pim.message_listeners.append(self.message)
+        self.pim.transmission_listeners.append(self.transmission)
+        self.pim.transmit_listeners.append(self.transmitted)
+        self.pim.ack_listeners.append(self.acked)
+
+    def detach(self):
+        self.pim.message_listeners.remove(self.message)
+        self.pim.transmission_listeners.remove(self.transmission)
+        self.pim.transmit_listeners.remove(self.transmitted)
+        self.pim.ack_listeners.remove(self.acked)
+
+    def grow(self):
+        self.window = min(self.window + 1 / self.window, self.max_window)
+
+    def shrink(self, reason):
+        self.window = max(self.window / 2, 1.0)
+        log.debug("%s, window now %.1f", reason, self.window)
+
+    def resolve(self, key, result):
+        request = self.requests.pop(key, None)
+        if request is None:
+            return
+        if request.timer is not None:
+            request.timer.cancel()
+        if not request.future.done():
+            request.future.set_result(result)
+
+    def message(self, packet, copies):
+        if packet.network_id == self.network_id:
+            self.resolve((packet.source_id, packet.mdid), bytes(packet.data))
+
+    def transmission(self, transmission):
+        if transmission == UpbTransmission.UPB_PIM_BUSY:
+            self.busy += 1
+            self.shrink("PIM busy")
+
+    def transmitted(self, packet):
+        if packet.network_id != self.network_id:
+            return
+        request = self.requests.get((packet.destination_id, REPORTS.get(packet.mdid)))
+        if request is not None and request.timer is None:
+            request.timer = self.loop.call_later(self.timeout, self.resolve,
+                (packet.destination_id, REPORTS[packet.mdid]), None)
+
+    def acked(self, entry):
+        packet = entry.packet
+        if entry.nak and packet.network_id == self.network_id:
+            self.resolve((packet.destination_id, REPORTS.get(packet.mdid)), False)
+
+    async def request(self, device, command, data=b''):
+        """
+        Returns the report data, False on NAK or None on timeout, retrying
+        lost reports.
+        """
+        key = (device.device_id, REPORTS[command])
+        for attempt in range(self.retries + 1):
+            request = SurveyRequest(self.loop.create_future())
+            self.requests[key] = request
+            self.pim.originate(self.pim.encoder.transmit(self.network_id, device.device_id, command, data))
+            result = await request.future
+            if result is False:
+                device.naks += 1
+                if device.present:
+                    self.shrink(f"NAK from device {device.device_id}")
+                return False
+            if result is not None:
+                self.grow()
+                return result
+            device.timeouts += 1
+            self.shrink(f"no report from device {device.device_id}")
+        return None
+
+    async def pipelined(self, job, device):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.active < int(self.window))
+            self.active += 1
+        try:
+            await job(device)
+        finally:
+            async with self.changed:
+                self.active -= 1
+                self.changed.notify_all()
+
+    async def run(self, job, devices):
+        self.attach()
+        try:
+            await asyncio.gather(*(self.pipelined(job, device) for device in devices))
+        finally:
+            self.detach()
+            for key in list(self.requests):
+                self.resolve(key, None)
+
+
+class NetworkSurvey(RequestPipeline):
+    """
+    Signal strength and noise level of each of device_ids.
+    """
+
+    def __init__(self, pim, network_id, device_ids=range(1, 251), **kwargs):
+        super().__init__(pim, network_id, **kwargs)
+        self.devices = {device_id: DeviceSurvey(device_id) for device_id in device_ids}
+
+    async def survey_device(self, device):
+        signal = await self.request(device, GETSIGNALSTRENGTH)
+        if signal is False:
+            device.present = False
+        elif signal is not None:
+            device.present = True
+            device.signal = signal
+            device.noise = await self.request(device, GETNOISELEVEL)
+
+    async def survey(self):
+        await self.run(self.survey_device, self.devices.values())
+        return [device.as_dict() for device in self.devices.values()]
+
+
+async def connect(host, port, username=None, password=None, register_path=None):
+    """
+    Connects to a gateway, or to the proxy, as a client of its own and
+    returns the PIM once commands can be originated, with the task keeping
+    it connected.
+    """
+    pim = PIM(register_path=register_path, username=username, password=password)
+    # do the handshake a client session would
+    pim.hello = SURVEY_HELLO
+    pim.protocol = SURVEY_HELLO.split(b'/')[2]
+    connection = asyncio.ensure_future(maintain_pim(pim, host, port))
+    await pim.ready.wait()
+    return pim, connection
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Survey UPB signal strength and noise')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--network', type=int, default=1)
+    parser.add_argument('--devices', type=device_range, default=range(1, 251))
+    parser.add_argument('--window', type=float, default=SURVEY_INITIAL_WINDOW)
+    parser.add_argument('--max-window', type=float, default=SURVEY_MAX_WINDOW)
+    parser.add_argument('--timeout', type=float, default=SURVEY_REPORT_TIMEOUT)
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    args = parser.parse_args()
+
+    listener = setup_logging(os.environ.get('UPBSHARK_LOG_LEVEL', 'WARNING').upper())
+    connection = None
+    try:
+        pim, connection = await connect(args.host, args.port, args.username, args.password)
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        survey = NetworkSurvey(pim, args.network, args.devices, window=args.window, max_window=args.max_window,
+            timeout=args.timeout)
+        rows = await survey.survey()
+        print(f'surveyed {len(rows)} device IDs in {loop.time() - started:.1f}s, '
+            f'{sum(1 for row in rows if row["present"])} present, {survey.busy} PIM busy', file=sys.stderr)
+        for row in rows:
+            print(json.dumps(row))
+    finally:
+        if connection is not None:
+            connection.cancel()
+        listener.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+"""
+Tests for repeated message suppression
+"""
+
+from dedupe import MessageDeduper
+from packet import encode_packet
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def copy(seq, data=b'\x40'):
+    # transmit count 1, the sequence in the low bits
+    return encode_packet(1, 5, 0xff, 0x86, data, control=0x04 | seq)
+
+
+def test_repeats_join_the_first_copy():
+    deduper = MessageDeduper(2.0, Clock())
+    first = deduper.observe(copy(0))
+    assert first.count == 1
+    assert deduper.observe(copy(1)) is first
+    assert deduper.observe(copy(2)) is first
+    assert first.count == 3
+    assert deduper.repeats == 2
+
+
+def test_same_sequence_is_a_new_message():
+    deduper = MessageDeduper(2.0, Clock())
+    first = deduper.observe(copy(0))
+    deduper.observe(copy(1))
+    second = deduper.observe(copy(0))
+    assert second is not first
+    assert second.count == 1
+
+
+def test_different_message_is_not_a_repeat():
+    deduper = MessageDeduper(2.0, Clock())
+    first = deduper.observe(copy(0))
+    assert deduper.observe(copy(1, b'\x00')) is not first
+    assert len(deduper) == 2
+
+
+def test_window_expires_messages():
+    clock = Clock()
+    deduper = MessageDeduper(2.0, clock)
+    first = deduper.observe(copy(0))
+    clock.now = 2.5
+    later = deduper.observe(copy(1))
+    assert later is not first
+    assert later.count == 1
+    assert len(deduper) == 1
+
+
+def test_relay_flag_is_shared_with_repeats():
+    deduper = MessageDeduper(2.0, Clock())
+    first = deduper.observe(copy(0))
+    first.relay = False
+    assert not deduper.observe(copy(1)).relay
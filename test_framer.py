@@ -0,0 +1,90 @@
+"""
+Tests for the ring buffer framer
+"""
+
+from const import GatewayCmd, GATEWAY_REQUEST_HEADER_BYTES, GATEWAY_REQUEST_LENGTH_OFFSET, \
+GATEWAY_RESPONSE_HEADER_BYTES, GATEWAY_RESPONSE_LENGTH_OFFSET, GATEWAY_TRAILER_BYTES
+from framer import Framer, encode_gateway_request, encode_gateway_response
+
+
+def lines(framer, sep=b'\r'):
+    return [bytes(line) for line in framer.lines(sep)]
+
+
+def responses(framer):
+    return [(cmd, bytes(payload)) for cmd, frame, payload in framer.gateway_frames(GATEWAY_RESPONSE_HEADER_BYTES,
+        GATEWAY_RESPONSE_LENGTH_OFFSET, GATEWAY_TRAILER_BYTES, cmd_offset=1)]
+
+
+def test_lines_split_across_feeds():
+    framer = Framer()
+    framer.feed(b'PA\rP')
+    assert lines(framer) == [b'PA']
+    assert len(framer) == 1
+    framer.feed(b'K\r')
+    assert lines(framer) == [b'PK']
+    assert len(framer) == 0
+
+
+def test_empty_buffer_rewinds():
+    framer = Framer(8)
+    framer.feed(b'abcdef\r')
+    assert lines(framer) == [b'abcdef']
+    framer.feed(b'ghijklm\r')
+    assert framer.start == 0
+    assert lines(framer) == [b'ghijklm']
+
+
+def test_wraparound_compacts_pending_bytes():
+    framer = Framer(8)
+    framer.feed(b'abcd\ref')
+    assert lines(framer) == [b'abcd']
+    buf = framer.buf
+    framer.feed(b'gh\r')
+    # the pending 'ef' is moved to the front of the same buffer
+    assert framer.buf is buf
+    assert framer.start == 0
+    assert lines(framer) == [b'efgh']
+
+
+def test_grows_when_pending_does_not_fit():
+    framer = Framer(8)
+    framer.feed(b'abcdef')
+    framer.feed(b'ghijkl\r')
+    assert len(framer.buf) >= 13
+    assert lines(framer) == [b'abcdefghijkl']
+
+
+def test_null_terminated_lines():
+    framer = Framer()
+    framer.feed(b'PIM/1.0/PROTO/NO AUTH/00\x00PU')
+    assert lines(framer, b'\x00') == [b'PIM/1.0/PROTO/NO AUTH/00']
+    assert lines(framer) == []
+    assert len(framer) == 2
+
+
+def test_gateway_responses_split_across_feeds():
+    data = encode_gateway_response(GatewayCmd.SEND_TO_SERIAL, b'PA\r') + \
+        encode_gateway_response(GatewayCmd.KEEP_ALIVE, b'')
+    framer = Framer(16)
+    framer.feed(data[:5])
+    assert responses(framer) == []
+    framer.feed(data[5:])
+    assert responses(framer) == [(GatewayCmd.SEND_TO_SERIAL, b'PA\r'), (GatewayCmd.KEEP_ALIVE, b'')]
+    assert len(framer) == 0
+
+
+def test_gateway_requests():
+    framer = Framer()
+    framer.feed(encode_gateway_request(GatewayCmd.SEND_TO_SERIAL, b'\x14ABCD\r'))
+    frames = [(cmd, bytes(frame), bytes(payload)) for cmd, frame, payload in framer.gateway_frames(
+        GATEWAY_REQUEST_HEADER_BYTES, GATEWAY_REQUEST_LENGTH_OFFSET, GATEWAY_TRAILER_BYTES)]
+    assert frames == [(GatewayCmd.SEND_TO_SERIAL, encode_gateway_request(GatewayCmd.SEND_TO_SERIAL, b'\x14ABCD\r'),
+        b'\x14ABCD\r')]
+
+
+def test_unknown_gateway_command_stops():
+    framer = Framer()
+    framer.feed(b'\xee' + encode_gateway_response(GatewayCmd.KEEP_ALIVE, b'')[1:])
+    assert responses(framer) == []
+    assert len(framer) == GATEWAY_RESPONSE_HEADER_BYTES + GATEWAY_TRAILER_BYTES
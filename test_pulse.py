@@ -0,0 +1,84 @@
+"""
+Tests for the pulse mode decoder
+"""
+
+from const import UpbMessage
+from packet import encode_packet
+from pulse import PulseDecoder, PulseEvent
+from simulator import pulse_lines
+
+PACKET = encode_packet(1, 5, 0xff, 0x86, b'\x40')
+OTHER = encode_packet(1, 6, 0xff, 0x86, b'\x00')
+
+
+def packets(events):
+    return [event[1] for event in events if event[0] == PulseEvent.PACKET]
+
+
+def with_seq(line, seq):
+    return line[:2] + b'0123456789ABCDEF'[seq:seq + 1]
+
+
+def test_decodes_packet():
+    events = PulseDecoder().decode(pulse_lines(PACKET))
+    assert events == [(PulseEvent.PACKET, PACKET, False, UpbMessage.UPB_MESSAGE_ACK)]
+
+
+def test_packet_split_across_batches():
+    decoder = PulseDecoder()
+    lines = pulse_lines(PACKET)
+    assert decoder.decode(lines[:7]) == []
+    assert packets(decoder.decode(lines[7:])) == [PACKET]
+
+
+def test_grows_for_long_packets():
+    packet = encode_packet(1, 5, 0xff, 0x90, bytes(range(20)))
+    assert packets(PulseDecoder(size=4).decode(pulse_lines(packet))) == [packet]
+
+
+def test_sequence_error_discards_packet():
+    lines = pulse_lines(PACKET)
+    lines[5] = with_seq(lines[5], 9)
+    events = PulseDecoder().decode(lines)
+    assert (PulseEvent.SEQUENCE_ERROR, 4, 9) in events
+    assert packets(events) == []
+
+
+def test_resync_on_end():
+    lines = pulse_lines(PACKET)
+    lines[3] = with_seq(lines[3], 0)
+    decoder = PulseDecoder()
+    assert packets(decoder.decode(lines)) == []
+    # the END of the broken packet resets the sequence for the next one
+    assert packets(decoder.decode(pulse_lines(OTHER))) == [OTHER]
+
+
+def test_resync_on_reset():
+    lines = pulse_lines(PACKET)
+    decoder = PulseDecoder()
+    decoder.decode(lines[:6])
+    # a new START abandons the partial packet, its data continues the sequence
+    restarted = [with_seq(line, (index + 4) & 0x0f) if index else line
+        for index, line in enumerate(pulse_lines(OTHER)[:-1])]
+    events = decoder.decode(restarted + pulse_lines(OTHER)[-1:])
+    assert packets(events) == [OTHER]
+
+
+def test_other_lines_pass_through():
+    events = PulseDecoder().decode([b'PA', b''] + pulse_lines(PACKET) + [b'PK'])
+    assert events[0] == (PulseEvent.LINE, b'PA')
+    assert events[1][0] == PulseEvent.PACKET
+    assert events[2] == (PulseEvent.LINE, b'PK')
+
+
+def test_drop_reports_partial_packet():
+    lines = pulse_lines(PACKET)
+    events = PulseDecoder().decode(lines[:9] + [bytes((UpbMessage.UPB_MESSAGE_DROP, 0x30))])
+    assert events == [(PulseEvent.DROP, PACKET[:2])]
+
+
+def test_reset_clears_state():
+    decoder = PulseDecoder()
+    decoder.decode(pulse_lines(PACKET)[:6])
+    decoder.reset()
+    assert packets(decoder.decode(pulse_lines(OTHER))) == [OTHER]
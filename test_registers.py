@@ -0,0 +1,112 @@
+"""
+Tests for the register image and cache
+"""
+
+from links import LINK_TABLE_START
+from packet import decode_packet, encode_packet
+from registers import RegisterImage, RegisterCache, GETREGISTERVALUES, SETREGISTERVALUES, WRITEENABLE, \
+REGISTERVALUES, REGISTER_COUNT
+
+
+def read_request(device_id, start, count):
+    return decode_packet(encode_packet(1, device_id, 0xff, GETREGISTERVALUES, bytes((start, count))))
+
+
+def register_report(device_id, start, values):
+    return decode_packet(encode_packet(1, 0xff, device_id, REGISTERVALUES, bytes((start,)) + values))
+
+
+def test_missing_unknown_image():
+    assert RegisterImage().missing(0x10, 16) == (0x10, 16)
+
+
+def test_missing_known_range():
+    image = RegisterImage()
+    image.update(0x10, bytes(range(16)))
+    assert image.missing(0x10, 16) is None
+    assert image.missing(0x14, 4) is None
+    assert image.read(0x14, 4) == bytes((4, 5, 6, 7))
+
+
+def test_missing_narrows_to_unknown_window():
+    image = RegisterImage()
+    image.update(0x10, bytes(8))
+    assert image.missing(0x10, 16) == (0x18, 8)
+    assert image.missing(0x08, 16) == (0x08, 8)
+    image.update(0x20, bytes(8))
+    # one window covers both gaps
+    assert image.missing(0x08, 0x20) == (0x08, 0x18)
+
+
+def test_invalidate():
+    image = RegisterImage()
+    image.update(0, bytes(REGISTER_COUNT))
+    image.invalidate(0x12, 2)
+    assert image.missing(0x10, 16) == (0x12, 2)
+    image.invalidate()
+    assert image.missing(0, 4) == (0, 4)
+
+
+def test_update_clipped_to_register_space():
+    image = RegisterImage()
+    image.update(REGISTER_COUNT - 2, b'\x01\x02\x03')
+    assert image.missing(REGISTER_COUNT - 2, 2) is None
+    assert len(image.values) == REGISTER_COUNT
+
+
+def test_answer_from_cache():
+    cache = RegisterCache(None)
+    cache.report(register_report(5, 0x10, bytes(range(16))))
+    report, request = cache.answer(read_request(5, 0x14, 4), None)
+    assert request is None
+    assert decode_packet(report).data == b'\x14' + bytes((4, 5, 6, 7))
+    assert cache.hits == 1
+
+
+def test_answer_unknown_goes_out_unchanged():
+    cache = RegisterCache(None)
+    assert cache.answer(read_request(5, 0x10, 16), None) == (None, None)
+    assert cache.pending == {}
+
+
+def test_answer_narrows_and_report_completes():
+    cache = RegisterCache(None)
+    session = object()
+    cache.report(register_report(5, 0x10, bytes(8)))
+    request = read_request(5, 0x10, 16)
+    report, narrowed = cache.answer(request, session)
+    assert report is None
+    assert decode_packet(narrowed).data == b'\x18\x08'
+    completed = cache.report(register_report(5, 0x18, bytes(range(8))))
+    assert [(owner, packet) for owner, packet, report in completed] == [(session, request)]
+    assert decode_packet(completed[0][2]).data == b'\x10' + bytes(8) + bytes(range(8))
+    assert cache.pending == {}
+
+
+def test_failed_narrowed_read():
+    cache = RegisterCache(None)
+    session = object()
+    cache.report(register_report(5, 0x10, bytes(8)))
+    request = read_request(5, 0x10, 16)
+    report, narrowed = cache.answer(request, session)
+    assert cache.fail(decode_packet(narrowed)) == [(session, request)]
+    assert cache.pending == {}
+
+
+def test_writes_invalidate():
+    cache = RegisterCache(None)
+    cache.image(1, 5).update(0, bytes(REGISTER_COUNT))
+    cache.command(decode_packet(encode_packet(1, 5, 0xff, SETREGISTERVALUES, b'\x12\x00\x00')))
+    assert cache.image(1, 5).missing(0x10, 16) == (0x12, 2)
+    cache.command(decode_packet(encode_packet(1, 5, 0xff, WRITEENABLE)))
+    assert (1, 5) not in cache.images
+
+
+def test_link_table_write_drops_links():
+    cache = RegisterCache(None)
+    cache.image(1, 5).update(0, bytes(REGISTER_COUNT))
+    cache.links.add(1, 5, 9, 100)
+    cache.command(decode_packet(encode_packet(1, 5, 0xff, SETREGISTERVALUES,
+        bytes((LINK_TABLE_START, 0x07)))))
+    assert cache.image(1, 5).missing(LINK_TABLE_START, 1) == (LINK_TABLE_START, 1)
+    assert not cache.links.targets(1, 9)
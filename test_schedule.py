@@ -0,0 +1,220 @@
+"""
+Tests for the timer wheel and schedule engine
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from encoder import CommandEncoder
+from schedule import TimerWheel, ScheduleEngine, ScheduleEntry, parse_days, ALL_DAYS
+
+
+class Due:
+
+    __slots__ = ('due', 'cancelled')
+
+    def __init__(self, due):
+        self.due = due
+        self.cancelled = False
+
+
+def expire(wheel, start, end, step):
+    """
+    Advances the wheel in steps, returning (time, entry) for each expiry.
+    """
+    fired = []
+    now = start
+    while now < end:
+        now += step
+        fired.extend((now, entry) for entry in wheel.advance(now))
+    return fired
+
+
+def test_fires_on_its_tick():
+    wheel = TimerWheel(0.0, tick=0.02)
+    entry = Due(0.1)
+    wheel.insert(entry)
+    assert len(wheel) == 1
+    assert wheel.advance(0.08) == []
+    assert wheel.advance(0.1) == [entry]
+    assert len(wheel) == 0
+
+
+def test_past_due_fires_on_next_tick():
+    wheel = TimerWheel(1.0, tick=0.02)
+    entry = Due(0.5)
+    wheel.insert(entry)
+    assert wheel.advance(1.02) == [entry]
+
+
+@pytest.mark.parametrize('due', [0.5, 1.28, 1.3, 5.0, 90.0, 400.0])
+def test_cascades_from_higher_levels(due):
+    wheel = TimerWheel(0.0, tick=0.02, bits=3, levels=3)
+    entry = Due(due)
+    wheel.insert(entry)
+    fired = expire(wheel, 0.0, due + 1.0, 0.02)
+    assert len(fired) == 1
+    assert fired[0][0] == pytest.approx(due, abs=0.021)
+    assert len(wheel) == 0
+
+
+def test_beyond_top_level_is_parked():
+    # 3 levels of 8 slots span 512 ticks
+    wheel = TimerWheel(0.0, tick=1.0, bits=3, levels=3)
+    entry = Due(2000.0)
+    wheel.insert(entry)
+    fired = expire(wheel, 0.0, 2100.0, 1.0)
+    assert [when for when, _ in fired] == [pytest.approx(2000.0)]
+
+
+def test_order_of_expiry():
+    wheel = TimerWheel(0.0, tick=0.02)
+    entries = [Due(due) for due in (3.0, 0.04, 1.5, 0.5)]
+    for entry in entries:
+        wheel.insert(entry)
+    fired = [entry.due for _, entry in expire(wheel, 0.0, 4.0, 0.1)]
+    assert fired == [0.04, 0.5, 1.5, 3.0]
+
+
+def test_cancelled_entries_are_dropped():
+    wheel = TimerWheel(0.0, tick=0.02)
+    kept, cancelled, far = Due(0.1), Due(0.1), Due(10.0)
+    for entry in (kept, cancelled, far):
+        wheel.insert(entry)
+    cancelled.cancelled = True
+    far.cancelled = True
+    assert [entry for _, entry in expire(wheel, 0.0, 11.0, 0.5)] == [kept]
+    assert len(wheel) == 0
+
+
+def test_next_tick():
+    wheel = TimerWheel(0.0, tick=0.02, bits=6)
+    assert wheel.next_tick() == 64
+    wheel.insert(Due(0.1))
+    assert wheel.next_tick() == 5
+
+
+def test_next_after_time_of_day():
+    entry = ScheduleEntry(1, 5, (18, 30, 0), parse_days('mon,wed'))
+    # 2026-10-19 is a Monday
+    monday = datetime(2026, 10, 19, 12, 0)
+    assert entry.next_after(monday) == datetime(2026, 10, 19, 18, 30)
+    assert entry.next_after(monday.replace(hour=19)) == datetime(2026, 10, 21, 18, 30)
+
+
+def test_next_after_one_shot():
+    at = datetime(2026, 12, 24, 17, 45)
+    entry = ScheduleEntry(1, 9, at)
+    assert entry.next_after(at - timedelta(days=1)) == at
+    assert entry.next_after(at + timedelta(seconds=1)) is None
+
+
+def test_from_dict():
+    entry = ScheduleEntry.from_dict({'at': '23:00', 'network': 1, 'link': 5, 'action': 'deactivate'})
+    assert entry.at == (23, 0, 0)
+    assert entry.days == ALL_DAYS
+    assert not entry.activate
+    with pytest.raises(ValueError):
+        ScheduleEntry.from_dict({'at': '23:00', 'network': 1, 'link': 5, 'action': 'toggle'})
+
+
+class Handle:
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.handles = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        handle = Handle(when, callback)
+        self.handles.append(handle)
+        return handle
+
+    def run(self, seconds):
+        end = self.now + seconds
+        while True:
+            due = [handle for handle in self.handles if not handle.cancelled and handle.when <= end]
+            if not due:
+                break
+            handle = min(due, key=lambda handle: handle.when)
+            self.handles.remove(handle)
+            self.now = handle.when
+            handle.callback()
+        self.now = end
+
+
+class Ready:
+
+    def __init__(self, ready):
+        self.ready = ready
+
+    def is_set(self):
+        return self.ready
+
+
+class FakePIM:
+
+    def __init__(self, ready=True):
+        self.ready = Ready(ready)
+        self.encoder = CommandEncoder()
+        self.originated = []
+
+    def originate(self, frame):
+        self.originated.append(bytes(frame))
+
+
+def one_shot(seconds):
+    return ScheduleEntry(1, 5, datetime.now() + timedelta(seconds=seconds))
+
+
+def test_engine_fires_link_activation():
+    loop = FakeLoop()
+    pim = FakePIM()
+    engine = ScheduleEngine(pim, [one_shot(1.0)], loop=loop)
+    assert len(engine) == 1
+    assert len(loop.handles) == 1
+    loop.run(0.5)
+    assert pim.originated == []
+    loop.run(1.0)
+    assert pim.originated == [bytes(CommandEncoder().activate_link(1, 5))]
+    assert engine.fired == 1
+    assert len(engine) == 0
+
+
+def test_engine_skips_when_pim_not_ready():
+    loop = FakeLoop()
+    pim = FakePIM(ready=False)
+    engine = ScheduleEngine(pim, [one_shot(0.5)], loop=loop)
+    loop.run(1.0)
+    assert pim.originated == []
+    assert engine.skipped == 1
+
+
+def test_engine_drops_past_one_shot():
+    engine = ScheduleEngine(FakePIM(), loop=FakeLoop())
+    assert not engine.add(one_shot(-10.0))
+    assert len(engine) == 0
+
+
+def test_engine_cancel():
+    loop = FakeLoop()
+    pim = FakePIM()
+    entry = one_shot(0.5)
+    engine = ScheduleEngine(pim, [entry], loop=loop)
+    engine.cancel(entry)
+    loop.run(1.0)
+    assert pim.originated == []
@@ -0,0 +1,193 @@
+"""
+Tests for the transmit scheduler
+"""
+
+from const import PimCommand, UpbTransmission
+from packet import decode_packet, encode_packet
+from scheduler import TransmitScheduler, TransmitPriority, TransmitEntry, transmit_priority, coalesce_key, \
+TRANSMIT_BUSY_RETRIES
+
+
+class Handle:
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop:
+    """
+    Just enough of an event loop for the scheduler, time only moves on run().
+    """
+
+    def __init__(self):
+        self.now = 100.0
+        self.handles = []
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback):
+        handle = Handle(self.now + delay, callback)
+        self.handles.append(handle)
+        return handle
+
+    def run(self, seconds):
+        end = self.now + seconds
+        while True:
+            due = [handle for handle in self.handles if not handle.cancelled and handle.when <= end]
+            if not due:
+                break
+            handle = min(due, key=lambda handle: handle.when)
+            self.handles.remove(handle)
+            self.now = handle.when
+            handle.callback()
+        self.now = end
+
+
+def transmit(device_id, mdid, data=b''):
+    packet = decode_packet(encode_packet(1, device_id, 0xff, mdid, data))
+    return packet, dict(priority=transmit_priority(PimCommand.UPB_NETWORK_TRANSMIT, packet),
+        key=coalesce_key(PimCommand.UPB_NETWORK_TRANSMIT, packet), needs_ack=True, packet=packet)
+
+
+def scheduler(**kwargs):
+    loop = FakeLoop()
+    written = []
+    return TransmitScheduler(written.append, loop=loop, **kwargs), loop, written
+
+
+def test_priorities():
+    goto, _ = transmit(5, 0x22, b'\x40')
+    read, _ = transmit(5, 0x10, b'\x00\x10')
+    status, _ = transmit(5, 0x07)
+    assert transmit_priority(PimCommand.UPB_NETWORK_TRANSMIT, goto) == TransmitPriority.INTERACTIVE
+    assert transmit_priority(PimCommand.UPB_NETWORK_TRANSMIT, read) == TransmitPriority.BULK
+    assert transmit_priority(PimCommand.UPB_NETWORK_TRANSMIT, status) == TransmitPriority.NORMAL
+    assert transmit_priority(PimCommand.UPB_PIM_READ, None) == TransmitPriority.NORMAL
+
+
+def test_entry_order():
+    entries = [TransmitEntry(TransmitPriority.BULK, 0, b'a'), TransmitEntry(TransmitPriority.INTERACTIVE, 2, b'b'),
+        TransmitEntry(TransmitPriority.INTERACTIVE, 1, b'c')]
+    assert [entry.frame for entry in sorted(entries)] == [b'c', b'b', b'a']
+
+
+def test_interactive_goes_first():
+    sched, loop, written = scheduler()
+    sched.pause()
+    packet, args = transmit(5, 0x10, b'\x00\x10')
+    sched.submit(b'read', **args)
+    packet, args = transmit(6, 0x22, b'\x40')
+    sched.submit(b'goto', **args)
+    sched.resume()
+    assert written == [b'goto']
+    sched.transmission(UpbTransmission.UPB_TRANSMISSION_ACK)
+    loop.run(1.0)
+    assert written == [b'goto', b'read']
+
+
+def test_waits_for_ack_and_paces():
+    sched, loop, written = scheduler(min_interval=0.05)
+    for device_id in (5, 6):
+        packet, args = transmit(device_id, 0x30)
+        sched.submit(bytes((device_id,)), **args)
+    assert written == [b'\x05']
+    # a network transmit is only complete once ACKed
+    sched.transmission(UpbTransmission.UPB_PIM_ACCEPT)
+    assert written == [b'\x05']
+    loop.run(0.01)
+    sched.transmission(UpbTransmission.UPB_TRANSMISSION_ACK)
+    assert written == [b'\x05']
+    loop.run(0.04)
+    assert written == [b'\x05', b'\x06']
+
+
+def test_timeout_sends_next():
+    sched, loop, written = scheduler(timeout=2.0)
+    for device_id in (5, 6):
+        packet, args = transmit(device_id, 0x30)
+        sched.submit(bytes((device_id,)), **args)
+    loop.run(1.9)
+    assert written == [b'\x05']
+    loop.run(0.2)
+    assert written == [b'\x05', b'\x06']
+
+
+def test_coalesces_device_control():
+    sched, loop, written = scheduler()
+    sched.pause()
+    session = object()
+    packet, args = transmit(5, 0x22, b'\x40')
+    sched.submit(b'first', owner=session, **args)
+    packet, args = transmit(5, 0x22, b'\x00')
+    sched.submit(b'second', **args)
+    assert len(sched) == 1
+    assert sched.coalesced == 1
+    sent = []
+    sched.sent = lambda packet, owner: sent.append((packet, owner))
+    sched.resume()
+    assert written == [b'second']
+    # the superseded client still waits for the outcome
+    assert sent == [(packet, session)]
+
+
+def test_identical_reads_coalesce_different_ones_do_not():
+    sched, loop, written = scheduler()
+    sched.pause()
+    for data in (b'\x00\x10', b'\x00\x10', b'\x10\x10'):
+        packet, args = transmit(5, 0x10, data)
+        sched.submit(data, **args)
+    assert len(sched) == 2
+    assert sched.coalesced == 1
+
+
+def test_busy_retry_keeps_order():
+    sched, loop, written = scheduler(busy_delay=0.25)
+    packet, args = transmit(5, 0x30)
+    sched.submit(b'first', **args)
+    packet, args = transmit(6, 0x30)
+    sched.submit(b'second', **args)
+    sched.transmission(UpbTransmission.UPB_PIM_BUSY)
+    loop.run(0.2)
+    assert written == [b'first']
+    loop.run(0.1)
+    assert written == [b'first', b'first']
+    sched.transmission(UpbTransmission.UPB_TRANSMISSION_ACK)
+    loop.run(1.0)
+    assert written == [b'first', b'first', b'second']
+
+
+def test_busy_drop_after_retries():
+    dropped = []
+    sched, loop, written = scheduler(dropped=lambda packet, owner: dropped.append((packet, owner)))
+    session = object()
+    packet, args = transmit(5, 0x30)
+    sched.submit(b'first', owner=session, **args)
+    other, args = transmit(6, 0x30)
+    sched.submit(b'second', **args)
+    for _ in range(TRANSMIT_BUSY_RETRIES):
+        sched.transmission(UpbTransmission.UPB_PIM_BUSY)
+        loop.run(1.0)
+        assert dropped == []
+    assert written == [b'first'] * (TRANSMIT_BUSY_RETRIES + 1)
+    sched.transmission(UpbTransmission.UPB_PIM_BUSY)
+    assert dropped == [(packet, session)]
+    loop.run(1.0)
+    assert written[-1] == b'second'
+
+
+def test_pause_requeues_outstanding():
+    sched, loop, written = scheduler()
+    packet, args = transmit(5, 0x30)
+    sched.submit(b'first', **args)
+    sched.pause()
+    assert sched.outstanding is None
+    assert len(sched) == 1
+    sched.resume()
+    loop.run(0.1)
+    assert written == [b'first', b'first']